@@ -5,19 +5,12 @@ El formato ChatML es compatible con modelos Qwen2.5-Instruct.
 """
 
 import json
+import sys
 from pathlib import Path
 
-SYSTEM_INSTRUCTION = (
-    "Genera una epicrisis narrativa en UN SOLO PARRAFO. "
-    "USA SOLO la informacion del JSON, NO inventes datos. "
-    "IMPORTANTE: Incluye TODOS los codigos entre parentesis: "
-    "diagnostico de ingreso con codigo CIE-10 (ej: I20.0), "
-    "procedimientos con codigo K (ej: K492, K493), "
-    "medicacion con dosis y codigo ATC (ej: B01AC06). "
-    "Estructura: dx ingreso -> procedimientos -> evolucion -> dx alta -> medicacion alta. "
-    "Abreviaturas: DA=descendente anterior, CD=coronaria derecha, CX=circunfleja, "
-    "SDST=supradesnivel ST, IAM=infarto agudo miocardio."
-)
+# Prompt compartido con la inferencia (inference/prompt_compiler.py)
+sys.path.append(str(Path(__file__).resolve().parents[1] / "inference"))
+from prompt_compiler import DEFAULT_STYLE, build_training_text, save_prompt_style  # noqa: E402
 
 
 def convert_to_chatml(input_data: dict, output_text: str) -> str:
@@ -28,19 +21,11 @@ def convert_to_chatml(input_data: dict, output_text: str) -> str:
     <|im_start|>system
     {system_instruction}<|im_end|>
     <|im_start|>user
-    {json_input}<|im_end|>
+    {json_input en DEFAULT_STYLE}<|im_end|>
     <|im_start|>assistant
     {output}<|im_end|>
     """
-    json_str = json.dumps(input_data, ensure_ascii=False, indent=2)
-
-    chatml = (
-        f"<|im_start|>system\n{SYSTEM_INSTRUCTION}<|im_end|>\n"
-        f"<|im_start|>user\n{json_str}<|im_end|>\n"
-        f"<|im_start|>assistant\n{output_text}<|im_end|>"
-    )
-
-    return chatml
+    return build_training_text(input_data, output_text)
 
 
 def process_datasets():
@@ -119,9 +104,12 @@ def process_datasets():
         for example in valid_examples:
             f.write(json.dumps(example, ensure_ascii=False) + "\n")
 
+    save_prompt_style(output_dir, DEFAULT_STYLE)
+
     print(f"\nDatasets ChatML guardados en {output_dir}/")
     print(f"  - train.jsonl: {len(train_examples)} ejemplos")
     print(f"  - valid.jsonl: {len(valid_examples)} ejemplos")
+    print(f"  - prompt_style.json: estilo de prompt '{DEFAULT_STYLE}'")
 
     # Mostrar ejemplo
     print("\n" + "="*60)
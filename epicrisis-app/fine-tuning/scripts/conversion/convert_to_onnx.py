@@ -3,9 +3,11 @@ Convierte el modelo fine-tuned a ONNX para Transformers.js
 Paso 1: Merge LoRA con modelo base
 Paso 2: Exportar a ONNX
 Paso 3: Cuantizar a INT8
+Paso 4: (opcional) Logits solo de la última posición (ver last_token_logits.py)
 """
 
 import os
+import shutil
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from peft import PeftModel
@@ -15,16 +17,20 @@ print("CONVERSIÓN DE MODELO FINE-TUNED A ONNX")
 print("=" * 60)
 
 # Configuración
+# prompt_style.json (estilo de prompt del entrenamiento, inference/prompt_compiler.py) viaja con el modelo
+PROMPT_STYLE_FILE = "prompt_style.json"
 MODEL_PATH = "./epicrisis-model-finetuned"
 BASE_MODEL = "Qwen/Qwen2.5-1.5B-Instruct"
 MERGED_PATH = "./epicrisis-merged"
 ONNX_PATH = "./epicrisis-onnx"
+# Genera además <modelo>_last_logits.onnx (prefill sin logits [seq, vocab])
+LAST_TOKEN_LOGITS = True
 
 # ============================================
 # PASO 1: Merge LoRA con modelo base
 # ============================================
 
-print("\n[1/3] Merging LoRA adapters con modelo base...")
+print("\n[1/4] Merging LoRA adapters con modelo base...")
 
 # Cargar tokenizer
 tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH)
@@ -51,6 +57,8 @@ print(f"   Guardando en {MERGED_PATH}...")
 os.makedirs(MERGED_PATH, exist_ok=True)
 model.save_pretrained(MERGED_PATH, safe_serialization=True)
 tokenizer.save_pretrained(MERGED_PATH)
+if os.path.exists(os.path.join(MODEL_PATH, PROMPT_STYLE_FILE)):
+    shutil.copy2(os.path.join(MODEL_PATH, PROMPT_STYLE_FILE), MERGED_PATH)
 
 print("✓ Modelo mergeado guardado!")
 
@@ -63,7 +71,7 @@ torch.cuda.empty_cache() if torch.cuda.is_available() else None
 # PASO 2: Exportar a ONNX
 # ============================================
 
-print("\n[2/3] Exportando a ONNX...")
+print("\n[2/4] Exportando a ONNX...")
 
 # Usar optimum para exportar
 from optimum.exporters.onnx import main_export
@@ -97,11 +105,14 @@ except Exception as e:
         print(f"❌ Error: {result.stderr}")
         exit(1)
 
+if os.path.exists(os.path.join(MERGED_PATH, PROMPT_STYLE_FILE)):
+    shutil.copy2(os.path.join(MERGED_PATH, PROMPT_STYLE_FILE), ONNX_PATH)
+
 # ============================================
 # PASO 3: Cuantizar a INT8
 # ============================================
 
-print("\n[3/3] Cuantizando a INT8...")
+print("\n[3/4] Cuantizando a INT8...")
 
 ONNX_Q8_PATH = "./epicrisis-onnx-q8"
 
@@ -115,12 +126,37 @@ try:
     quantizer = ORTQuantizer.from_pretrained(ONNX_PATH)
     quantizer.quantize(save_dir=ONNX_Q8_PATH, quantization_config=qconfig)
 
+    if os.path.exists(os.path.join(ONNX_PATH, PROMPT_STYLE_FILE)):
+        shutil.copy2(os.path.join(ONNX_PATH, PROMPT_STYLE_FILE), ONNX_Q8_PATH)
     print("✓ Modelo cuantizado guardado!")
 except Exception as e:
     print(f"⚠️  Cuantización falló: {e}")
     print("   Usando modelo sin cuantizar...")
     ONNX_Q8_PATH = ONNX_PATH
 
+# ============================================
+# PASO 4: Logits solo de la última posición
+# ============================================
+
+if LAST_TOKEN_LOGITS:
+    print("\n[4/4] Reescribiendo lm_head para devolver solo los últimos logits...")
+
+    import onnx
+    from last_token_logits import add_logits_to_keep
+
+    for f in sorted(os.listdir(ONNX_Q8_PATH)):
+        if not f.endswith(".onnx") or f.endswith("_last_logits.onnx"):
+            continue
+        source = os.path.join(ONNX_Q8_PATH, f)
+        target = os.path.join(ONNX_Q8_PATH, f.replace(".onnx", "_last_logits.onnx"))
+        try:
+            # Sin cargar pesos externos: el grafo nuevo referencia los mismos .onnx_data
+            model = onnx.load(source, load_external_data=False)
+            onnx.save(add_logits_to_keep(model), target)
+            print(f"✓ {target}")
+        except Exception as e:
+            print(f"⚠️  No se pudo reescribir {f}: {e}")
+
 # ============================================
 # RESUMEN
 # ============================================
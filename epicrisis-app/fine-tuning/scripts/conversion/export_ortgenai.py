@@ -5,12 +5,49 @@ FP16 ofrece mejor calidad que INT4 con tamaño razonable (~2.9GB).
 ORT GenAI soporta: int4, bf16, fp16, fp32 (no soporta int8).
 """
 import argparse
+import json
 import shutil
 import subprocess
 import sys
 from pathlib import Path
 
 
+def write_last_token_logits(model_path: Path) -> Path:
+    """
+    Escribe <modelo>_last_logits.onnx junto al export (mismos pesos externos).
+
+    Es para DecodeEngine (onnx_min_infer, batch_generate, worker):
+    genai_config.json sigue apuntando al model.onnx original, porque no está
+    verificado que el generador de ORT GenAI acepte logits [batch, 1, vocab]
+    en el prefill ni la entrada num_logits_to_keep.
+    """
+    import onnx
+
+    from last_token_logits import add_logits_to_keep
+
+    output_path = model_path.with_name(f"{model_path.stem}_last_logits.onnx")
+    print(f"\nReescribiendo lm_head (solo últimos logits): {output_path}")
+    model = onnx.load(str(model_path), load_external_data=False)
+    onnx.save(add_logits_to_keep(model), str(output_path))
+    print("✓ Entrada num_logits_to_keep agregada (por defecto 1); ORT GenAI sigue usando model.onnx")
+    return output_path
+
+
+def use_precompiled(output_dir: Path, fmt: str):
+    """Precompila model.onnx y apunta genai_config.json al resultado (solo EP cpu)."""
+    from precompile_ort import precompile
+
+    print(f"\nPrecompilando model.onnx ({fmt})...")
+    outputs = precompile(output_dir / "model.onnx", formats=[fmt])
+    if fmt not in outputs:
+        return
+    config_path = output_dir / "genai_config.json"
+    config = json.loads(config_path.read_text(encoding="utf-8"))
+    config["model"]["decoder"]["filename"] = outputs[fmt].name
+    config_path.write_text(json.dumps(config, indent=4), encoding="utf-8")
+    print(f"✓ genai_config.json usa {outputs[fmt].name}")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Exportar modelo a ORT GenAI")
     parser.add_argument(
@@ -35,8 +72,25 @@ def main():
         default="webgpu",
         help="Proveedor de ejecución objetivo",
     )
+    parser.add_argument(
+        "--last-token-logits",
+        action="store_true",
+        help="Escribir además model_last_logits.onnx, con lm_head solo en la última posición "
+        "(entrada num_logits_to_keep, ver last_token_logits.py). Solo para DecodeEngine "
+        "(onnx_min_infer/batch_generate/worker); ORT GenAI sigue usando model.onnx",
+    )
+    parser.add_argument(
+        "--precompile",
+        choices=["prepacked", "ort"],
+        default=None,
+        help="Guardar el grafo optimizado con pesos prepackeados (prepacked) o en formato .ort "
+        "y usarlo en genai_config.json (solo --execution-provider cpu, ver precompile_ort.py)",
+    )
     args = parser.parse_args()
 
+    if args.precompile and args.execution_provider != "cpu":
+        parser.error("--precompile genera grafos optimizados para CPU; usar con --execution-provider cpu")
+
     model_dir = Path(args.model_dir)
     output_dir = Path(args.output_dir)
 
@@ -80,6 +134,17 @@ def main():
         print("=" * 60)
         print(f"Modelo exportado a: {output_dir}")
 
+        # El estilo de prompt viaja con el modelo (inference/prompt_compiler.py)
+        style_file = model_dir / "prompt_style.json"
+        if style_file.exists():
+            shutil.copy2(style_file, output_dir / style_file.name)
+
+        if args.last_token_logits:
+            write_last_token_logits(output_dir / "model.onnx")
+
+        if args.precompile:
+            use_precompiled(output_dir, args.precompile)
+
         # Listar archivos generados
         print("\nArchivos generados:")
         for f in sorted(output_dir.iterdir()):
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Cirugía de grafo: logits solo de las últimas posiciones.
+
+Los exports de optimum / transformers.js calculan `lm_head` sobre toda la
+secuencia y devuelven `logits` [batch, seq, vocab] en float32. En el prefill
+de un prompt ChatML (SYSTEM_INSTRUCTION + JSON clínico indentado) eso son
+cientos de MB que el runner descarta para quedarse con la última fila.
+
+Este script inserta un Slice justo antes de `lm_head`, controlado por una
+entrada nueva `num_logits_to_keep` (int64 escalar, valor por defecto 1):
+- prefill y decode obtienen logits [batch, 1, vocab];
+- quien necesite más posiciones (p.ej. verificación especulativa) pasa N.
+
+Con left padding la última columna siempre es un token real, así que el
+resultado es idéntico al slice `logits[:, -1]` del grafo original.
+
+Los pesos externos (`*.onnx_data`) no se cargan: solo se reescribe el grafo
+y, si la salida va a otro directorio, se copian los archivos de datos.
+
+Uso:
+    python last_token_logits.py \
+        --model ../../../models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx
+"""
+import argparse
+import shutil
+import sys
+from pathlib import Path
+
+import numpy as np
+import onnx
+from onnx import TensorProto, helper, numpy_helper
+
+LOGITS_TO_KEEP_NAME = "num_logits_to_keep"
+
+# Nodos entre lm_head y la salida `logits` que no mezclan posiciones.
+PASSTHROUGH_OPS = {"Cast", "Identity"}
+LM_HEAD_OPS = {"MatMul", "MatMulNBits", "FusedMatMul"}
+
+
+def find_lm_head(graph: onnx.GraphProto, logits_name: str = "logits"):
+    """Devuelve (nodo lm_head, tensores intermedios hasta `logits`)."""
+    producers = {output: node for node in graph.node for output in node.output}
+    name = logits_name
+    chain = [name]
+    node = producers.get(name)
+    while node is not None and node.op_type in PASSTHROUGH_OPS:
+        name = node.input[0]
+        chain.append(name)
+        node = producers.get(name)
+    if node is None or node.op_type not in LM_HEAD_OPS:
+        found = node.op_type if node is not None else "input"
+        raise RuntimeError(f"No se encontró lm_head antes de '{logits_name}' (encontrado: {found})")
+    return node, chain
+
+
+def add_logits_to_keep(model: onnx.ModelProto, logits_name: str = "logits") -> onnx.ModelProto:
+    """Inserta `Slice(hidden, -num_logits_to_keep:)` delante de lm_head (modifica `model`)."""
+    graph = model.graph
+    if any(i.name == LOGITS_TO_KEEP_NAME for i in graph.input):
+        raise RuntimeError(f"El modelo ya tiene la entrada '{LOGITS_TO_KEEP_NAME}'")
+
+    lm_head, chain = find_lm_head(graph, logits_name)
+    hidden = lm_head.input[0]
+    sliced = f"{hidden}_last"
+
+    graph.input.append(helper.make_tensor_value_info(LOGITS_TO_KEEP_NAME, TensorProto.INT64, []))
+    # Inicializador con el mismo nombre que la entrada = valor por defecto sobreescribible.
+    graph.initializer.extend(
+        [
+            numpy_helper.from_array(np.array(1, dtype=np.int64), LOGITS_TO_KEEP_NAME),
+            numpy_helper.from_array(np.array([1], dtype=np.int64), "logits_to_keep_shape"),
+            numpy_helper.from_array(np.array([np.iinfo(np.int64).max], dtype=np.int64), "logits_to_keep_end"),
+            numpy_helper.from_array(np.array([1], dtype=np.int64), "logits_to_keep_axis"),
+        ]
+    )
+    nodes = [
+        helper.make_node(
+            "Reshape", [LOGITS_TO_KEEP_NAME, "logits_to_keep_shape"], ["logits_to_keep_1d"], name="LogitsToKeep/Reshape"
+        ),
+        helper.make_node("Neg", ["logits_to_keep_1d"], ["logits_to_keep_start"], name="LogitsToKeep/Neg"),
+        helper.make_node(
+            "Slice",
+            [hidden, "logits_to_keep_start", "logits_to_keep_end", "logits_to_keep_axis"],
+            [sliced],
+            name="LogitsToKeep/Slice",
+        ),
+    ]
+    index = list(graph.node).index(lm_head)
+    for offset, node in enumerate(nodes):
+        graph.node.insert(index + offset, node)
+    lm_head.input[0] = sliced
+
+    # Las formas intermedias guardadas llevan la dimensión de secuencia completa.
+    stale = set(chain[1:])
+    kept = [info for info in graph.value_info if info.name not in stale]
+    del graph.value_info[:]
+    graph.value_info.extend(kept)
+    for output in graph.output:
+        if output.name == logits_name:
+            dims = output.type.tensor_type.shape.dim
+            if len(dims) == 3:
+                dims[1].Clear()
+                dims[1].dim_param = LOGITS_TO_KEEP_NAME
+    return model
+
+
+def external_data_files(model: onnx.ModelProto) -> set:
+    files = set()
+    for tensor in model.graph.initializer:
+        if tensor.data_location == TensorProto.EXTERNAL:
+            files.update(entry.value for entry in tensor.external_data if entry.key == "location")
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reescribe un modelo ONNX para devolver solo los últimos logits")
+    parser.add_argument("--model", required=True, help="Modelo ONNX de entrada (decoder con KV cache)")
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Modelo de salida (por defecto: <modelo>_last_logits.onnx en el mismo directorio)",
+    )
+    parser.add_argument("--logits-name", default="logits", help="Nombre de la salida de logits")
+    args = parser.parse_args()
+
+    model_path = Path(args.model)
+    if not model_path.exists():
+        print(f"ERROR: Modelo no encontrado en {model_path}")
+        sys.exit(1)
+    output_path = Path(args.output) if args.output else model_path.with_name(f"{model_path.stem}_last_logits.onnx")
+
+    print(f"Cargando grafo (sin pesos externos): {model_path}")
+    model = onnx.load(str(model_path), load_external_data=False)
+    add_logits_to_keep(model, args.logits_name)
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    if output_path.parent.resolve() != model_path.parent.resolve():
+        for name in sorted(external_data_files(model)):
+            print(f"Copiando datos externos: {name}")
+            shutil.copy2(model_path.parent / name, output_path.parent / name)
+
+    onnx.save(model, str(output_path))
+    print(f"✓ Modelo guardado: {output_path}")
+    print(f"  Entrada nueva: {LOGITS_TO_KEEP_NAME} (int64, por defecto 1)")
+
+
+if __name__ == "__main__":
+    main()
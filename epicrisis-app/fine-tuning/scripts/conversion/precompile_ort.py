@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Precompilar modelos ONNX para arranque en frío rápido (ONNX Runtime CPU).
+
+Cada arranque de un .onnx + .onnx_data parsea el protobuf, aplica las
+transformaciones de grafo y "prepackea" cada peso de MatMul. Este script hace
+ese trabajo una sola vez y guarda el resultado junto al modelo:
+
+  model.opt.onnx (+ .data)  grafo ya optimizado con los pesos prepackeados
+                            guardados como datos externos
+                            (session.save_external_prepacked_constant_initializers).
+                            ORT mapea los datos externos en memoria (mmap) al cargar.
+  model.ort                 formato ORT (flatbuffer). Los inicializadores se usan
+                            directamente desde el buffer del archivo, sin copia.
+                            Límite de 2 GB: sirve para int4, no para fp32 1.5B.
+
+Ambos se generan con SimplifiedLayerNormFusion desactivado (falla en el grafo
+Qwen2 exportado). inference/ort_session.py los reconoce por la extensión y
+los carga sin volver a optimizar.
+
+Uso:
+  python precompile_ort.py --model onnx/model_int4.onnx
+  python precompile_ort.py --benchmark \\
+      fp32=onnx/model.onnx fp16=onnx/model_fp16.onnx int4=onnx/model_int4.onnx
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import onnxruntime as ort
+
+# Niveles, optimizadores desactivados y umbral de datos externos compartidos con la inferencia
+sys.path.append(str(Path(__file__).resolve().parents[1] / "inference"))
+from ort_session import DISABLED_OPTIMIZERS, EXTERNAL_MIN_BYTES, OPT_LEVELS  # noqa: E402
+from shared_weights import peak_rss_mb  # noqa: E402
+
+# Precompilar sin optimizar no tiene sentido: solo basic / extended / all
+PRECOMPILE_LEVELS = [level for level in OPT_LEVELS if level != "disable"]
+ORT_FORMAT_MAX_BYTES = 2**31 - 1
+FORMATS = ("prepacked", "ort")
+
+ONNX_TYPES = {
+    "tensor(float)": np.float32,
+    "tensor(float16)": np.float16,
+    "tensor(int64)": np.int64,
+    "tensor(int32)": np.int32,
+}
+
+
+def precompiled_paths(model_path: Path) -> dict:
+    model_path = Path(model_path)
+    return {
+        "prepacked": model_path.with_name(model_path.stem + ".opt.onnx"),
+        "ort": model_path.with_suffix(".ort"),
+    }
+
+
+def model_bytes(model_path: Path) -> int:
+    """Tamaño del .onnx más sus archivos de datos externos."""
+    model_path = Path(model_path)
+    return sum(p.stat().st_size for p in model_path.parent.glob(model_path.name + "*"))
+
+
+def _compile(model_path: Path, so: ort.SessionOptions, output_path: Path) -> Path:
+    so.optimized_model_filepath = str(output_path)
+    ort.InferenceSession(
+        str(model_path),
+        sess_options=so,
+        providers=["CPUExecutionProvider"],
+        disabled_optimizers=list(DISABLED_OPTIMIZERS),
+    )
+    return output_path
+
+
+def compile_prepacked(model_path: Path, output_path: Path, opt_level: str = "extended") -> Path:
+    so = ort.SessionOptions()
+    so.graph_optimization_level = OPT_LEVELS[opt_level]
+    so.add_session_config_entry("session.optimized_model_external_initializers_file_name", output_path.name + ".data")
+    so.add_session_config_entry(
+        "session.optimized_model_external_initializers_min_size_in_bytes", str(EXTERNAL_MIN_BYTES)
+    )
+    so.add_session_config_entry("session.save_external_prepacked_constant_initializers", "1")
+    return _compile(model_path, so, output_path)
+
+
+def compile_ort_format(model_path: Path, output_path: Path, opt_level: str = "extended") -> Path:
+    size = model_bytes(model_path)
+    if size > ORT_FORMAT_MAX_BYTES:
+        raise ValueError(f"{model_path.name} pesa {size / 2**30:.1f} GB; el formato ORT admite hasta 2 GB")
+    so = ort.SessionOptions()
+    so.graph_optimization_level = OPT_LEVELS[opt_level]
+    so.add_session_config_entry("session.save_model_format", "ORT")
+    return _compile(model_path, so, output_path)
+
+
+def precompile(model_path, formats=FORMATS, opt_level: str = "extended") -> dict:
+    """Genera los formatos pedidos junto al modelo; devuelve {formato: ruta} de los generados."""
+    model_path = Path(model_path)
+    targets = precompiled_paths(model_path)
+    compilers = {"prepacked": compile_prepacked, "ort": compile_ort_format}
+    outputs = {}
+    for fmt in formats:
+        start = time.perf_counter()
+        try:
+            outputs[fmt] = compilers[fmt](model_path, targets[fmt], opt_level)
+        except ValueError as exc:
+            print(f"⚠️  {fmt}: {exc}, se omite")
+            continue
+        print(f"✓ {fmt}: {outputs[fmt]} ({model_bytes(outputs[fmt]) / 2**20:.0f} MB, {time.perf_counter() - start:.1f}s)")
+    return outputs
+
+
+def _probe_feeds(sess: ort.InferenceSession) -> dict:
+    """Un token de entrada con KV vacío (I/O estilo optimum / ORT GenAI)."""
+    feeds = {}
+    for inp in sess.get_inputs():
+        dtype = ONNX_TYPES.get(inp.type, np.float32)
+        if inp.name.startswith("past_key_values"):
+            heads, head_dim = inp.shape[1], inp.shape[3]
+            feeds[inp.name] = np.zeros((1, heads, 0, head_dim), dtype=dtype)
+        else:
+            feeds[inp.name] = np.ones((1, 1), dtype=dtype) if inp.name != "position_ids" else np.zeros((1, 1), dtype)
+    return feeds
+
+
+def time_to_ready(model_path: Path, opt_level: str = "extended") -> dict:
+    """Crear sesión + primera inferencia, en este proceso (usar un proceso nuevo por medición)."""
+    model_path = Path(model_path)
+    so = ort.SessionOptions()
+    precompiled = model_path.suffix == ".ort" or model_path.name.endswith(".opt.onnx")
+    so.graph_optimization_level = (
+        ort.GraphOptimizationLevel.ORT_DISABLE_ALL if precompiled else OPT_LEVELS[opt_level]
+    )
+    if model_path.suffix == ".ort":
+        so.add_session_config_entry("session.use_ort_model_bytes_directly", "1")
+        so.add_session_config_entry("session.use_ort_model_bytes_for_initializers", "1")
+    start = time.perf_counter()
+    sess = ort.InferenceSession(
+        str(model_path),
+        sess_options=so,
+        providers=["CPUExecutionProvider"],
+        disabled_optimizers=[] if precompiled else list(DISABLED_OPTIMIZERS),
+    )
+    load_s = time.perf_counter() - start
+    sess.run(None, _probe_feeds(sess))
+    ready_s = time.perf_counter() - start
+    return {
+        "load_s": load_s,
+        "first_run_s": ready_s - load_s,
+        "ready_s": ready_s,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def benchmark(variants: dict, opt_level: str = "extended") -> list:
+    """Time-to-ready de cada variante y formato, cada uno en un proceso nuevo."""
+    rows = []
+    for name, model_path in variants.items():
+        model_path = Path(model_path)
+        candidates = {"onnx": model_path}
+        candidates.update({fmt: p for fmt, p in precompiled_paths(model_path).items() if p.exists()})
+        for fmt, path in candidates.items():
+            result = subprocess.run(
+                [sys.executable, __file__, "--probe", str(path), "--opt-level", opt_level],
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+            row = {"variant": name, "format": fmt, "mb": model_bytes(path) / 2**20}
+            row.update(json.loads(result.stdout.strip().splitlines()[-1]))
+            rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompilar modelos ONNX (formato ORT / pesos prepackeados)")
+    parser.add_argument("--model", action="append", default=[], help="Modelo .onnx a precompilar (repetible)")
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=list(FORMATS))
+    parser.add_argument("--opt-level", choices=PRECOMPILE_LEVELS, default="extended")
+    parser.add_argument(
+        "--benchmark",
+        nargs="+",
+        metavar="NOMBRE=RUTA",
+        help="Medir time-to-ready de cada variante (onnx original y precompilados existentes)",
+    )
+    parser.add_argument("--probe", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.probe:
+        print(json.dumps(time_to_ready(Path(args.probe), args.opt_level)))
+        return
+
+    for model in args.model:
+        print(f"\nPrecompilando {model} (nivel {args.opt_level})...")
+        precompile(model, args.formats, args.opt_level)
+
+    if args.benchmark:
+        variants = {}
+        for spec in args.benchmark:
+            name, _, path = spec.rpartition("=")
+            variants[name or Path(path).stem] = path
+        print(f"\n{'variante':<10} {'formato':<10} {'MB':>8} {'carga s':>8} {'1a inf s':>9} {'listo s':>8} {'RSS MB':>8}")
+        for row in benchmark(variants, args.opt_level):
+            print(
+                f"{row['variant']:<10} {row['format']:<10} {row['mb']:>8.0f} {row['load_s']:>8.2f} "
+                f"{row['first_run_s']:>9.3f} {row['ready_s']:>8.2f} {row['peak_rss_mb']:>8.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
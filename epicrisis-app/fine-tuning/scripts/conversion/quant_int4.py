@@ -1,8 +1,12 @@
 from pathlib import Path
 from onnxruntime.quantization import matmul_4bits_quantizer, quant_utils
 
+from precompile_ort import precompile
+
 INPUT = Path("onnx/model.onnx")
 OUTPUT = Path("onnx/model_int4.onnx")
+# Formatos precompilados para arranque en frío (ver precompile_ort.py); () para omitir.
+PRECOMPILE = ("prepacked", "ort")
 
 model = quant_utils.load_model_with_shape_infer(INPUT)
 
@@ -20,3 +24,6 @@ quant.process()
 
 quant.model.save_model_to_file(OUTPUT, use_external_data_format=True)
 print("INT4 listo:", OUTPUT)
+
+if PRECOMPILE:
+    precompile(OUTPUT, PRECOMPILE)
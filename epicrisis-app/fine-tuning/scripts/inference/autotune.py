@@ -0,0 +1,244 @@
+"""
+CPU thread / affinity autotuner for ORT sessions.
+
+Sweeps, on the local machine and for one model:
+  1. single process: intra-op threads x spinning policy, then the best of those
+     with CPU pinning and with ORT_PARALLEL (2 inter-op threads)
+  2. serving layout: worker processes x threads per worker, all decoding
+     concurrently, each pinned to its own block of cores
+
+Every configuration runs in fresh processes (ORT thread pools and affinity are
+per process) on episodes from dataset_epicrisis_350_completo.jsonl and reports
+prefill tokens/s, decode tokens/s and p95 per-token decode latency.
+
+The result is written as `ort_profile.json` in the model directory:
+  session / cpus                 best single-process settings (lowest p95)
+  worker_session / worker_cpus   best layout by aggregate decode tokens/s
+create_session() applies `session` automatically; session_from_args() also
+pins to `cpus`, and multi-process runners pass their worker index to get
+`worker_session` / `worker_cpus` (see ort_session.profile_settings).
+
+Usage:
+  python3 epicrisis-app/fine-tuning/scripts/inference/autotune.py \\
+    --model epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx \\
+    --limit 4 --decode-steps 32
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from batch_generate import load_episodes
+from ort_session import (
+    BARRIER_TIMEOUT_S,
+    DEFAULT_CACHE_DIR,
+    DEFAULT_OPT_LEVEL,
+    OPT_LEVELS,
+    PROFILE_NAME,
+    allowed_cpus,
+    create_session,
+    host_info,
+    join_workers,
+    model_fingerprint,
+    pin_process,
+)
+from prompt_compiler import build_chatml_prompt, load_prompt_style
+
+
+def _run_worker(model, opt_level, cache_dir, settings, cpus, prompts, steps, barrier, results, index) -> None:
+    from onnx_engine import DecodeEngine, ModelGeometry
+
+    pin_process(cpus)
+    sess = create_session(model, opt_level, cache_dir=cache_dir, threads=settings)
+    engine = DecodeEngine(sess, max(len(p) for p in prompts) + steps, ModelGeometry.from_session(sess))
+    # Untimed warm-up so first-run allocations do not land in the measurement.
+    engine.reset(batch=1)
+    engine.prefill(np.array([prompts[0][:8]], dtype=np.int64))
+    try:
+        barrier.wait(timeout=BARRIER_TIMEOUT_S)
+    except threading.BrokenBarrierError:
+        return  # another worker failed to start; measure() reports the missing result
+
+    prefill_tokens, prefill_s, latencies = 0, 0.0, []
+    for prompt in prompts:
+        engine.reset(batch=1)
+        tick = time.perf_counter()
+        logits = engine.prefill(np.array([prompt], dtype=np.int64))
+        prefill_s += time.perf_counter() - tick
+        prefill_tokens += len(prompt)
+        for _ in range(steps):
+            tick = time.perf_counter()
+            logits = engine.forward(np.argmax(logits, axis=-1).astype(np.int64)[:, None])
+            latencies.append(time.perf_counter() - tick)
+    results[index] = {
+        "prefill_tokens": prefill_tokens,
+        "prefill_s": prefill_s,
+        "latencies": latencies,
+    }
+
+
+def measure(model, opt_level, cache_dir, settings: dict, layout, prompts, steps: int) -> dict:
+    """
+    Run one configuration: `layout` is a list of CPU lists (or None), one per worker process.
+
+    Prompts are split round-robin across workers; all workers start together.
+    """
+    ctx = mp.get_context("spawn")
+    manager = ctx.Manager()
+    barrier = ctx.Barrier(len(layout))
+    results = manager.dict()
+    workers = []
+    for index, cpus in enumerate(layout):
+        shard = prompts[index :: len(layout)] or prompts[:1]
+        args = (model, opt_level, cache_dir, settings, cpus, shard, steps, barrier, results, index)
+        workers.append(ctx.Process(target=_run_worker, args=args))
+    for worker in workers:
+        worker.start()
+    try:
+        exitcodes = join_workers(workers, barrier)
+        runs = [results[key] for key in sorted(results.keys())]
+    finally:
+        manager.shutdown()
+    if len(runs) != len(layout):
+        raise RuntimeError(
+            f"{len(layout) - len(runs)} worker(s) failed for settings {settings} (exit codes {exitcodes})"
+        )
+
+    latencies = np.concatenate([run["latencies"] for run in runs])
+    # Workers run concurrently: aggregate rates are the sum of per-worker rates.
+    return {
+        "prefill_tps": sum(r["prefill_tokens"] / max(r["prefill_s"], 1e-9) for r in runs),
+        "decode_tps": sum(len(r["latencies"]) / max(sum(r["latencies"]), 1e-9) for r in runs),
+        "p95_ms": float(np.percentile(latencies, 95) * 1000),
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+    }
+
+
+def thread_candidates(cpu_count: int) -> list:
+    candidates = {1, cpu_count, max(cpu_count // 2, 1)}
+    power = 2
+    while power < cpu_count:
+        candidates.add(power)
+        power *= 2
+    return sorted(candidates)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Autotune ORT threads/affinity and worker layout for this machine.")
+    parser.add_argument(
+        "--model",
+        default="epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx",
+        help="Path to ONNX model",
+    )
+    parser.add_argument(
+        "--tokenizer",
+        default=None,
+        help="Path to tokenizer directory (defaults to model's parent directory)",
+    )
+    parser.add_argument(
+        "--episodes",
+        default=str(Path(__file__).resolve().parents[2] / "datasets" / "dataset_epicrisis_350_completo.jsonl"),
+        help="Episodes (.jsonl with compact 'input' or .json)",
+    )
+    parser.add_argument("--limit", type=int, default=4, help="Episodes per configuration")
+    parser.add_argument("--decode-steps", type=int, default=32, help="Greedy decode steps per episode")
+    parser.add_argument("--threads", type=int, nargs="+", default=None, help="Intra-op thread counts to try")
+    parser.add_argument("--max-workers", type=int, default=None, help="Largest worker count for the layout sweep")
+    parser.add_argument("--opt-level", choices=list(OPT_LEVELS), default=DEFAULT_OPT_LEVEL)
+    parser.add_argument("--ort-cache-dir", default=str(DEFAULT_CACHE_DIR), help="Optimized-graph cache directory")
+    parser.add_argument("--output", default=None, help=f"Profile path (default: {PROFILE_NAME} in the model directory)")
+    args = parser.parse_args()
+
+    try:
+        from transformers import AutoTokenizer
+    except Exception as exc:
+        raise RuntimeError("transformers is required for the autotuner") from exc
+
+    tokenizer_dir = args.tokenizer or Path(args.model).parent.parent
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir)
+    style = load_prompt_style(args.model)
+    prompts = [
+        tokenizer.encode(build_chatml_prompt(episode, style), add_special_tokens=False)
+        for episode in load_episodes(args.episodes, args.limit)
+    ]
+    cpus = allowed_cpus()
+    cpu_count = len(cpus)
+    # Build the optimized-graph cache once, outside the timed runs.
+    create_session(args.model, args.opt_level, cache_dir=args.ort_cache_dir, threads={})
+
+    results = []
+
+    def run(stage: str, settings: dict, layout) -> dict:
+        metrics = measure(args.model, args.opt_level, args.ort_cache_dir, settings, layout, prompts, args.decode_steps)
+        entry = {"stage": stage, "settings": settings, "layout": layout, **metrics}
+        results.append(entry)
+        pinned = "pinned" if layout[0] else "unpinned"
+        print(
+            f"{stage:<8} workers={len(layout)} {json.dumps(settings)} {pinned}: "
+            f"prefill={metrics['prefill_tps']:.1f} tok/s decode={metrics['decode_tps']:.1f} tok/s "
+            f"p95={metrics['p95_ms']:.2f}ms",
+            flush=True,
+        )
+        return entry
+
+    # 1. Single process: threads x spinning, then pinning and parallel execution on the best one.
+    single = []
+    for threads in args.threads or thread_candidates(cpu_count):
+        for spinning in (True, False):
+            settings = {"intra_op_num_threads": threads, "execution_mode": "sequential", "allow_spinning": spinning}
+            single.append(run("single", settings, [None]))
+    best = min(single, key=lambda entry: entry["p95_ms"])
+    threads = best["settings"]["intra_op_num_threads"]
+    single.append(run("single", best["settings"], [cpus[:threads]]))
+    if cpu_count >= 2:
+        parallel = dict(best["settings"], execution_mode="parallel", inter_op_num_threads=2)
+        single.append(run("single", parallel, best["layout"]))
+    best = min(single, key=lambda entry: entry["p95_ms"])
+
+    # 2. Serving layout: W workers x (cpu_count // W) threads, each pinned to its own cores.
+    serving = []
+    workers = 1
+    while workers <= min(args.max_workers or cpu_count, cpu_count):
+        per_worker = cpu_count // workers
+        settings = dict(best["settings"], intra_op_num_threads=per_worker, execution_mode="sequential")
+        settings.pop("inter_op_num_threads", None)
+        layout = [cpus[index * per_worker : (index + 1) * per_worker] for index in range(workers)]
+        serving.append(run("serving", settings, layout))
+        workers *= 2
+    best_serving = max(serving, key=lambda entry: entry["decode_tps"])
+
+    profile = {
+        "host": host_info(),
+        "model": str(args.model),
+        "model_fingerprint": model_fingerprint(args.model),
+        "opt_level": args.opt_level,
+        "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "session": best["settings"],
+        "cpus": best["layout"][0],
+        "workers": len(best_serving["layout"]),
+        "worker_session": best_serving["settings"],
+        "worker_cpus": best_serving["layout"],
+        "results": results,
+    }
+    output = Path(args.output) if args.output else Path(args.model).parent / PROFILE_NAME
+    output.write_text(json.dumps(profile, indent=2), encoding="utf-8")
+    print(
+        f"\nbest single: {json.dumps(best['settings'])} cpus={profile['cpus']} "
+        f"p95={best['p95_ms']:.2f}ms decode={best['decode_tps']:.1f} tok/s"
+    )
+    print(
+        f"best serving: {profile['workers']} workers x {best_serving['settings']['intra_op_num_threads']} threads "
+        f"decode={best_serving['decode_tps']:.1f} tok/s p95={best_serving['p95_ms']:.2f}ms"
+    )
+    print(f"profile: {output}")
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,210 @@
+"""
+Batched epicrisis generation over the ONNX decode engine.
+
+N compact episode JSONs are rendered as ChatML prompts (training format, see prompt_compiler.py),
+left-padded into one batch, prefilled together and decoded together.
+Rows that hit EOS / a stop sequence / their budget are retired from the
+batch between steps, so finished episodes stop costing compute.
+
+Usage:
+  python3 epicrisis-app/fine-tuning/scripts/inference/batch_generate.py \
+    --model epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx \
+    --episodes epicrisis-app/fine-tuning/datasets/dataset_epicrisis_350_completo.jsonl \
+    --limit 8 --max-new-tokens 256 --compare-sequential
+"""
+
+import argparse
+import time
+from itertools import islice
+from pathlib import Path
+
+import numpy as np
+
+from normalize_episodes import iter_episodes
+from onnx_engine import DecodeEngine, ModelGeometry
+from ort_session import add_session_arguments, session_from_args
+from prompt_compiler import PromptCompiler, load_prompt_style
+from stopping import StopCriteria
+
+
+def load_episodes(path: Path, limit: int = None) -> list:
+    """Compact inputs from a .jsonl ({"input": {...}} or bare) or a .json list/object."""
+    return [record.get("input", record) for record in islice(iter_episodes(path), limit or None)]
+
+
+def left_pad(prompts: list, pad_token_id: int):
+    """Return (input_ids, attention_mask), both [batch, max_len], padded on the left."""
+    width = max(len(p) for p in prompts)
+    input_ids = np.full((len(prompts), width), pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(prompts), width), dtype=np.int64)
+    for row, prompt in enumerate(prompts):
+        input_ids[row, width - len(prompt) :] = prompt
+        attention_mask[row, width - len(prompt) :] = 1
+    return input_ids, attention_mask
+
+
+def generate_batch(
+    engine: DecodeEngine,
+    prompts: list,
+    stop_criteria: StopCriteria,
+    pad_token_id: int,
+    prefill_chunk: int = None,
+):
+    """
+    Greedy-decode all `prompts` (lists of token ids) as one batch.
+
+    `prefill_chunk` feeds the padded prompts that many positions per run.
+
+    Returns (outputs, stats): generated ids per prompt (stop tokens trimmed)
+    and timing counters.
+    """
+    engine.reset(batch=len(prompts))
+    input_ids, attention_mask = left_pad(prompts, pad_token_id)
+
+    start = time.perf_counter()
+    logits = engine.prefill(input_ids, attention_mask, prefill_chunk)
+    prefill_s = time.perf_counter() - start
+
+    outputs = [[] for _ in prompts]
+    matchers = [stop_criteria.matcher() for _ in prompts]
+    active = list(range(len(prompts)))
+    decode_steps = 0
+    start = time.perf_counter()
+    while True:
+        tokens = np.argmax(logits, axis=-1)
+        keep = []
+        for row, index in enumerate(active):
+            token_id = int(tokens[row])
+            outputs[index].append(token_id)
+            if not matchers[index].update(token_id):
+                keep.append(row)
+        if not keep:
+            break
+        if len(keep) < len(active):
+            engine.retain(keep)
+            tokens = tokens[keep]
+            active = [active[row] for row in keep]
+        logits = engine.forward(tokens[:, None])
+        decode_steps += 1
+    decode_s = time.perf_counter() - start
+
+    for output, matcher in zip(outputs, matchers):
+        if matcher.reason in ("eos", "stop_sequence"):
+            del output[-matcher.matched_length :]
+    stats = {
+        "batch": len(prompts),
+        "prompt_tokens": sum(len(p) for p in prompts),
+        "generated_tokens": sum(m.num_tokens for m in matchers),
+        "decode_steps": decode_steps,
+        "prefill_s": prefill_s,
+        "decode_s": decode_s,
+    }
+    return outputs, stats
+
+
+def _report(label: str, stats: list) -> float:
+    generated = sum(s["generated_tokens"] for s in stats)
+    elapsed = sum(s["prefill_s"] + s["decode_s"] for s in stats)
+    tokens_per_s = generated / elapsed if elapsed else 0.0
+    print(
+        f"[{label}] episodes={sum(s['batch'] for s in stats)} generated={generated} "
+        f"prefill={sum(s['prefill_s'] for s in stats):.2f}s decode={sum(s['decode_s'] for s in stats):.2f}s "
+        f"tokens/s={tokens_per_s:.1f}"
+    )
+    return tokens_per_s
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Batched epicrisis generation (ONNX Runtime).")
+    parser.add_argument(
+        "--model",
+        default="epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx",
+        help="Path to ONNX model",
+    )
+    parser.add_argument(
+        "--tokenizer",
+        default=None,
+        help="Path to tokenizer directory (defaults to model's parent directory)",
+    )
+    parser.add_argument(
+        "--episodes",
+        default=str(Path(__file__).resolve().parents[2] / "datasets" / "dataset_epicrisis_350_completo.jsonl"),
+        help="Episodes (.jsonl with compact 'input' or .json)",
+    )
+    parser.add_argument("--limit", type=int, default=8, help="Number of episodes to generate")
+    parser.add_argument("--batch-size", type=int, default=8, help="Episodes per batch")
+    parser.add_argument("--max-new-tokens", type=int, default=256, help="New-token budget per episode")
+    parser.add_argument(
+        "--prefill-chunk",
+        type=int,
+        default=None,
+        help="Prefill prompts in chunks of this many tokens (default: whole prompt)",
+    )
+    parser.add_argument(
+        "--compare-sequential",
+        action="store_true",
+        help="Also generate one episode at a time and compare tokens/s",
+    )
+    parser.add_argument("--print-outputs", action="store_true", help="Print generated epicrisis text")
+    parser.add_argument(
+        "--prompt-budget",
+        type=int,
+        default=None,
+        help="Max prompt tokens; longer episodes are trimmed (evo, then tto, proc; see prompt_compiler.py)",
+    )
+    add_session_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        from transformers import AutoTokenizer
+    except Exception as exc:
+        raise RuntimeError("transformers is required for batch generation") from exc
+
+    tokenizer_dir = args.tokenizer or Path(args.model).parent.parent
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+    sess = session_from_args(args, args.model)
+    geometry = ModelGeometry.from_session(sess, config_path=Path(tokenizer_dir) / "config.json")
+
+    episodes = load_episodes(args.episodes, args.limit)
+    compiler = PromptCompiler(tokenizer, load_prompt_style(args.model), budget=args.prompt_budget)
+    compiled = [compiler.compile(episode) for episode in episodes]
+    prompts = [prompt.token_ids for prompt in compiled]
+    if args.prompt_budget:
+        print(f"prompt budget {args.prompt_budget}: {sum(bool(p.trimmed) for p in compiled)}/{len(compiled)} trimmed")
+    stop_criteria = StopCriteria.from_tokenizer(tokenizer, max_new_tokens=args.max_new_tokens)
+    max_length = max(len(p) for p in prompts) + args.max_new_tokens
+
+    engine = DecodeEngine(sess, max_length=max_length, geometry=geometry, batch=min(args.batch_size, len(prompts)))
+    print(f"geometry: {geometry} kv_cache={engine.cache.nbytes / 2**20:.1f} MB")
+
+    outputs, batched_stats = [], []
+    for offset in range(0, len(prompts), args.batch_size):
+        batch_outputs, stats = generate_batch(
+            engine, prompts[offset : offset + args.batch_size], stop_criteria, pad_token_id, args.prefill_chunk
+        )
+        outputs.extend(batch_outputs)
+        batched_stats.append(stats)
+    batched_tps = _report("batched", batched_stats)
+
+    if args.print_outputs:
+        for index, output in enumerate(outputs):
+            print(f"\n[{index}] {tokenizer.decode(output, skip_special_tokens=True)}")
+
+    if args.compare_sequential:
+        single = DecodeEngine(sess, max_length=max_length, geometry=geometry, batch=1)
+        sequential_stats = []
+        for prompt in prompts:
+            _, stats = generate_batch(single, [prompt], stop_criteria, pad_token_id, args.prefill_chunk)
+            sequential_stats.append(stats)
+        sequential_tps = _report("sequential", sequential_stats)
+        if sequential_tps:
+            print(f"speedup: {batched_tps / sequential_tps:.2f}x")
+
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,364 @@
+"""
+End-to-end latency / throughput benchmark across model variants.
+
+Each variant runs in a fresh process so load time and peak RSS are its own.
+The corpus is fixed: the first --limit episodes of
+dataset_epicrisis_350_completo.jsonl. After --warmup untimed generations,
+the corpus is replayed --repeats times with greedy decoding. Measured per
+variant:
+  load_s            model + tokenizer load (session creation)
+  tokenize_ms       prompt encoding
+  ttft_ms           prompt submitted -> first generated token (prefill + first step)
+  token_ms          per-token decode latency after the first token (p50 / p95 / p99)
+  decode_tps        decode tokens/s (tokens after the first / decode time)
+  e2e_tps           generated tokens / total generation time (prefill included)
+  peak_rss_mb       peak resident memory of the variant's process
+  kv_mb             KV cache of the longest sequence (layers x 2 x kv_heads x head_dim x dtype)
+  kv_alloc_mb       KV memory actually allocated (max_length-sized when the buffer is preallocated)
+
+A variant is NAME=PATH:
+  directory with genai_config.json   ORT GenAI (og.Generator)
+  .onnx / .ort file                  DecodeEngine (IOBinding KV cache, session from ort_session.py;
+                                     tokenizer in the model's parent directory)
+Both use the ChatML prompt of prompt_compiler.py.
+
+Results are written as JSON (every run plus the aggregates per variant) and
+printed as a summary table. --ignore-eos makes every run generate exactly
+--max-new-tokens, so tokens/s compare the same amount of work across
+quantizations.
+
+Usage:
+  python3 epicrisis-app/fine-tuning/scripts/inference/benchmark.py \\
+    --variants fp32=app/public/models/onnx-cpu-fp32 fp16=app/public/models/onnx-cpu-fp16 \\
+               int4=app/public/models/onnx-cpu-int4-qmix \\
+    --limit 8 --repeats 2 --warmup 1 --max-new-tokens 128 --ignore-eos
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from ort_session import add_session_arguments, host_info, percentile, session_from_args
+from shared_weights import peak_rss_mb
+
+DEFAULT_MODELS_DIR = Path(__file__).resolve().parent / "app" / "public" / "models"
+DEFAULT_VARIANTS = {
+    "fp32": DEFAULT_MODELS_DIR / "onnx-cpu-fp32",
+    "fp16": DEFAULT_MODELS_DIR / "onnx-cpu-fp16",
+    "int4": DEFAULT_MODELS_DIR / "onnx-cpu-int4-qmix",
+}
+ONNX_ELEM_DTYPES = {1: np.float32, 10: np.float16, 16: np.uint16}  # uint16 stands in for bfloat16 (2 bytes)
+
+
+def detect_backend(path: Path) -> str:
+    path = Path(path)
+    if path.is_dir() and (path / "genai_config.json").exists():
+        return "genai"
+    if path.is_file() and path.suffix in (".onnx", ".ort"):
+        return "ort"
+    raise ValueError(f"{path}: expected an ORT GenAI model directory or an .onnx/.ort file")
+
+
+def model_size_mb(path: Path) -> float:
+    path = Path(path)
+    files = path.rglob("*") if path.is_dir() else path.parent.glob(path.name + "*")
+    return sum(f.stat().st_size for f in files if f.is_file()) / 2**20
+
+
+def _genai_kv_bytes_per_token(model_dir: Path) -> int:
+    """From genai_config.json geometry and the decoder's past_key_values dtype (graph only, no weights)."""
+    import onnx
+
+    decoder = json.loads((model_dir / "genai_config.json").read_text(encoding="utf-8"))["model"]["decoder"]
+    graph = onnx.load(str(model_dir / decoder["filename"]), load_external_data=False).graph
+    past = next((i for i in graph.input if i.name.startswith("past_key_values")), None)
+    elem_type = past.type.tensor_type.elem_type if past is not None else 1
+    itemsize = np.dtype(ONNX_ELEM_DTYPES.get(elem_type, np.float32)).itemsize
+    return 2 * decoder["num_hidden_layers"] * decoder["num_key_value_heads"] * decoder["head_size"] * itemsize
+
+
+class GenAIRunner:
+    """og.Model / og.Tokenizer, greedy search."""
+
+    def __init__(self, model_dir: Path, args):
+        import onnxruntime_genai as og
+        from prompt_compiler import load_prompt_style
+        from run_epicrisis_onnx import build_prompt, load_model
+
+        self.og = og
+        self.build_prompt = build_prompt
+        self.args = args
+        model_dir = Path(model_dir)
+        self.style = load_prompt_style(model_dir)
+        self.model = load_model(model_dir, args.ort_profile)
+        self.tokenizer = og.Tokenizer(self.model)
+        self.kv_bytes_per_token = _genai_kv_bytes_per_token(model_dir)
+        config = json.loads((model_dir / "genai_config.json").read_text(encoding="utf-8"))
+        self.preallocated = config.get("search", {}).get("past_present_share_buffer", False)
+
+    def run(self, payload: dict) -> dict:
+        prompt = self.build_prompt(payload, style=self.style)
+        start = time.perf_counter()
+        tokens = self.tokenizer.encode(prompt)
+        tokenize_s = time.perf_counter() - start
+
+        max_length = len(tokens) + self.args.max_new_tokens
+        params = self.og.GeneratorParams(self.model)
+        options = {"max_length": max_length, "do_sample": False}
+        if self.args.ignore_eos:
+            options["min_length"] = max_length
+        params.set_search_options(**options)
+        generator = self.og.Generator(self.model, params)
+        latencies = []
+        start = time.perf_counter()
+        generator.append_tokens(tokens)
+        while not generator.is_done():
+            tick = time.perf_counter()
+            generator.generate_next_token()
+            latencies.append(time.perf_counter() - tick)
+        total_s = time.perf_counter() - start
+        sequence_length = len(generator.get_sequence(0))
+        return {
+            "prompt_tokens": len(tokens),
+            "generated": sequence_length - len(tokens),
+            "tokenize_s": tokenize_s,
+            # append_tokens runs the prefill; the first generate_next_token yields the first token.
+            "ttft_s": total_s - sum(latencies[1:]),
+            "token_s": latencies[1:],
+            "total_s": total_s,
+            "kv_bytes": self.kv_bytes_per_token * sequence_length,
+            "kv_alloc_bytes": self.kv_bytes_per_token * (max_length if self.preallocated else sequence_length),
+        }
+
+
+class EngineRunner:
+    """DecodeEngine over an ORT session, greedy argmax."""
+
+    def __init__(self, model_path: Path, args):
+        from transformers import AutoTokenizer
+
+        from onnx_engine import DecodeEngine, ModelGeometry
+        from prompt_compiler import build_chatml_prompt, load_prompt_style
+        from stopping import StopCriteria
+
+        self.build_prompt = build_chatml_prompt
+        self.args = args
+        model_path = Path(model_path)
+        self.style = load_prompt_style(model_path)
+        tokenizer_dir = Path(args.tokenizer or model_path.parent.parent)
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir)
+        sess = session_from_args(args, model_path)
+        geometry = ModelGeometry.from_session(sess, config_path=tokenizer_dir / "config.json")
+        self.engine = DecodeEngine(sess, args.max_length, geometry)
+        self.kv_bytes_per_token = geometry.kv_bytes_per_token
+        if args.ignore_eos:
+            self.stop_criteria = StopCriteria(max_new_tokens=args.max_new_tokens)
+        else:
+            self.stop_criteria = StopCriteria.from_tokenizer(self.tokenizer, max_new_tokens=args.max_new_tokens)
+
+    def run(self, payload: dict) -> dict:
+        prompt = self.build_prompt(payload, self.style)
+        start = time.perf_counter()
+        tokens = self.tokenizer.encode(prompt, add_special_tokens=False)
+        tokenize_s = time.perf_counter() - start
+        if len(tokens) + self.args.max_new_tokens > self.args.max_length:
+            raise ValueError(f"Prompt of {len(tokens)} tokens + {self.args.max_new_tokens} exceeds --max-length")
+
+        stop = self.stop_criteria.matcher()
+        latencies = []
+        start = time.perf_counter()
+        self.engine.reset(batch=1)
+        logits = self.engine.prefill(np.array([tokens], dtype=np.int64), chunk_size=self.args.prefill_chunk)
+        token_id = int(np.argmax(logits[0]))
+        ttft_s = time.perf_counter() - start
+        while not stop.update(token_id):
+            tick = time.perf_counter()
+            logits = self.engine.forward(np.array([[token_id]], dtype=np.int64))
+            token_id = int(np.argmax(logits[0]))
+            latencies.append(time.perf_counter() - tick)
+        total_s = time.perf_counter() - start
+        return {
+            "prompt_tokens": len(tokens),
+            "generated": stop.num_tokens,
+            "tokenize_s": tokenize_s,
+            "ttft_s": ttft_s,
+            "token_s": latencies,
+            "total_s": total_s,
+            "kv_bytes": self.kv_bytes_per_token * self.engine.cache.length,
+            "kv_alloc_bytes": self.engine.cache.nbytes,
+        }
+
+
+RUNNERS = {"genai": GenAIRunner, "ort": EngineRunner}
+
+
+def bench_variant(path: Path, args) -> dict:
+    """Load, warm up and replay the corpus in this process; return aggregates plus per-run records."""
+    from batch_generate import load_episodes
+
+    episodes = load_episodes(args.episodes, args.limit)
+    backend = detect_backend(path)
+    start = time.perf_counter()
+    runner = RUNNERS[backend](path, args)
+    load_s = time.perf_counter() - start
+    rss_loaded_mb = peak_rss_mb()
+    for index in range(args.warmup):
+        runner.run(episodes[index % len(episodes)])
+
+    runs, token_s = [], []
+    for repeat in range(args.repeats):
+        for index, payload in enumerate(episodes):
+            record = runner.run(payload)
+            token_s.extend(record.pop("token_s"))
+            runs.append(
+                {
+                    "repeat": repeat,
+                    "episode": index,
+                    **{key: value for key, value in record.items() if not key.endswith("_s")},
+                    **{key[:-2] + "_ms": value * 1000 for key, value in record.items() if key.endswith("_s")},
+                }
+            )
+
+    decode_tokens = sum(run["generated"] - 1 for run in runs if run["generated"] > 0)
+    token_ms = np.array(token_s) * 1000
+    return {
+        "backend": backend,
+        "path": str(path),
+        "size_mb": model_size_mb(path),
+        "load_s": load_s,
+        "rss_after_load_mb": rss_loaded_mb,
+        "peak_rss_mb": peak_rss_mb(),
+        "tokenize_ms_p50": percentile([r["tokenize_ms"] for r in runs], 50),
+        "ttft_ms_p50": percentile([r["ttft_ms"] for r in runs], 50),
+        "ttft_ms_p95": percentile([r["ttft_ms"] for r in runs], 95),
+        "token_ms_p50": percentile(token_ms, 50),
+        "token_ms_p95": percentile(token_ms, 95),
+        "token_ms_p99": percentile(token_ms, 99),
+        "decode_tps": decode_tokens / max(float(np.sum(token_s)), 1e-9),
+        "e2e_tps": sum(r["generated"] for r in runs) / max(sum(r["total_ms"] for r in runs) / 1000, 1e-9),
+        "prompt_tokens_mean": float(np.mean([r["prompt_tokens"] for r in runs])),
+        "generated_mean": float(np.mean([r["generated"] for r in runs])),
+        "kv_mb": max(r["kv_bytes"] for r in runs) / 2**20,
+        "kv_alloc_mb": max(r["kv_alloc_bytes"] for r in runs) / 2**20,
+        "runs": runs,
+    }
+
+
+def print_table(results: dict) -> None:
+    header = (
+        f"{'variant':<10} {'backend':<6} {'MB':>7} {'load s':>7} {'tok ms':>7} {'TTFT ms':>8} "
+        f"{'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'tok/s':>7} {'e2e/s':>7} {'RSS MB':>7} {'KV MB':>7}"
+    )
+    print(header)
+    print("-" * len(header))
+    for name, row in results.items():
+        if "error" in row:
+            print(f"{name:<10} ERROR: {row['error']}")
+            continue
+        print(
+            f"{name:<10} {row['backend']:<6} {row['size_mb']:>7.0f} {row['load_s']:>7.2f} "
+            f"{row['tokenize_ms_p50']:>7.2f} {row['ttft_ms_p50']:>8.1f} {row['token_ms_p50']:>7.2f} "
+            f"{row['token_ms_p95']:>7.2f} {row['token_ms_p99']:>7.2f} {row['decode_tps']:>7.1f} "
+            f"{row['e2e_tps']:>7.1f} {row['peak_rss_mb']:>7.0f} {row['kv_mb']:>7.1f}"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Latency/throughput benchmark across model variants.")
+    parser.add_argument(
+        "--variants",
+        nargs="+",
+        metavar="NAME=PATH",
+        default=None,
+        help="ORT GenAI model directories or .onnx files (default: the fp32/fp16/int4 CPU exports that exist)",
+    )
+    parser.add_argument(
+        "--tokenizer",
+        default=None,
+        help="Tokenizer directory for .onnx variants (defaults to the model's parent directory)",
+    )
+    parser.add_argument(
+        "--episodes",
+        default=str(Path(__file__).resolve().parents[2] / "datasets" / "dataset_epicrisis_350_completo.jsonl"),
+        help="Episodes (.jsonl with compact 'input' or .json)",
+    )
+    parser.add_argument("--limit", type=int, default=8, help="Episodes in the corpus (first N)")
+    parser.add_argument("--repeats", type=int, default=1, help="Timed passes over the corpus")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed generations before timing")
+    parser.add_argument("--max-new-tokens", type=int, default=128, help="New-token budget per episode")
+    parser.add_argument("--ignore-eos", action="store_true", help="Always generate --max-new-tokens tokens")
+    parser.add_argument("--max-length", type=int, default=4096, help="KV cache length for .onnx variants")
+    parser.add_argument("--prefill-chunk", type=int, default=None, help="Prefill chunk size for .onnx variants")
+    parser.add_argument(
+        "--output",
+        default=str(Path(__file__).resolve().parent / "outputs" / "benchmark.json"),
+        help="JSON results path",
+    )
+    add_session_arguments(parser)
+    parser.add_argument("--probe", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.probe:
+        print(json.dumps(bench_variant(Path(args.probe), args)))
+        return 0
+
+    if args.variants:
+        variants = {}
+        for spec in args.variants:
+            name, _, path = spec.rpartition("=")
+            variants[name or Path(path).stem] = Path(path)
+    else:
+        variants = {name: path for name, path in DEFAULT_VARIANTS.items() if path.exists()}
+        if not variants:
+            parser.error(f"No model variants found under {DEFAULT_MODELS_DIR}; pass --variants NAME=PATH")
+
+    # Re-run this script per variant with the same options; the probe prints its result as the last line.
+    forwarded = list(sys.argv[1:])
+    if "--variants" in forwarded:
+        start = forwarded.index("--variants")
+        end = start + 1
+        while end < len(forwarded) and not forwarded[end].startswith("--"):
+            end += 1
+        del forwarded[start:end]
+
+    results = {}
+    for name, path in variants.items():
+        print(f"[{name}] {path}", flush=True)
+        proc = subprocess.run(
+            [sys.executable, str(Path(__file__).resolve()), *forwarded, "--probe", str(path)],
+            capture_output=True,
+            text=True,
+        )
+        if proc.returncode != 0:
+            error = (proc.stderr.strip().splitlines() or [f"exit code {proc.returncode}"])[-1]
+            print(f"[{name}] ERROR: {error}")
+            results[name] = {"path": str(path), "error": error}
+            continue
+        results[name] = json.loads(proc.stdout.strip().splitlines()[-1])
+
+    report = {
+        "host": host_info(),
+        "corpus": {"episodes": args.episodes, "limit": args.limit, "repeats": args.repeats, "warmup": args.warmup},
+        "max_new_tokens": args.max_new_tokens,
+        "ignore_eos": args.ignore_eos,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "variants": results,
+    }
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+    print()
+    print_table(results)
+    print(f"\nresults: {output}")
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
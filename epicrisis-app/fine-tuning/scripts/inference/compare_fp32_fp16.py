@@ -4,40 +4,21 @@ from pathlib import Path
 
 import onnxruntime_genai as og
 
-
-def build_prompt(payload: dict) -> str:
-    json_str = json.dumps(payload, ensure_ascii=False)
-    return (
-        "Genera la epicrisis en un solo parrafo, sin bullets.\n"
-        "Usa SOLO los datos del JSON, no inventes.\n\n"
-        "Epicrisis:\n"
-        f"{json_str}\n\n"
-        "Respuesta:"
-    )
+from prompt_compiler import load_prompt_style
+from run_epicrisis_onnx import build_prompt, create_generator, load_model
 
 
-def run_model(model_dir: Path, prompt: str, max_new_tokens: int, temperature: float, top_p: float) -> str:
-    model = og.Model(str(model_dir))
+def run_model(model_dir: Path, payload: dict, max_new_tokens: int, temperature: float, top_p: float) -> str:
+    model = load_model(model_dir)
     tokenizer = og.Tokenizer(model)
-    tokens = tokenizer.encode(prompt)
-    params = og.GeneratorParams(model)
-    params.set_search_options(
-        max_length=len(tokens) + max_new_tokens,
-        temperature=temperature,
-        top_p=top_p,
-        do_sample=True,
+    generator, prompt_length = create_generator(
+        model, tokenizer, build_prompt(payload, style=load_prompt_style(model_dir)), max_new_tokens, temperature, top_p
     )
-
-    generator = og.Generator(model, params)
-    generator.append_tokens(tokens)
     while not generator.is_done():
         generator.generate_next_token()
 
-    output = tokenizer.decode(generator.get_sequence(0))
-    if output.startswith(prompt):
-        output = output[len(prompt) :].lstrip()
-    if "Respuesta:" in output:
-        output = output.split("Respuesta:", 1)[1].lstrip()
+    # Sin deduplicar frases (postprocess): las repeticiones son parte de la comparación.
+    output = tokenizer.decode(generator.get_sequence(0)[prompt_length:])
     output = output.replace("<|endoftext|>", "").strip()
     output = " ".join(output.split())
     return output
@@ -90,7 +71,6 @@ def main() -> None:
 
     args = parser.parse_args()
     payload = json.loads(args.input_json)
-    prompt = build_prompt(payload)
 
     out_dir = Path(args.out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
@@ -109,7 +89,7 @@ def main() -> None:
         out_path = out_dir / out_file
         print(f"\n[{name}] Cargando modelo desde {model_dir}...")
         try:
-            text = run_model(Path(model_dir), prompt, args.max_new_tokens, args.temperature, args.top_p)
+            text = run_model(Path(model_dir), payload, args.max_new_tokens, args.temperature, args.top_p)
             out_path.write_text(text, encoding="utf-8")
             print(f"[{name}] OK -> {out_path}")
             print(f"[{name}] Respuesta:\n{text[:500]}{'...' if len(text) > 500 else ''}")
@@ -0,0 +1,381 @@
+"""
+Persistent epicrisis inference server (ORT GenAI).
+
+Each configured model directory is loaded once (og.Model + og.Tokenizer) and
+kept resident; requests reuse it instead of paying the multi-second model
+load of run_epicrisis_onnx.py on every call. Prompts and post-processing are
+the same as the CLI (build_prompt, postprocess); --prompt-budget trims long
+episodes to a token budget (prompt_compiler.py). With --cache-dir, greedy or
+seeded requests are answered from the response cache when the same input was
+already generated with the same model and settings (response_cache.py).
+
+Endpoints (JSON over HTTP, TCP or Unix socket):
+  GET  /health            loaded models, load times, request counts
+  POST /warmup            {"model"?}: short generation to fault in weights
+  POST /generate          {"input": {...} | "input_json": "...", "model"?,
+                           "max_new_tokens"?, "temperature"?, "top_p"?, "seed"?}
+  POST /generate/stream   same body; NDJSON lines {"delta": ...} then a final
+                          {"done": true, "text": <post-processed>, ...}
+  POST /generate/sse      same body; server-sent events: `data: {"delta"}`
+                          per text delta, then `event: done` with the result
+  GET  /generate/sse      same, with the body as query parameters for
+                          EventSource: ?input_json=<url-encoded JSON>&model=..
+                          &max_new_tokens=..&temperature=..&top_p=..&seed=..
+
+Generations on one model are serialized (one og.Generator at a time per
+model) so concurrent requests do not oversubscribe the CPU.
+
+Usage:
+  python3 epicrisis-app/fine-tuning/scripts/inference/epicrisis_server.py \
+    --model-dir fp16=app/public/models/onnx-cpu-fp16 --port 8765 --warmup
+
+  curl -s localhost:8765/generate -d '{"input": {"dx": ["I20.0"]}}'
+  curl -sN -G localhost:8765/generate/sse --data-urlencode 'input_json={"dx": ["I20.0"]}'
+"""
+
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import parse_qs, urlsplit
+
+import onnxruntime_genai as og
+
+from prompt_compiler import PromptCompiler, load_prompt_style
+from response_cache import DEFAULT_MAX_BYTES, ResponseCache, model_dir_fingerprint, response_key
+from run_epicrisis_onnx import build_prompt, create_generator, load_model, postprocess
+
+WARMUP_PAYLOAD = {"dx": ["I20.0"], "proc": ["K492"]}
+QUERY_OPTIONS = {"max_new_tokens": int, "temperature": float, "top_p": float, "seed": int}
+
+
+class ModelHandle:
+    """One resident ORT GenAI model and its tokenizer."""
+
+    def __init__(
+        self,
+        name: str,
+        model_dir: str,
+        prompt_budget: int = None,
+        cache: ResponseCache = None,
+        ort_profile: str = "auto",
+    ):
+        self.name = name
+        self.model_dir = model_dir
+        self.prompt_budget = prompt_budget
+        self.style = load_prompt_style(model_dir)
+        self.cache = cache
+        self.fingerprint = model_dir_fingerprint(model_dir) if cache is not None else None
+        start = time.perf_counter()
+        self.model = load_model(model_dir, ort_profile)
+        self.tokenizer = og.Tokenizer(self.model)
+        self.load_s = time.perf_counter() - start
+        self.compiler = PromptCompiler(self.tokenizer, self.style, budget=prompt_budget) if prompt_budget else None
+        self.requests = 0
+        self.warm = False
+        self._lock = threading.Lock()
+
+    def stream(
+        self, payload: dict, max_new_tokens: int = 200, temperature: float = 0.2, top_p: float = 0.8, seed: int = None
+    ):
+        """Yield raw text deltas, then a final dict with the post-processed text and timings."""
+        key = None
+        if self.cache is not None:
+            sampling = {
+                "max_new_tokens": max_new_tokens,
+                "temperature": temperature,
+                "top_p": top_p,
+                "do_sample": True,
+                "seed": seed,
+            }
+            key = response_key(payload, self.fingerprint, sampling, self.style, prompt_budget=self.prompt_budget)
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.requests += 1
+                yield cached["text"]
+                yield {"model": self.name, **cached, "cached": True}
+                return
+        compiled = self.compiler.compile(payload) if self.compiler else None
+        prompt = compiled.text if compiled else build_prompt(payload, style=self.style)
+        with self._lock:
+            self.requests += 1
+            start = time.perf_counter()
+            generator, prompt_length = create_generator(
+                self.model, self.tokenizer, prompt, max_new_tokens, temperature, top_p, seed
+            )
+            decoder = self.tokenizer.create_stream()
+            first_token_s = None
+            generated = 0
+            while not generator.is_done():
+                generator.generate_next_token()
+                generated += 1
+                if first_token_s is None:
+                    first_token_s = time.perf_counter() - start
+                delta = decoder.decode(generator.get_next_tokens()[0])
+                if delta:
+                    yield delta
+            output = self.tokenizer.decode(generator.get_sequence(0)[prompt_length:])
+            elapsed = time.perf_counter() - start
+        result = {
+            "text": postprocess(output),
+            "prompt_tokens": prompt_length,
+            "trimmed": compiled.trimmed if compiled else {},
+            "generated_tokens": generated,
+        }
+        if self.cache is not None:
+            self.cache.put(key, result)
+        yield {"model": self.name, **result, "ttft_s": first_token_s, "elapsed_s": elapsed, "cached": False}
+
+    def generate(self, payload: dict, **options) -> dict:
+        for item in self.stream(payload, **options):
+            if isinstance(item, dict):
+                return item
+        raise RuntimeError("Generation produced no result")
+
+    def warmup(self) -> dict:
+        result = self.generate(WARMUP_PAYLOAD, max_new_tokens=8)
+        self.warm = True
+        return result
+
+    def info(self) -> dict:
+        return {
+            "model_dir": self.model_dir,
+            "prompt_style": self.style,
+            "load_s": round(self.load_s, 3),
+            "requests": self.requests,
+            "warm": self.warm,
+        }
+
+
+def _parse_request(body: dict) -> tuple:
+    if "input" in body:
+        payload = body["input"]
+    elif "input_json" in body:
+        payload = json.loads(body["input_json"])
+    else:
+        raise ValueError("Missing 'input' (object) or 'input_json' (string)")
+    options = {key: body[key] for key in QUERY_OPTIONS if key in body}
+    return payload, options
+
+
+def _query_body(query: str) -> dict:
+    """Request body from a query string (GET /generate/sse, for EventSource clients)."""
+    body = {key: values[-1] for key, values in parse_qs(query).items()}
+    for key, cast in QUERY_OPTIONS.items():
+        if key in body:
+            try:
+                body[key] = cast(body[key])
+            except ValueError:
+                raise ValueError(f"Invalid '{key}': {body[key]!r}") from None
+    return body
+
+
+class EpicrisisRequestHandler(BaseHTTPRequestHandler):
+    server_version = "EpicrisisONNX/1.0"
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def models(self) -> dict:
+        return self.server.models
+
+    def address_string(self) -> str:
+        # Unix-socket clients have no (host, port) address.
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def _send_json(self, status: int, data: dict) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _model(self, body: dict) -> ModelHandle:
+        name = body.get("model") or self.server.default_model
+        if name not in self.models:
+            raise ValueError(f"Unknown model '{name}' (available: {', '.join(self.models)})")
+        return self.models[name]
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        if url.path == "/generate/sse":
+            try:
+                body = _query_body(url.query)
+                handle = self._model(body)
+                payload, options = _parse_request(body)
+            except ValueError as exc:
+                self._send_json(400, {"error": str(exc)})
+                return
+            self._sse(handle.stream(payload, **options))
+            return
+        if url.path != "/health":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        self._send_json(
+            200,
+            {
+                "status": "ok",
+                "uptime_s": round(time.time() - self.server.started_at, 1),
+                "default_model": self.server.default_model,
+                "models": {name: handle.info() for name, handle in self.models.items()},
+                "cache": self.server.cache.stats() if self.server.cache is not None else None,
+            },
+        )
+
+    def do_POST(self) -> None:
+        try:
+            body = self._read_json()
+            handle = self._model(body)
+            if self.path == "/warmup":
+                self._send_json(200, handle.warmup())
+            elif self.path == "/generate":
+                payload, options = _parse_request(body)
+                self._send_json(200, handle.generate(payload, **options))
+            elif self.path == "/generate/stream":
+                payload, options = _parse_request(body)
+                self._stream(handle.stream(payload, **options))
+            elif self.path == "/generate/sse":
+                payload, options = _parse_request(body)
+                self._sse(handle.stream(payload, **options))
+            else:
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+        except ValueError as exc:
+            self._send_json(400, {"error": str(exc)})
+        except Exception as exc:  # noqa: BLE001
+            self._send_json(500, {"error": str(exc)})
+
+    def _stream(self, items) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for item in items:
+                self._write_chunk({"done": True, **item} if isinstance(item, dict) else {"delta": item})
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        except Exception as exc:  # noqa: BLE001
+            # Headers are already sent: report the failure as the last event.
+            self._write_chunk({"done": True, "error": str(exc)})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _sse(self, items) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for item in items:
+                if isinstance(item, dict):
+                    self._write_event(item, "done")
+                else:
+                    self._write_event({"delta": item})
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        except Exception as exc:  # noqa: BLE001
+            self._write_event({"error": str(exc)}, "error")
+
+    def _write_event(self, data: dict, event: str = None) -> None:
+        lines = f"event: {event}\n" if event else ""
+        lines += f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+        self.wfile.write(lines.encode("utf-8"))
+        self.wfile.flush()
+
+    def _write_chunk(self, event: dict) -> None:
+        line = (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(line):X}\r\n".encode("ascii") + line + b"\r\n")
+        self.wfile.flush()
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def load_models(specs, prompt_budget: int = None, cache: ResponseCache = None, ort_profile: str = "auto") -> dict:
+    """`name=path` (or bare `path`, named after its directory) -> ModelHandle."""
+    models = {}
+    for spec in specs:
+        name, _, model_dir = spec.rpartition("=")
+        name = name or Path(model_dir).name
+        print(f"Cargando modelo '{name}' desde {model_dir}...", flush=True)
+        models[name] = ModelHandle(name, model_dir, prompt_budget, cache, ort_profile)
+        print(f"✓ '{name}' cargado en {models[name].load_s:.1f}s", flush=True)
+    return models
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Servidor persistente de epicrisis (ORT GenAI)")
+    default_model_dir = Path(__file__).resolve().parent / "app" / "public" / "models" / "onnx-cpu-fp32"
+    parser.add_argument(
+        "--model-dir",
+        action="append",
+        default=[],
+        help="Modelo ORT GenAI como nombre=ruta (repetible; el primero es el modelo por defecto)",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", default=None, help="Escuchar en un socket Unix en vez de TCP")
+    parser.add_argument("--warmup", action="store_true", help="Generar unos tokens por modelo al iniciar")
+    parser.add_argument(
+        "--prompt-budget",
+        type=int,
+        default=None,
+        help="Máximo de tokens del prompt por solicitud; recorta evo, luego tto y proc (ver prompt_compiler.py)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Caché de respuestas en disco para solicitudes reproducibles (greedy o con seed)",
+    )
+    parser.add_argument("--cache-max-mb", type=float, default=DEFAULT_MAX_BYTES / 2**20, help="Tamaño máximo del caché")
+    parser.add_argument(
+        "--ort-profile",
+        default="auto",
+        help="Perfil de hilos de autotune.py: 'auto' (ort_profile.json junto a cada modelo), una ruta, o 'none'",
+    )
+    args = parser.parse_args()
+
+    cache = ResponseCache(args.cache_dir, max_bytes=int(args.cache_max_mb * 2**20)) if args.cache_dir else None
+    models = load_models(args.model_dir or [str(default_model_dir)], args.prompt_budget, cache, args.ort_profile)
+    if args.warmup:
+        for handle in models.values():
+            handle.warmup()
+
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.unlink(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, EpicrisisRequestHandler)
+        address = f"unix:{args.unix_socket}"
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), EpicrisisRequestHandler)
+        server.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        address = f"http://{args.host}:{args.port}"
+    server.models = models
+    server.cache = cache
+    server.default_model = next(iter(models))
+    server.started_at = time.time()
+
+    print(f"Escuchando en {address} (modelos: {', '.join(models)})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix_socket and os.path.exists(args.unix_socket):
+            os.unlink(args.unix_socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+Extractive compression of daily evolution notes into the `evo` field.
+
+The model was trained on a short `evo` phrase ("Favorable, afebril 3er dia,
+sin O2 5to dia"), while the clinical record holds one long note per day
+(data_example/evolucion_resultado.json). Prefill cost grows with every note
+token, so the notes are reduced to the sentences that carry the course:
+  1. segment each note into sentences (".", ";", "|" between authors, " - "
+     bullets, "1.-" lists, PLAN: / SE SUGIERE: / EX: sections); a period
+     before a lowercase word or after an abbreviation (ABBREVIATIONS, single
+     letters) does not end a sentence
+  2. drop sentences already seen on an earlier day (hash of the word
+     sequence), which removes the daily boilerplate ("KNT R Y M + TRIFLO")
+  3. score each sentence: clinical keyword weights (KEYWORDS, negative for
+     plans and routine orders) + novelty (share of its words not used on
+     earlier days) + recency (later days describe the state at discharge)
+  4. keep the best sentences that fit the token budget, in note order
+Everything is regex and dict lookups, so the cost is microseconds per
+episode-day.
+
+The budget is in tokens. Without a tokenizer the count is estimated from
+the number of characters (estimate_tokens).
+
+Usage (benchmark on the bundled example, real token counts with --tokenizer):
+  python3 epicrisis-app/fine-tuning/scripts/inference/evo_compress.py \\
+    --notes data_example/evolucion_resultado.json --budget 48 --repeats 2000
+"""
+
+import argparse
+import json
+import re
+import time
+from pathlib import Path
+
+DEFAULT_BUDGET = 48
+CHARS_PER_TOKEN = 3.0
+NOVELTY_WEIGHT = 2.0
+RECENCY_WEIGHT = 1.5
+MIN_WORDS = 2
+
+KEYWORDS = {
+    # Course and state at discharge
+    "ESTABLE": 1.5,
+    "AFEBRIL": 2.0,
+    "FEBRIL": 2.0,
+    "FIEBRE": 2.0,
+    "FAVORABLE": 2.0,
+    "MEJORIA": 2.0,
+    "RESUELTO": 2.0,
+    "RESUELTA": 2.0,
+    "RETIRO": 2.0,
+    "ALTA": 1.5,
+    "EXPANSION": 1.0,
+    "DISMINUCION": 1.0,
+    "SIN": 0.5,
+    # Complications and findings
+    "COMPLICACION": 2.0,
+    "INFECCION": 2.0,
+    "SEPSIS": 3.0,
+    "SHOCK": 3.0,
+    "COLECCION": 2.0,
+    "COLECCIONES": 2.0,
+    "DERRAME": 1.5,
+    "ASCITIS": 1.5,
+    "DHC": 1.0,
+    "NAUSEAS": 1.0,
+    "VOMITOS": 1.0,
+    "ICTERICA": 1.5,
+    "DISNEA": 1.5,
+    "DOLOR": 1.0,
+    "CULTIVO": 1.5,
+    "PCR": 1.0,
+    "DEBITO": 1.0,
+    "TAC": 1.0,
+    "RADIOGRAFIA": 0.5,
+    "MEROPENEM": 1.5,
+    "ANTIBIOTICO": 1.5,
+    "TRASLADO": 1.5,
+    "INCIDENTES": 1.0,
+    # Plans and routine orders
+    "PLAN": -2.0,
+    "SUGIERE": -2.0,
+    "MANTENER": -1.0,
+    "EVALUAR": -1.0,
+    "REEVALUACION": -1.0,
+    "SEGUIMIENTO": -1.0,
+    "CONTROL": -0.5,
+    "MANANA": -1.0,
+    "SOS": -1.0,
+    "KNT": -1.5,
+    "TRIFLO": -1.5,
+    "APOSITO": -1.0,
+    "ATTE": -3.0,
+}
+STOPWORDS = frozenset(
+    "A AL CON DE DEL EL EN ES LA LAS LO LOS O POR PARA QUE SE SU UN UNA Y CC HRS HR DIA DIAS".split()
+)
+# Abbreviations whose period does not end a sentence ("RETIRO DE SEP. POR AHORA ...").
+ABBREVIATIONS = ("SEP", "DR", "DRA", "SR", "SRA")
+# A period ends a sentence only before a capital or digit ("p. hepaticas" is one sentence) and not
+# after an abbreviation or a single letter.
+_PERIOD = (
+    r"\.(?<!\b[^\W\d_]\.)" + "".join(rf"(?<!\b(?i:{word})\.)" for word in ABBREVIATIONS) + r"\s+(?=[A-ZÁÉÍÓÚÑ0-9])"
+)
+_SPLIT = re.compile(_PERIOD + r"|;\s+|\s*\|\s*|\s+-\s+|\s+(?=\d+\.-|(?i:PLAN|SE SUGIERE|EX|SE INDICA)\s*:)")
+_WORD = re.compile(r"[A-Z0-9ÁÉÍÓÚÑ]+")
+_ENUMERATOR = re.compile(r"^\d+\.-\s*")
+
+
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def sentences(note: str) -> list:
+    """Sentence-like segments of one note, whitespace collapsed and trailing punctuation removed."""
+    parts = (_ENUMERATOR.sub("", " ".join(part.split())).strip(" .;:-") for part in _SPLIT.split(note))
+    return [part for part in parts if part]
+
+
+class EvolutionCompressor:
+    """Pick the highest-scoring, non-repeated sentences of a day-ordered list of notes within a token budget."""
+
+    def __init__(self, budget: int = DEFAULT_BUDGET, count_tokens=estimate_tokens, keywords: dict = None):
+        self.budget = budget
+        self.count_tokens = count_tokens
+        self.keywords = KEYWORDS if keywords is None else keywords
+        self._keyword_set = frozenset(self.keywords)
+
+    def candidates(self, notes: list) -> list:
+        """(score, day, position, text) for every sentence that was not already written on an earlier day."""
+        seen_sentences, seen_words, result = set(), set(), []
+        days = max(len(notes), 1)
+        for day, note in enumerate(notes):
+            day_words = set()
+            for position, text in enumerate(sentences(note)):
+                words = _WORD.findall(text.upper())
+                unique = {word for word in set(words) - STOPWORDS if len(word) > 1 and not word.isdigit()}
+                if len(unique) < MIN_WORDS:
+                    continue
+                digest = hash(tuple(words))
+                if digest in seen_sentences:
+                    continue
+                seen_sentences.add(digest)
+                novelty = len(unique - seen_words) / len(unique)
+                keyword = sum(self.keywords[word] for word in unique & self._keyword_set)
+                score = keyword + NOVELTY_WEIGHT * novelty + RECENCY_WEIGHT * (day + 1) / days
+                result.append((score, day, position, text))
+                day_words |= unique
+            seen_words |= day_words
+        return result
+
+    def select(self, notes: list) -> list:
+        """Kept sentences, in note order."""
+        kept, used = [], 0
+        for score, day, position, text in sorted(self.candidates(notes), key=lambda c: -c[0]):
+            if score <= 0:
+                break
+            cost = self.count_tokens(text) + (1 if kept else 0)
+            if used + cost > self.budget:
+                continue
+            kept.append((day, position, text))
+            used += cost
+        return [text for _, _, text in sorted(kept)]
+
+    def compress(self, notes: list, default: str = "") -> str:
+        """`notes` in chronological order; returns the kept sentences joined with ". " (or `default`)."""
+        return ". ".join(self.select(notes)) or default
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Compress daily evolution notes into a short evo phrase.")
+    parser.add_argument(
+        "--notes",
+        default=str(Path(__file__).resolve().parents[4] / "data_example" / "evolucion_resultado.json"),
+        help="JSON with evolucion_resumen [{dia, texto}] (or a full-format episode)",
+    )
+    parser.add_argument("--budget", type=int, default=DEFAULT_BUDGET, help="Token budget for evo")
+    parser.add_argument("--tokenizer", default=None, help="Tokenizer directory for real token counts")
+    parser.add_argument("--repeats", type=int, default=1000, help="Timed compressions of the example")
+    args = parser.parse_args()
+
+    data = json.loads(Path(args.notes).read_text(encoding="utf-8"))
+    entries = sorted(data.get("evolucion_resumen") or data.get("evolucion") or [], key=lambda e: e.get("dia") or 0)
+    notes = [entry.get("texto") or entry.get("nota") or "" for entry in entries]
+
+    count_tokens = estimate_tokens
+    if args.tokenizer:
+        try:
+            from transformers import AutoTokenizer
+        except Exception as exc:
+            raise RuntimeError("transformers is required for --tokenizer") from exc
+
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+
+        def count_tokens(text: str) -> int:
+            return len(tokenizer.encode(text, add_special_tokens=False))
+
+    compressor = EvolutionCompressor(args.budget, count_tokens)
+    kept = compressor.select(notes)
+    evo = ". ".join(kept)
+
+    # Timing uses the character estimate so it measures the compressor, not the tokenizer.
+    timed = EvolutionCompressor(args.budget)
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        timed.compress(notes)
+    per_episode_us = (time.perf_counter() - start) * 1e6 / max(args.repeats, 1)
+
+    raw = " ".join(notes)
+    print(f"days: {len(notes)}  sentences kept: {len(kept)} of {len(compressor.candidates(notes))}")
+    print(f"tokens: {count_tokens(raw)} (all notes) -> {count_tokens(evo)} (evo, budget {args.budget})")
+    print(f"latency: {per_episode_us:.1f}us per episode, {per_episode_us / max(len(notes), 1):.1f}us per episode-day")
+    print(f"evo: {evo}")
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,323 @@
+"""
+Skeleton-guided decoding: spans that are fixed by the input are forced, not sampled.
+
+Epicrisis text follows a fixed structure ("Ingresa por ... (code). Se realiza
+... Recibio ... Alta con diagnostico de ... indicandose ...")
+and copies its codes and doses from the input JSON. SkeletonGuide looks at the
+text generated so far and returns the deterministic continuation, if any:
+
+  - after "(" : the CIE-10/ATC/K code of the input item named just before it,
+    plus ")", when exactly one input code has every name word in the clause
+    and no item with another code shares a word with it; before the first
+    code only admission diagnoses count (otherwise the model samples the code)
+  - after a drug name from tto/med and the first digit of its dose: the rest
+    of the amount ("8" -> "75" of 875mg); the name alone is not enough (outputs
+    sometimes omit the dose) and the unit is left to the model ("125 ug")
+  - after a fixed connector (CONNECTORS): the words that always follow it
+
+guided_generate() feeds the sampled token together with the forced span as one
+multi-token chunk, so a forced span costs a single forward instead of one per
+token, and codes are copied from the input by construction. The model samples
+freely everywhere else.
+
+Usage (greedy benchmark against plain decoding):
+  python3 epicrisis-app/fine-tuning/scripts/inference/guided.py \\
+    --model epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx \\
+    --limit 8
+"""
+
+import argparse
+import re
+import time
+import unicodedata
+from pathlib import Path
+
+import numpy as np
+
+from batch_generate import load_episodes
+from logits_processors import BatchSamplingParams, LogitsPipeline, TokenHistory
+from onnx_engine import DecodeEngine, ModelGeometry
+from ort_session import add_session_arguments, session_from_args
+from prompt_compiler import build_chatml_prompt, load_prompt_style
+from sampling import SamplingParams
+from stopping import StopCriteria
+from streaming import IncrementalDetokenizer, stream_generate
+
+# Connector -> continuation; each is followed by the same words in every training output
+# ("Recibio tratamiento" is not: "con ..." and "sintomatico" both occur).
+CONNECTORS = {
+    "cumpliendo": " criterios de alta",
+    "Alta con diagnostico": " de",
+}
+# Sections whose items are mentioned before / after the discharge part of the text.
+ADMISSION_KEYS = ("dx", "proc", "tto")
+DISCHARGE_KEYS = ("dx_alta", "med")
+DISCHARGE_MARKERS = ("alta con", "indicandose")
+
+DOSE_RE = re.compile(r"^(?P<name>.+?)\s+(?P<number>\d+(?:[.,]\d+)?)\s?(?:mg|mcg|ug|g|UI|ml|mEq)\b", re.IGNORECASE)
+CODE_RE = re.compile(r"\(([^()]*)\)")
+# A drug name followed by the first digits of a dose: the model has committed to writing the dose.
+DOSE_START_RE = re.compile(r"(?<![A-Za-zÀ-ÿ])(?P<word>[A-Za-zÀ-ÿ]+) (?P<digits>\d+)$")
+
+
+def normalize(text: str) -> str:
+    """Lowercase without accents."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def _words(text: str) -> list:
+    return re.findall(r"[a-z0-9]+", normalize(text))
+
+
+class SkeletonGuide:
+    """Deterministic continuations of a partial epicrisis, derived from its input payload."""
+
+    def __init__(self, payload: dict, connectors: dict = None, min_word: int = 4):
+        self.connectors = CONNECTORS if connectors is None else connectors
+        self.min_word = min_word
+        # (name words, code, admission dx?); a clause names the item when it contains every one of these words.
+        self.items = []
+        # (section, last name word) -> dose amount, for drugs with an unambiguous dose in that section.
+        self.doses = {}
+        ambiguous = set()
+        for key in ADMISSION_KEYS + DISCHARGE_KEYS:
+            section = key in DISCHARGE_KEYS
+            for item in payload.get(key) or []:
+                if not isinstance(item, str) or "(" not in item:
+                    continue
+                name, _, code = item.rpartition("(")
+                code = code.rstrip(") ")
+                words = frozenset(self._name_words(name))
+                if code and words:
+                    self.items.append((words, code, key == "dx"))
+                match = DOSE_RE.match(name.strip()) if key in ("tto", "med") else None
+                if match:
+                    name_words = _words(match.group("name"))
+                    dose_key = (section, name_words[-1]) if name_words else None
+                    if dose_key in self.doses and self.doses[dose_key] != match.group("number"):
+                        ambiguous.add(dose_key)
+                    elif dose_key:
+                        self.doses[dose_key] = match.group("number")
+        for dose_key in ambiguous:
+            del self.doses[dose_key]
+
+    def _name_words(self, name: str) -> list:
+        """Words of an item name without doses, frequencies or durations (any word with a digit)."""
+        words = [w for w in _words(name) if not any(c.isdigit() for c in w)]
+        return [w for w in words if len(w) >= self.min_word] or words
+
+    def _section(self, text: str) -> bool:
+        lowered = normalize(text)
+        return any(marker in lowered for marker in DISCHARGE_MARKERS)
+
+    def _code(self, text: str) -> str:
+        """Code of the one input item named in the current clause, or None if there is not exactly one."""
+        # The current clause: text since the previous code or sentence.
+        clause = set(_words(re.split(r"[).]", text[:-1])[-1]))
+        if not clause:
+            return None
+        # Until the first code, the text is the opening "Ingresa por ..." clause, which codes the admission dx.
+        opening = ")" not in text
+        named = {code for words, code, dx in self.items if words <= clause and (dx or not opening)}
+        if len(named) != 1:
+            return None
+        code = named.pop()
+        # An item with another code partly named here (e.g. the procedure of a diagnosis) makes it ambiguous.
+        if any(other != code and words & clause for words, other, _ in self.items):
+            return None
+        return code
+
+    def forced(self, text: str) -> str:
+        """Continuation of `text` that must follow, or "" when the model should sample."""
+        if text.endswith("("):
+            code = self._code(text)
+            return f"{code})" if code else ""
+        for connector, continuation in self.connectors.items():
+            if text.endswith(connector):
+                return continuation
+        match = DOSE_START_RE.search(text) if self.doses and text[-1:].isdigit() else None
+        if match:
+            number = self.doses.get((self._section(text), normalize(match.group("word"))))
+            if number and number.startswith(match.group("digits")):
+                return number[len(match.group("digits")) :]
+        return ""
+
+
+def code_fidelity(text: str, payload: dict) -> tuple:
+    """(parenthesized codes found in the input, parenthesized spans) of a generated text."""
+    codes = set()
+    for key in ADMISSION_KEYS + DISCHARGE_KEYS:
+        for item in payload.get(key) or []:
+            if isinstance(item, str) and "(" in item:
+                codes.add(item.rpartition("(")[2].rstrip(") "))
+    spans = CODE_RE.findall(text)
+    return sum(span in codes for span in spans), len(spans)
+
+
+def replay(guide: SkeletonGuide, text: str) -> tuple:
+    """(forced spans, wrong forced spans) asking `guide` at every prefix of a reference output `text`."""
+    forced = wrong = 0
+    for end in range(1, len(text)):
+        span = guide.forced(text[:end])
+        if span:
+            forced += 1
+            wrong += not text.startswith(span, end)
+    return forced, wrong
+
+
+def guided_generate(
+    engine: DecodeEngine,
+    tokenizer,
+    prompt_ids,
+    guide: SkeletonGuide,
+    stop_criteria: StopCriteria,
+    sampling: SamplingParams = None,
+    eos_token_ids=(),
+    prefill_chunk: int = None,
+):
+    """
+    Generate from a single-row engine, inserting the guide's forced spans as multi-token chunks.
+
+    Forced tokens count against max_new_tokens and go through the stop matcher
+    like sampled ones. Returns (token ids with stop tokens trimmed, stats dict).
+    """
+    sampling = sampling or SamplingParams()
+    params = BatchSamplingParams([sampling])
+    rngs = [sampling.rng()]
+    pipeline = LogitsPipeline(eos_token_ids=eos_token_ids)
+    budget = stop_criteria.max_new_tokens or engine.max_length - len(prompt_ids)
+    history = TokenHistory(1, budget)
+    stop = stop_criteria.matcher()
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    tokens = []
+    stats = {"forwards": 1, "forced": 0, "spans": 0}
+
+    def emit(token_id: int) -> bool:
+        tokens.append(token_id)
+        history.append(token_id)
+        detokenizer.push(token_id)
+        return stop.update(token_id) or len(tokens) >= budget
+
+    engine.reset(batch=1)
+    logits = engine.prefill(np.array([prompt_ids], dtype=np.int64), chunk_size=prefill_chunk)
+    while True:
+        token_id = int(pipeline.sample(logits, history.view(), params, rngs)[0])
+        if emit(token_id):
+            break
+        chunk = [token_id]
+        span = guide.forced(detokenizer.text)
+        if span:
+            stats["spans"] += 1
+            for forced_id in tokenizer.encode(span, add_special_tokens=False):
+                chunk.append(forced_id)
+                stats["forced"] += 1
+                if emit(forced_id):
+                    break
+            if stop.done or len(tokens) >= budget:
+                break
+        logits = engine.forward(np.array([chunk], dtype=np.int64))
+        stats["forwards"] += 1
+
+    if stop.reason in ("eos", "stop_sequence"):
+        del tokens[len(tokens) - stop.matched_length :]
+    stats["generated"] = stop.num_tokens
+    stats["tokens_per_forward"] = stop.num_tokens / stats["forwards"]
+    return tokens, stats
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Skeleton-guided decoding benchmark (ONNX Runtime).")
+    parser.add_argument(
+        "--model",
+        default="epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx",
+        help="Path to ONNX model",
+    )
+    parser.add_argument(
+        "--tokenizer",
+        default=None,
+        help="Path to tokenizer directory (defaults to model's parent directory)",
+    )
+    parser.add_argument(
+        "--episodes",
+        default=str(Path(__file__).resolve().parents[2] / "datasets" / "dataset_epicrisis_350_completo.jsonl"),
+        help="Episodes (.jsonl with compact 'input' or .json)",
+    )
+    parser.add_argument("--limit", type=int, default=8, help="Number of episodes to generate")
+    parser.add_argument("--max-new-tokens", type=int, default=256, help="New-token budget per episode")
+    parser.add_argument("--no-connectors", action="store_true", help="Only force codes and doses")
+    parser.add_argument("--temperature", type=float, default=0.0, help="Sampling temperature (0 = greedy)")
+    parser.add_argument("--top-p", type=float, default=0.0, help="Top-p (nucleus) sampling (0 = disabled)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for sampling")
+    parser.add_argument("--no-baseline", action="store_true", help="Skip plain decoding (no speedup figure)")
+    parser.add_argument("--show", action="store_true", help="Print each guided output")
+    add_session_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        from transformers import AutoTokenizer
+    except Exception as exc:
+        raise RuntimeError("transformers is required for guided decoding") from exc
+
+    tokenizer_dir = args.tokenizer or Path(args.model).parent.parent
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir)
+    style = load_prompt_style(args.model)
+
+    sess = session_from_args(args, args.model)
+    geometry = ModelGeometry.from_session(sess, config_path=Path(tokenizer_dir) / "config.json")
+
+    episodes = load_episodes(args.episodes, args.limit)
+    prompts = [tokenizer.encode(build_chatml_prompt(e, style), add_special_tokens=False) for e in episodes]
+    stop_criteria = StopCriteria.from_tokenizer(tokenizer, max_new_tokens=args.max_new_tokens)
+    eos_ids = [tokenizer.eos_token_id] if tokenizer.eos_token_id is not None else []
+    engine = DecodeEngine(sess, max(len(p) for p in prompts) + args.max_new_tokens, geometry)
+    sampling = SamplingParams(args.temperature, top_p=args.top_p, seed=args.seed)
+
+    totals = {"forwards": 0, "forced": 0, "generated": 0, "guided_s": 0.0, "base_s": 0.0}
+    fidelity = {"guided": [0, 0], "baseline": [0, 0]}
+    for index, (episode, prompt) in enumerate(zip(episodes, prompts)):
+        guide = SkeletonGuide(episode, connectors={} if args.no_connectors else None)
+        start = time.perf_counter()
+        tokens, stats = guided_generate(engine, tokenizer, prompt, guide, stop_criteria, sampling, eos_ids)
+        guided_s = time.perf_counter() - start
+        for key in ("forwards", "forced", "generated"):
+            totals[key] += stats[key]
+        totals["guided_s"] += guided_s
+        text = tokenizer.decode(tokens, skip_special_tokens=True)
+        valid, spans = code_fidelity(text, episode)
+        fidelity["guided"][0] += valid
+        fidelity["guided"][1] += spans
+
+        line = (
+            f"[{index}] generated={stats['generated']} forced={stats['forced']} forwards={stats['forwards']} "
+            f"codes={valid}/{spans} time={guided_s:.2f}s"
+        )
+        if not args.no_baseline:
+            start = time.perf_counter()
+            baseline = list(stream_generate(engine, prompt, stop_criteria, sampling, eos_ids))
+            base_s = time.perf_counter() - start
+            totals["base_s"] += base_s
+            valid, spans = code_fidelity(tokenizer.decode(baseline, skip_special_tokens=True), episode)
+            fidelity["baseline"][0] += valid
+            fidelity["baseline"][1] += spans
+            line += f" baseline={base_s:.2f}s baseline_codes={valid}/{spans}"
+        print(line)
+        if args.show:
+            print(f"    {text}")
+
+    print(
+        f"episodes={len(prompts)} generated={totals['generated']} forced={totals['forced']} "
+        f"forwards={totals['forwards']} tokens/forward={totals['generated'] / max(totals['forwards'], 1):.2f} "
+        f"codes={fidelity['guided'][0]}/{fidelity['guided'][1]}"
+    )
+    if not args.no_baseline and totals["guided_s"]:
+        print(
+            f"speedup: {totals['base_s'] / totals['guided_s']:.2f}x "
+            f"(baseline codes={fidelity['baseline'][0]}/{fidelity['baseline'][1]})"
+        )
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
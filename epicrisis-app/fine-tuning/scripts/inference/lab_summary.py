@@ -0,0 +1,362 @@
+"""
+Columnar lab-results summary per episode (laboratorios_resumen).
+
+Python version of data_example/generar_laboratorios_resumen.sql. LIS result
+exports (d_res.txt layout: ID_ATENCION, NOMBRE_PRUEBA_LIS, VALOR_RESULTADO,
+UNIDAD_MEDIDA, RANGO_INFERIOR, RANGO_SUPERIOR, FECHA_INTEGRACION,
+IND_RANGO_RESULTADO, ...) are loaded into numpy columns. Each
+(ID_ATENCION, NOMBRE_PRUEBA_LIS) group is then summarized with one sort
+and reduceat, so no Python loop runs per row:
+  ingreso / ultimo   first and last result by FECHA_INTEGRACION, with range and
+                     estado (N/H/L -> normal/alto/bajo); `ultimo` only when it
+                     differs from `ingreso` by more than 0.001, as in the SQL
+  periodo            min / max, plus `n` results and `fuera_rango` (H or L)
+  tendencia          sube / baja / estable, from ultimo - ingreso
+Rows are kept as in the SQL: a value and IND_RANGO_RESULTADO present, value
+not "-", and a value that parses as a number ("," or "." decimals). With
+--exams (d_exa.txt layout), only results whose COD_PRESTACION was ordered for
+the episode (CAMPO4) are kept, like the join on TAB_EXAMENES.
+
+The output has the shape of laboratorios_resumen_v2.json, one object per
+episode: {"id_atencion", "laboratorios_resumen": [...]} ordered by prueba.
+--attach merges the summaries into full-format episodes (.json/.jsonl, see
+normalize_episodes.py) by id_atencion. --benchmark writes N synthetic rows
+with every column of --results to a temporary CSV and times loading it as
+well as the summary, since reading the export is a large part of a real run.
+
+Usage:
+  python3 epicrisis-app/fine-tuning/scripts/inference/lab_summary.py \\
+    --results data_example/d_res.txt --exams data_example/d_exa.txt --output outputs/laboratorios_resumen.jsonl
+  python3 epicrisis-app/fine-tuning/scripts/inference/lab_summary.py \\
+    --results data_example/d_res.txt --benchmark 2000000
+"""
+
+import argparse
+import csv
+import json
+import sys
+import tempfile
+import time
+from datetime import datetime
+from operator import itemgetter
+from pathlib import Path
+
+import numpy as np
+
+RESULT_COLUMNS = (
+    "ID_ATENCION",
+    "COD_PRESTACION",
+    "NOMBRE_PRUEBA_LIS",
+    "VALOR_RESULTADO",
+    "UNIDAD_MEDIDA",
+    "RANGO_INFERIOR",
+    "RANGO_SUPERIOR",
+    "FECHA_INTEGRACION",
+    "IND_RANGO_RESULTADO",
+)
+EXAM_COLUMNS = ("ID_ATENCION", "CAMPO4")
+ESTADOS = {"N": "normal", "H": "alto", "L": "bajo"}
+CHANGE_EPSILON = 0.001
+# FECHA_INTEGRACION is exported as DD/MM/YYYY HH24:MI:SS; these character
+# positions rebuild it as YYYY-MM-DDTHH:MI:SS for datetime64.
+_ISO_FROM_DMY = [6, 7, 8, 9, 2, 3, 4, 5, 0, 1, 10, 11, 12, 13, 14, 15, 16, 17, 18]
+_DMY_FROM_ISO = [8, 9, 4, 5, 6, 7, 0, 1, 2, 3, 10, 11, 12, 13, 14, 15, 16, 17, 18]
+
+
+def read_columns(path: Path, columns, delimiter: str = ",") -> dict:
+    """Selected columns of a CSV export as numpy string arrays (the csv module does the row splitting)."""
+    with open(path, "r", encoding="utf-8", errors="replace", newline="") as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        header = [name.strip().upper() for name in next(reader, [])]
+        missing = [name for name in columns if name not in header]
+        if missing:
+            raise ValueError(f"{path}: missing columns {', '.join(missing)}")
+        getter = itemgetter(*[header.index(name) for name in columns])
+        rows = list(map(getter, reader))
+    if not rows:
+        return {name: np.array([], dtype=str) for name in columns}
+    return {name: np.char.strip(np.array(values, dtype=str)) for name, values in zip(columns, zip(*rows))}
+
+
+def to_number(values: np.ndarray) -> np.ndarray:
+    """float64 column; NaN where the text is not a plain number ("7,8" and "7.8" parse, ">60" or "-" do not)."""
+    text = np.char.replace(values, ",", ".")
+    digits = np.char.replace(np.char.lstrip(text, "+-"), ".", "", count=1)
+    valid = np.char.isdigit(digits)
+    result = np.full(len(values), np.nan)
+    result[valid] = text[valid].astype(np.float64)
+    return result
+
+
+def to_datetime(values: np.ndarray) -> np.ndarray:
+    """datetime64[s] column from DD/MM/YYYY HH24:MI:SS (fractional seconds ignored); NaT if unparseable."""
+    if len(values) == 0:
+        return np.array([], dtype="datetime64[s]")
+    chars = np.ascontiguousarray(values.astype("U19")).view("U1").reshape(len(values), 19)
+    iso = np.ascontiguousarray(chars[:, _ISO_FROM_DMY])
+    iso[:, [4, 7]] = "-"
+    iso[:, 10] = "T"
+    iso = iso.view("U19").ravel()
+    try:
+        return iso.astype("datetime64[s]")
+    except ValueError:
+        # Mixed formats: parse each distinct value once.
+        unique, inverse = np.unique(values, return_inverse=True)
+        parsed = np.array([_parse_datetime(value) for value in unique], dtype="datetime64[s]")
+        return parsed[inverse]
+
+
+def _parse_datetime(value: str):
+    for fmt in ("%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%d/%m/%Y", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return np.datetime64(datetime.strptime(value[:19], fmt), "s")
+        except ValueError:
+            continue
+    return np.datetime64("NaT")
+
+
+def composite(*columns: np.ndarray) -> np.ndarray:
+    """Dense int64 code for each distinct tuple of the given columns."""
+    key = np.zeros(len(columns[0]), dtype=np.int64)
+    for column in columns:
+        unique, inverse = np.unique(column, return_inverse=True)
+        key = key * len(unique) + inverse.ravel()
+    return key
+
+
+def filter_results(results: dict, exams: dict = None) -> dict:
+    """Rows the SQL keeps: value and range flag present, value not "-", numeric value, ordered exam (with `exams`)."""
+    value = results["VALOR_RESULTADO"]
+    keep = (value != "") & (value != "-") & (results["IND_RANGO_RESULTADO"] != "")
+    numeric = to_number(value)
+    keep &= ~np.isnan(numeric)
+    if exams is not None:
+        ordered = np.char.add(np.char.add(exams["ID_ATENCION"], "\x1f"), exams["CAMPO4"])
+        requested = np.char.add(np.char.add(results["ID_ATENCION"], "\x1f"), results["COD_PRESTACION"])
+        keep &= np.isin(requested, ordered)
+    columns = {name: column[keep] for name, column in results.items()}
+    columns["valor"] = numeric[keep]
+    return columns
+
+
+def summarize(columns: dict) -> dict:
+    """
+    One row per (ID_ATENCION, NOMBRE_PRUEBA_LIS): columnar arrays for the first/last result and period stats.
+
+    `columns` comes from filter_results (numeric `valor` included).
+    """
+    dates = to_datetime(columns["FECHA_INTEGRACION"])
+    key = composite(columns["ID_ATENCION"], columns["NOMBRE_PRUEBA_LIS"])
+    # Seconds from the earliest result; rows without a date go to the end of their group.
+    valid = ~np.isnat(dates)
+    seconds = dates.astype(np.int64) - (dates[valid].astype(np.int64).min() if valid.any() else 0)
+    span = int(seconds[valid].max()) + 1 if valid.any() else 0
+    seconds[~valid] = span
+    if (int(key.max(initial=0)) + 1) * (span + 1) < 2**62:
+        # (group, time) packed into one int64: a single argsort orders both.
+        order = np.argsort(key * (span + 1) + seconds, kind="stable")
+    else:
+        order = np.lexsort((seconds, key))
+    sorted_key = key[order]
+    starts = np.flatnonzero(np.r_[True, sorted_key[1:] != sorted_key[:-1]]) if len(order) else np.array([], int)
+    ends = np.r_[starts[1:], len(order)] - 1
+    first, last = order[starts], order[ends]
+    values = columns["valor"][order]
+    flags = columns["IND_RANGO_RESULTADO"][order]
+    out_of_range = ((flags == "H") | (flags == "L")).astype(np.int64)
+    delta = columns["valor"][last] - columns["valor"][first]
+
+    def point(rows):
+        # Ranges and dates are only converted for the rows that are reported.
+        return {
+            "valor": columns["valor"][rows],
+            "fecha": np.datetime_as_string(dates[rows], unit="s"),
+            "rango_inferior": to_number(columns["RANGO_INFERIOR"][rows]),
+            "rango_superior": to_number(columns["RANGO_SUPERIOR"][rows]),
+            "estado": columns["IND_RANGO_RESULTADO"][rows],
+        }
+
+    return {
+        "id_atencion": columns["ID_ATENCION"][first],
+        "prueba": columns["NOMBRE_PRUEBA_LIS"][first],
+        "unidad": columns["UNIDAD_MEDIDA"][first],
+        "ingreso": point(first),
+        "ultimo": point(last),
+        "has_last": np.abs(delta) > CHANGE_EPSILON,
+        "tendencia": np.where(delta > CHANGE_EPSILON, "sube", np.where(delta < -CHANGE_EPSILON, "baja", "estable")),
+        "min": np.minimum.reduceat(values, starts) if len(starts) else values[:0],
+        "max": np.maximum.reduceat(values, starts) if len(starts) else values[:0],
+        "n": np.diff(np.r_[starts, len(order)]),
+        "fuera_rango": np.add.reduceat(out_of_range, starts) if len(starts) else out_of_range[:0],
+    }
+
+
+def json_numbers(values: np.ndarray) -> list:
+    """JSON numbers as Oracle prints them: integers without a decimal point, NaN as null."""
+    values = np.round(values, 6)
+    finite = np.isfinite(values)
+    integral = finite & (values == np.floor(values))
+    result = values.astype(object)
+    result[integral] = values[integral].astype(np.int64)
+    result[~finite] = None
+    return result.tolist()
+
+
+def json_estados(flags: np.ndarray) -> list:
+    result = np.full(len(flags), "sin_clasificar", dtype=object)
+    for flag, estado in ESTADOS.items():
+        result[flags == flag] = estado
+    return result.tolist()
+
+
+def _episode_id(value: str):
+    return int(value) if value.isdigit() else value
+
+
+def to_json(summary: dict) -> list:
+    """laboratorios_resumen_v2.json objects, one per episode; pruebas sorted by name."""
+    order = np.lexsort((summary["prueba"], summary["id_atencion"]))
+    columns = {
+        name: summary[name][order].tolist()
+        for name in ("id_atencion", "prueba", "unidad", "has_last", "tendencia", "n", "fuera_rango")
+    }
+    columns["min"], columns["max"] = json_numbers(summary["min"][order]), json_numbers(summary["max"][order])
+    points = {}
+    for side in ("ingreso", "ultimo"):
+        point = summary[side]
+        fields = {name: json_numbers(point[name][order]) for name in ("valor", "rango_inferior", "rango_superior")}
+        fields["fecha"] = [None if fecha == "NaT" else fecha for fecha in point["fecha"][order].tolist()]
+        fields["estado"] = json_estados(point["estado"][order])
+        # Column lists -> one dict per group, in the key order of the SQL output.
+        points[side] = [
+            dict(zip(("valor", "fecha", "rango_inferior", "rango_superior", "estado"), row))
+            for row in zip(fields["valor"], fields["fecha"], fields["rango_inferior"], fields["rango_superior"], fields["estado"])
+        ]
+    episodes = {}
+    for row in range(len(order)):
+        item = {"prueba": columns["prueba"][row], "unidad": columns["unidad"][row], "ingreso": points["ingreso"][row]}
+        if columns["has_last"][row]:
+            item["ultimo"] = points["ultimo"][row]
+        item["periodo"] = {
+            "min": columns["min"][row],
+            "max": columns["max"][row],
+            "n": columns["n"][row],
+            "fuera_rango": columns["fuera_rango"][row],
+        }
+        item["tendencia"] = columns["tendencia"][row]
+        episodes.setdefault(columns["id_atencion"][row], []).append(item)
+    return [{"id_atencion": _episode_id(key), "laboratorios_resumen": items} for key, items in episodes.items()]
+
+
+def lab_summaries(results_path: Path, exams_path: Path = None) -> list:
+    results = read_columns(results_path, RESULT_COLUMNS)
+    exams = read_columns(exams_path, EXAM_COLUMNS) if exams_path else None
+    return to_json(summarize(filter_results(results, exams)))
+
+
+def attach(episodes_path: Path, summaries: list):
+    """Full-format episodes with `laboratorios_resumen` set from `summaries` (matched by id_atencion)."""
+    from normalize_episodes import iter_episodes
+
+    by_id = {str(entry["id_atencion"]): entry["laboratorios_resumen"] for entry in summaries}
+    for episode in iter_episodes(episodes_path):
+        episode_id = str(episode.get("id_atencion") or (episode.get("atencion") or {}).get("id"))
+        if episode_id in by_id:
+            episode = dict(episode, laboratorios_resumen=by_id[episode_id])
+        yield episode
+
+
+def synthetic_results(results: dict, rows: int, episodes: int) -> dict:
+    """`rows` result rows cycled from `results`, spread over `episodes` distinct ID_ATENCION values."""
+    index = np.arange(rows) % len(results["ID_ATENCION"])
+    columns = {name: column[index] for name, column in results.items()}
+    rng = np.random.default_rng(0)
+    columns["ID_ATENCION"] = rng.integers(1, episodes + 1, size=rows).astype(str)
+    values = to_number(columns["VALOR_RESULTADO"])
+    jitter = np.round(values * rng.uniform(0.8, 1.2, size=rows), 2).astype(str)
+    columns["VALOR_RESULTADO"] = np.where(np.isnan(values), columns["VALOR_RESULTADO"], jitter)
+    hours = rng.integers(0, 24 * 10, size=rows).astype("timedelta64[h]")
+    stamps = np.datetime_as_string(np.datetime64("2025-12-15T00:00:00") + hours, unit="s")
+    chars = np.ascontiguousarray(stamps.astype("U19")).view("U1").reshape(rows, 19)
+    dmy = np.ascontiguousarray(chars[:, _DMY_FROM_ISO])
+    dmy[:, [2, 5]] = "/"
+    dmy[:, 10] = " "
+    columns["FECHA_INTEGRACION"] = dmy.view("U19").ravel()
+    return columns
+
+
+def write_synthetic_csv(source: Path, path: Path, rows: int, episodes: int) -> Path:
+    """An export with every column of `source` and `rows` synthetic rows (synthetic_results), for --benchmark."""
+    with open(source, "r", encoding="utf-8", errors="replace", newline="") as f:
+        header = [name.strip().upper() for name in next(csv.reader(f), [])]
+    columns = synthetic_results(read_columns(source, header), rows, episodes)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(zip(*columns.values()))
+    return path
+
+
+def main() -> int:
+    data_example = Path(__file__).resolve().parents[4] / "data_example"
+    parser = argparse.ArgumentParser(description="Summarize LIS lab results per episode (laboratorios_resumen).")
+    parser.add_argument("--results", default=str(data_example / "d_res.txt"), help="LIS results export (CSV)")
+    parser.add_argument("--exams", default=None, help="Ordered exams export (CSV, d_exa.txt layout) to join on")
+    parser.add_argument("--output", default=None, help="Output .jsonl, one episode per line (default: stdout)")
+    parser.add_argument("--attach", default=None, help="Full-format episodes (.json/.jsonl) to add the summaries to")
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Instead of writing, time loading and summarizing a CSV of N synthetic rows built from --results",
+    )
+    parser.add_argument("--episodes", type=int, default=10000, help="Distinct episodes in the --benchmark rows")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        timings = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = write_synthetic_csv(args.results, Path(tmp) / "d_res.txt", args.benchmark, args.episodes)
+            start = time.perf_counter()
+            columns = read_columns(path, RESULT_COLUMNS)
+            timings["load"] = time.perf_counter() - start
+        start = time.perf_counter()
+        filtered = filter_results(columns)
+        timings["filter"] = time.perf_counter() - start
+        start = time.perf_counter()
+        summary = summarize(filtered)
+        timings["group-by"] = time.perf_counter() - start
+        start = time.perf_counter()
+        episodes = to_json(summary)
+        timings["json"] = time.perf_counter() - start
+        total = sum(timings.values())
+        print(
+            f"{args.benchmark} rows -> {len(filtered['valor'])} numeric, "
+            f"{len(summary['prueba'])} (episode, test) groups, {len(episodes)} episodes"
+        )
+        for stage, seconds in timings.items():
+            print(f"  {stage:<9} {seconds:>7.3f}s")
+        print(f"  total     {total:>7.3f}s  ({args.benchmark / max(total, 1e-9) / 1e6:.2f}M rows/s)")
+        print("OK")
+        return 0
+
+    summaries = lab_summaries(args.results, args.exams)
+    records = attach(args.attach, summaries) if args.attach else summaries
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    count = 0
+    try:
+        for record in records:
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    finally:
+        if args.output:
+            out.close()
+    if args.output:
+        print(f"{count} episodes -> {args.output}")
+        print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,247 @@
+"""
+Vectorized logits-processor chain and Gumbel-max sampling.
+
+Every stage works on last-position logits [batch, vocab] with per-row
+parameters (BatchSamplingParams), so rows of a continuous batch can use
+different temperature / top-k / top-p / min-p / repetition penalty.
+Disabled rows get neutral values instead of being skipped in Python.
+
+Stages are called as `stage(logits, floor, history, params)`:
+- transforms (no-EOS, repetition penalty, temperature) edit logits in place;
+- filters (top-k, top-p, min-p) only raise `floor`, a per-row logit
+  threshold, and the pipeline masks everything below it once at the end.
+
+top-k and top-p only sort a partitioned candidate set; top-p falls back to a
+full sort for a row only when the candidates hold less than top_p of the
+probability mass, so the result is exact. Sampling adds Gumbel noise to the
+surviving logits and takes argmax, which samples softmax(logits) without
+normalizing probabilities. LogitsPipeline.timings accumulates seconds per
+stage for profiling.
+"""
+
+import time
+
+import numpy as np
+
+NEG_INF = np.float32(-np.inf)
+TOP_P_CANDIDATES = 256
+
+
+class BatchSamplingParams:
+    """Per-row sampling parameters as arrays of shape [batch]."""
+
+    def __init__(self, params_list):
+        self.temperature = np.array([p.temperature or 0.0 for p in params_list], dtype=np.float32)
+        self.top_k = np.array([p.top_k or 0 for p in params_list], dtype=np.int64)
+        self.top_p = np.array([p.top_p or 0.0 for p in params_list], dtype=np.float32)
+        self.min_p = np.array([p.min_p or 0.0 for p in params_list], dtype=np.float32)
+        self.repetition_penalty = np.array(
+            [max(p.repetition_penalty or 1.0, 1.0) for p in params_list], dtype=np.float32
+        )
+        self.no_eos = np.array([bool(p.no_eos) for p in params_list])
+        self.sampled = self.temperature > 0
+
+    def __len__(self) -> int:
+        return len(self.temperature)
+
+
+class TokenHistory:
+    """Generated ids per row in a preallocated [rows, max_tokens] buffer padded with -1."""
+
+    def __init__(self, rows: int, max_tokens: int):
+        self._buffer = np.full((rows, max_tokens), -1, dtype=np.int64)
+        self.lengths = np.zeros(rows, dtype=np.int64)
+        self.rows = rows
+
+    def reset(self, rows: int) -> None:
+        self._buffer[:] = -1
+        self.lengths[:] = 0
+        self.rows = rows
+
+    def append(self, tokens: np.ndarray) -> None:
+        rows = np.arange(self.rows)
+        self._buffer[rows, self.lengths[: self.rows]] = tokens
+        self.lengths[: self.rows] += 1
+
+    def add_row(self, tokens) -> None:
+        self._buffer[self.rows] = -1
+        self._buffer[self.rows, : len(tokens)] = tokens
+        self.lengths[self.rows] = len(tokens)
+        self.rows += 1
+
+    def retain(self, rows) -> None:
+        rows = np.asarray(rows, dtype=np.int64)
+        self._buffer[: len(rows)] = self._buffer[rows]
+        self.lengths[: len(rows)] = self.lengths[rows]
+        self._buffer[len(rows) :] = -1
+        self.rows = len(rows)
+
+    def view(self) -> np.ndarray:
+        width = int(self.lengths[: self.rows].max()) if self.rows else 0
+        return self._buffer[: self.rows, :width]
+
+
+class NoEosProcessor:
+    name = "no_eos"
+
+    def __init__(self, eos_token_ids=()):
+        self.eos_token_ids = np.array(sorted(eos_token_ids), dtype=np.int64)
+
+    def __call__(self, logits, floor, history, params):
+        if self.eos_token_ids.size and params.no_eos.any():
+            rows = np.nonzero(params.no_eos)[0]
+            logits[np.ix_(rows, self.eos_token_ids)] = NEG_INF
+        return logits
+
+
+class RepetitionPenaltyProcessor:
+    """CTRL-style penalty: positive logits are divided, negative multiplied."""
+
+    name = "repetition_penalty"
+
+    def __call__(self, logits, floor, history, params):
+        penalty = params.repetition_penalty
+        if history.size == 0 or not (penalty > 1.0).any():
+            return logits
+        rows, columns = np.nonzero(history >= 0)
+        tokens = history[rows, columns]
+        seen = logits[rows, tokens]
+        factor = penalty[rows]
+        # Repeated ids in a row write the same value computed from the original logit.
+        logits[rows, tokens] = np.where(seen > 0, seen / factor, seen * factor)
+        return logits
+
+
+class TemperatureProcessor:
+    name = "temperature"
+
+    def __call__(self, logits, floor, history, params):
+        if params.sampled.any():
+            scale = np.where(params.sampled, params.temperature, 1.0).astype(np.float32)
+            logits /= scale[:, None]
+        return logits
+
+
+def _top_candidates(logits: np.ndarray, count: int) -> np.ndarray:
+    """The `count` largest logits per row, sorted descending (partition, then sort only those)."""
+    vocab = logits.shape[1]
+    candidates = np.partition(logits, vocab - count, axis=1)[:, vocab - count :]
+    return -np.sort(-candidates, axis=1)
+
+
+class TopKProcessor:
+    name = "top_k"
+
+    def __call__(self, logits, floor, history, params):
+        vocab = logits.shape[1]
+        top_k = np.where(params.sampled & (params.top_k > 0), np.minimum(params.top_k, vocab), 0)
+        if not top_k.any():
+            return logits
+        candidates = _top_candidates(logits, int(top_k.max()))
+        rows = np.nonzero(top_k)[0]
+        np.maximum.at(floor, rows, candidates[rows, top_k[rows] - 1])
+        return logits
+
+
+class TopPProcessor:
+    """Nucleus filter over a candidate set (keeps tokens with cumulative prob <= top_p)."""
+
+    name = "top_p"
+
+    def __init__(self, candidates: int = TOP_P_CANDIDATES):
+        self.candidates = candidates
+
+    def __call__(self, logits, floor, history, params):
+        active = params.sampled & (params.top_p > 0.0) & (params.top_p < 1.0)
+        if not active.any():
+            return logits
+        vocab = logits.shape[1]
+        count = min(max(self.candidates, int(params.top_k.max())), vocab)
+        candidates = _top_candidates(logits, count)
+        candidates[candidates < floor[:, None]] = NEG_INF
+        top = candidates[:, :1]
+        # Rows whose floor already cuts inside the candidates (e.g. after top-k) need no full-vocab pass.
+        covered = candidates[:, -1] == NEG_INF
+        mass = np.exp(candidates - top).sum(axis=1)
+        for row in np.nonzero(active & ~covered)[0]:
+            kept = logits[row] if floor[row] == NEG_INF else logits[row][logits[row] >= floor[row]]
+            mass[row] = np.exp(kept - top[row]).sum()
+        log_norm = top[:, 0] + np.log(mass)
+        cumulative = np.cumsum(np.exp(candidates - log_norm[:, None]), axis=1)
+        kept = np.maximum((cumulative <= params.top_p[:, None]).sum(axis=1), 1)
+        threshold = candidates[np.arange(len(kept)), kept - 1]
+        for row in np.nonzero(active & ~covered & (cumulative[:, -1] < params.top_p))[0]:
+            ordered = -np.sort(-logits[row])
+            row_mass = np.cumsum(np.exp(ordered - log_norm[row]))
+            threshold[row] = ordered[max(int((row_mass <= params.top_p[row]).sum()), 1) - 1]
+        rows = np.nonzero(active)[0]
+        np.maximum.at(floor, rows, threshold[rows])
+        return logits
+
+
+class MinPProcessor:
+    """Drop tokens whose probability is below min_p times the top token's probability."""
+
+    name = "min_p"
+
+    def __call__(self, logits, floor, history, params):
+        active = params.sampled & (params.min_p > 0.0)
+        if not active.any():
+            return logits
+        rows = np.nonzero(active)[0]
+        np.maximum.at(floor, rows, logits[rows].max(axis=1) + np.log(params.min_p[rows]))
+        return logits
+
+
+class LogitsPipeline:
+    """Ordered processor chain plus Gumbel-max / greedy token selection."""
+
+    def __init__(self, processors=None, eos_token_ids=()):
+        if processors is None:
+            processors = [
+                NoEosProcessor(eos_token_ids),
+                RepetitionPenaltyProcessor(),
+                TemperatureProcessor(),
+                TopKProcessor(),
+                TopPProcessor(),
+                MinPProcessor(),
+            ]
+        self.processors = processors
+        self.timings = {p.name: 0.0 for p in processors}
+        self.timings["sample"] = 0.0
+        self.calls = 0
+
+    def __call__(self, logits: np.ndarray, history: np.ndarray, params: BatchSamplingParams):
+        """Run the chain in place; return (logits, floor). Entries below floor[row] are filtered out."""
+        floor = np.full(len(logits), NEG_INF, dtype=np.float32)
+        for processor in self.processors:
+            start = time.perf_counter()
+            logits = processor(logits, floor, history, params)
+            self.timings[processor.name] += time.perf_counter() - start
+        return logits, floor
+
+    def sample(self, logits: np.ndarray, history: np.ndarray, params: BatchSamplingParams, rngs) -> np.ndarray:
+        """Process `logits` [batch, vocab] in place and return one token id per row."""
+        self.calls += 1
+        logits, floor = self(logits, history, params)
+        start = time.perf_counter()
+        tokens = np.argmax(logits, axis=1)
+        for row in np.nonzero(params.sampled)[0]:
+            if floor[row] == NEG_INF:
+                candidates, values = None, logits[row]
+            else:
+                candidates = np.flatnonzero(logits[row] >= floor[row])
+                values = logits[row, candidates]
+            noise = rngs[row].random(values.size, dtype=np.float32)
+            np.log(noise, out=noise)
+            np.negative(noise, out=noise)
+            np.log(noise, out=noise)
+            best = int(np.argmax(values - noise))
+            tokens[row] = best if candidates is None else candidates[best]
+        self.timings["sample"] += time.perf_counter() - start
+        return tokens
+
+    def report(self) -> dict:
+        """Mean milliseconds per call for each stage."""
+        calls = max(self.calls, 1)
+        return {name: seconds * 1000.0 / calls for name, seconds in self.timings.items()}
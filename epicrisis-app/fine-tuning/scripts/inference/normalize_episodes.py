@@ -0,0 +1,357 @@
+"""
+Full clinical episode JSON -> compact model input, in bulk.
+
+The full format (data_example/epicrisis_ejemplo.json, and the normalized
+ClinicalJson of the backend) is mapped to the compact schema the model was
+trained on, the same mapping as buildEpicrisisPromptFineTuned in the
+frontend's local-rag.service.ts:
+  dx       diagnostico_ingreso as "nombre (codigo)"; ["No consignado"] if empty
+  proc     procedimientos as "nombre (codigo)"
+  tto      tratamientos_intrahosp as "nombre dosis via frecuencia duracion (ATC)"
+  evo      evolution notes compressed to the sentences that carry the course
+           (evo_compress.py); "Favorable" if there are none
+  dx_alta  diagnostico_egreso, falling back to dx
+  med      indicaciones_alta.medicamentos, deduplicated by ATC code
+ATC codes lose their "ATC:" prefix, "cada 8 horas" becomes "c/8h" and
+"7 dias" becomes "7d", as in the dataset. A treatment without a duration gets
+the days between `inicio` and `fin`.
+
+Episodes are streamed from .json (object or list) or .jsonl (one or more
+episodes per line) and normalized across a process pool (imap, in order,
+--chunksize episodes per task). The output is JSONL with {"id", "input"},
+which batch_generate.load_episodes reads directly; --compact prints one
+bare compact JSON per line for run_epicrisis_onnx.py --input-json.
+
+Usage (normalize, then measure serial vs pool throughput):
+  python3 epicrisis-app/fine-tuning/scripts/inference/normalize_episodes.py \\
+    --input epicrisis-app/data_example/epicrisis_ejemplo.json --output outputs/compact_inputs.jsonl
+  python3 epicrisis-app/fine-tuning/scripts/inference/normalize_episodes.py \\
+    --input epicrisis-app/data_example/epicrisis_ejemplo.json --benchmark 20000
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import re
+import sys
+import time
+import warnings
+from datetime import date
+from itertools import islice, repeat
+from pathlib import Path
+
+from evo_compress import EvolutionCompressor
+
+EVO_CHARS = 100
+NOT_RECORDED = "No consignado"
+DEFAULT_EVO = "Favorable"
+
+VIA_MAP = {
+    "oral": "VO",
+    "via oral": "VO",
+    "endovenoso": "EV",
+    "endovenosa": "EV",
+    "intravenoso": "EV",
+    "intravenosa": "EV",
+    "iv": "EV",
+    "intramuscular": "IM",
+    "subcutaneo": "SC",
+    "subcutanea": "SC",
+    "sublingual": "SL",
+    "topico": "TOP",
+    "topica": "TOP",
+    "inhalatoria": "INH",
+    "nebulizacion": "NBZ",
+    "rectal": "REC",
+}
+_EVO_COMPRESSOR = EvolutionCompressor()
+_WHITESPACE = re.compile(r"\s+")
+_CONTROL = re.compile(r"[\x00-\x1F\x7F]")
+_EVERY = re.compile(r"^cada\s+(\d+)\s*(?:horas?|hrs?|h)$", re.IGNORECASE)
+_DURATION = re.compile(r"^(?:por\s+)?(\d+)\s*(dias?|días?|d|semanas?|meses?|m)$", re.IGNORECASE)
+_DURATION_UNITS = {"d": "d", "s": "sem", "m": "m"}
+# ATC code at any level (B, B01, B01A, B01AC, B01AC06) closing an item.
+_ATC_SUFFIX = re.compile(r"\(([A-Z]\d\d(?:[A-Z]{1,2}\d{0,2})?)\)$", re.IGNORECASE)
+
+
+def clean(value) -> str:
+    """Single-line text: control characters removed, whitespace collapsed (normalizerService.normalizeString)."""
+    if value is None:
+        return ""
+    return _WHITESPACE.sub(" ", _CONTROL.sub(" ", str(value))).strip()
+
+
+def parse_list(value) -> list:
+    """Oracle exports some list columns as JSON strings; accept both."""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            return []
+    return [item for item in value if item is not None] if isinstance(value, list) else []
+
+
+def atc_code(code) -> str:
+    code = clean(code).upper()
+    return code[4:].strip() if code.startswith("ATC:") else code
+
+
+def frequency(value) -> str:
+    value = clean(value)
+    match = _EVERY.match(value)
+    return f"c/{match.group(1)}h" if match else value
+
+
+def duration(value) -> str:
+    value = clean(value)
+    match = _DURATION.match(value)
+    if not match:
+        return value
+    return f"{match.group(1)}{_DURATION_UNITS[match.group(2)[0].lower()]}"
+
+
+def days_between(start, end) -> str:
+    try:
+        days = (date.fromisoformat(str(end)[:10]) - date.fromisoformat(str(start)[:10])).days
+    except ValueError:
+        return ""
+    return f"{max(days, 1)}d"
+
+
+def coded(name: str, code: str) -> str:
+    return f"{name} ({code})" if code else name
+
+
+def diagnoses(items) -> list:
+    result = []
+    for item in parse_list(items):
+        name = clean(item.get("nombre"))
+        if name:
+            result.append(coded(name, clean(item.get("codigo")).upper()))
+    return result
+
+
+def procedures(items) -> list:
+    result = []
+    for item in parse_list(items):
+        name = clean(item.get("nombre"))
+        if name:
+            result.append(coded(name, clean(item.get("codigo"))))
+    return result
+
+
+def medications(items) -> list:
+    """`nombre dosis via frecuencia duracion (ATC)`; parts already in the name are not repeated."""
+    result = []
+    for item in parse_list(items):
+        name = clean(item.get("nombre"))
+        if not name:
+            continue
+        via = clean(item.get("via"))
+        parts = [
+            clean(item.get("dosis")),
+            VIA_MAP.get(via.lower(), via.upper()),
+            frequency(item.get("frecuencia")),
+            duration(item.get("duracion")) or days_between(item.get("inicio"), item.get("fin")),
+        ]
+        words = set(name.lower().split())
+        text = " ".join([name] + [part for part in parts if part and part.lower() not in words])
+        result.append(coded(text, atc_code(item.get("codigo"))))
+    return result
+
+
+def dedupe_by_code(items: list) -> list:
+    """First item per ATC code (or per lowercased text without one), in order."""
+    seen = {}
+    for item in items:
+        match = _ATC_SUFFIX.search(item)
+        seen.setdefault(match.group(1).upper() if match else item.lower(), item)
+    return list(seen.values())
+
+
+def evolution(raw: dict) -> str:
+    """
+    Evolution notes (by `dia`, else `fecha`) compressed by _EVO_COMPRESSOR.
+
+    If no sentence scores, the last note cut to EVO_CHARS at a word boundary.
+    """
+    notes = parse_list(raw.get("evolucion_resumen")) or parse_list(raw.get("evolucion"))
+    notes = sorted(notes, key=lambda note: (note.get("dia") or 0, str(note.get("fecha") or "")))
+    texts = [clean(note.get("texto") or note.get("nota")) for note in notes]
+    texts = [text for text in texts if text]
+    if not texts:
+        return DEFAULT_EVO
+    text = _EVO_COMPRESSOR.compress(texts)
+    if text:
+        return text
+    text = texts[-1]
+    if len(text) > EVO_CHARS:
+        text = text[:EVO_CHARS].rsplit(" ", 1)[0] or text[:EVO_CHARS]
+    return text
+
+
+def normalize_episode(raw: dict) -> dict:
+    """Compact model input (dx, proc, tto, evo, dx_alta, med) for one full-format episode."""
+    dx = diagnoses(raw.get("diagnostico_ingreso"))
+    discharge = raw.get("indicaciones_alta") or {}
+    return {
+        "dx": dx or [NOT_RECORDED],
+        "proc": procedures(raw.get("procedimientos")),
+        "tto": medications(raw.get("tratamientos_intrahosp")),
+        "evo": evolution(raw),
+        "dx_alta": diagnoses(raw.get("diagnostico_egreso")) or dx,
+        "med": dedupe_by_code(medications(discharge.get("medicamentos"))),
+    }
+
+
+def _normalize_record(record: dict) -> dict:
+    episode_id = record.get("id_atencion") or (record.get("atencion") or {}).get("id")
+    return {"id": episode_id, "input": normalize_episode(record)}
+
+
+def iter_episodes(path: Path):
+    """
+    Records from a .jsonl (streamed) or a .json object/list.
+
+    Some .jsonl lines hold several records back to back; every object that
+    decodes is kept, the rest of an undecodable line is skipped with a warning.
+    """
+    path = Path(path)
+    if path.suffix != ".jsonl":
+        data = json.loads(path.read_text(encoding="utf-8"))
+        yield from data if isinstance(data, list) else [data]
+        return
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line, offset = line.strip(), 0
+            while offset < len(line):
+                try:
+                    record, offset = decoder.raw_decode(line, offset)
+                except json.JSONDecodeError as exc:
+                    warnings.warn(f"{path.name}:{number}: skipping undecodable data ({exc})")
+                    break
+                yield record
+                while offset < len(line) and line[offset].isspace():
+                    offset += 1
+
+
+def normalize_stream(records, workers: int = 1, chunksize: int = 64, pool=None):
+    """
+    Yield {"id", "input"} for each record, in input order.
+
+    workers > 1 uses a process pool (`pool` if given, else a new spawn pool).
+    """
+    if pool is not None:
+        yield from pool.imap(_normalize_record, records, chunksize=chunksize)
+        return
+    if workers <= 1:
+        yield from map(_normalize_record, records)
+        return
+    with mp.get_context("spawn").Pool(workers) as pool:
+        yield from pool.imap(_normalize_record, records, chunksize=chunksize)
+
+
+def _worker_pid(_) -> int:
+    time.sleep(0.01)  # leave tasks for workers still starting up
+    return os.getpid()
+
+
+def _start_pool(workers: int):
+    """A spawn pool whose processes have all started and imported this module; returns (pool, seconds)."""
+    start = time.perf_counter()
+    pool = mp.get_context("spawn").Pool(workers)
+    pids = set()
+    while len(pids) < workers:
+        pids.update(pool.map(_worker_pid, range(workers), chunksize=1))
+    return pool, time.perf_counter() - start
+
+
+def benchmark(records: list, total: int, workers_list: list, chunksize: int) -> list:
+    """
+    Episodes/s normalizing `total` episodes (cycled from `records`) serially and with each pool size.
+
+    Pools are started and warmed before the clock starts; their start-up
+    (spawn + imports, paid once per run) is reported separately.
+    """
+    corpus = list(islice((record for _ in repeat(None) for record in records), total))
+    rows = []
+    for workers in workers_list:
+        pool, startup = _start_pool(workers) if workers > 1 else (None, 0.0)
+        try:
+            start = time.perf_counter()
+            count = sum(1 for _ in normalize_stream(corpus, workers, chunksize, pool))
+            elapsed = time.perf_counter() - start
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        rows.append(
+            {
+                "workers": workers,
+                "episodes": count,
+                "startup_s": startup,
+                "seconds": elapsed,
+                "eps": count / max(elapsed, 1e-9),
+            }
+        )
+    return rows
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Normalize full clinical episodes to the compact model input.")
+    parser.add_argument(
+        "--input",
+        default=str(Path(__file__).resolve().parents[3] / "data_example" / "epicrisis_ejemplo.json"),
+        help="Full-format episodes (.json object/list or .jsonl)",
+    )
+    parser.add_argument("--output", default=None, help="Output .jsonl of {id, input} (default: stdout)")
+    parser.add_argument("--compact", action="store_true", help="Write only the compact input per line")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Normalizer processes")
+    parser.add_argument("--chunksize", type=int, default=64, help="Episodes per pool task")
+    parser.add_argument("--limit", type=int, default=None, help="Number of episodes (default: all)")
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        default=None,
+        metavar="N",
+        help=(
+            "Instead of writing, time N episodes (input cycled) serially and with 2..--workers processes "
+            "(warmed pools; start-up reported separately)"
+        ),
+    )
+    args = parser.parse_args()
+
+    records = islice(iter_episodes(args.input), args.limit)
+
+    if args.benchmark:
+        records = list(records)
+        workers_list = sorted({1, *[w for w in (2, 4, 8, 16) if w < args.workers], args.workers})
+        rows = benchmark(records, args.benchmark, workers_list, args.chunksize)
+        print(f"{'workers':>7} {'episodes':>9} {'startup_s':>9} {'seconds':>8} {'episodes/s':>11} {'speedup':>8}")
+        for row in rows:
+            print(
+                f"{row['workers']:>7} {row['episodes']:>9} {row['startup_s']:>9.2f} {row['seconds']:>8.2f} "
+                f"{row['eps']:>11.0f} {row['eps'] / rows[0]['eps']:>7.2f}x"
+            )
+        print("OK")
+        return 0
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    count = 0
+    try:
+        for result in normalize_stream(records, args.workers, args.chunksize):
+            out.write(json.dumps(result["input"] if args.compact else result, ensure_ascii=False) + "\n")
+            count += 1
+    finally:
+        if args.output:
+            out.close()
+    if args.output:
+        print(f"{count} episodes -> {args.output}")
+        print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
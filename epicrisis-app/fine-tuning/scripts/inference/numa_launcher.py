@@ -0,0 +1,446 @@
+"""
+NUMA-aware multi-instance launcher for the continuous-batching ONNX worker.
+
+On a multi-socket host, one ORT process whose threads span every socket keeps
+reading weights and KV cache across the interconnect. Past one socket, its
+decode throughput stops improving. This launcher reads the NUMA topology from
+/sys/devices/system/node and starts one worker per node, or per core group
+inside a node. Each worker is bound to its cores and to the memory of its own
+node, and requests are dispatched to the least-loaded worker.
+
+Binding, per worker process:
+  numactl    `numactl --physcpubind=<cpus> --membind=<node>` when numactl is
+             installed: every allocation (weights, KV cache, arena) comes from
+             the node's own memory.
+  affinity   sched_setaffinity to the group's CPUs only. Linux allocates a page
+             on the node of the CPU that first touches it, so memory ends up
+             local without a hard binding.
+Each worker runs ORT with one intra-op thread per CPU in its group.
+
+Weights: by default each worker prepacks its own copy at load time, in
+node-local memory. --shared-weights keeps one mmap'd copy in the page cache
+instead (see shared_weights.py). That copy lives on a single node, so workers
+on the other nodes read their weights remotely. It saves memory at the cost of
+the NUMA benefit.
+
+Workers are worker.py InferenceWorker instances in subprocesses. They receive
+token ids and return token ids, one JSON line per request over stdin/stdout.
+Tokenization stays in the launcher.
+
+Usage (replays episodes; --baseline first runs one unpinned worker on all CPUs):
+  python3 epicrisis-app/fine-tuning/scripts/inference/numa_launcher.py \\
+    --model epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx \\
+    --limit 32 --slots 4 --rate 0 --max-new-tokens 128 --baseline
+"""
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+
+import numpy as np
+
+from batch_generate import load_episodes
+from ort_session import add_session_arguments, allowed_cpus, create_session, percentile, pin_process
+from prompt_compiler import build_chatml_prompt, chatml_prefix, load_prompt_style
+from sampling import SamplingParams
+from stopping import StopCriteria
+
+NODE_DIR = Path("/sys/devices/system/node")
+BIND_MODES = ("auto", "numactl", "affinity", "none")
+
+
+def parse_cpulist(text: str) -> list:
+    """'0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11] (sysfs / numactl cpulist syntax)."""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpulist(cpus) -> str:
+    ranges = []
+    for _, run in itertools.groupby(enumerate(sorted(cpus)), key=lambda item: item[1] - item[0]):
+        run = [cpu for _, cpu in run]
+        ranges.append(str(run[0]) if len(run) == 1 else f"{run[0]}-{run[-1]}")
+    return ",".join(ranges)
+
+
+def numa_nodes() -> list:
+    """[{"node", "cpus"}] for each NUMA node with CPUs this process may use; one node=None group without sysfs."""
+    allowed = set(allowed_cpus())
+    nodes = []
+    for path in sorted(NODE_DIR.glob("node[0-9]*"), key=lambda p: int(p.name[4:])):
+        try:
+            cpus = [cpu for cpu in parse_cpulist((path / "cpulist").read_text()) if cpu in allowed]
+        except OSError:
+            continue
+        if cpus:
+            nodes.append({"node": int(path.name[4:]), "cpus": cpus})
+    return nodes or [{"node": None, "cpus": sorted(allowed)}]
+
+
+def core_groups(nodes, workers_per_node: int = 1, cpulists=None) -> list:
+    """
+    Worker CPU groups: `cpulists` if given (each assigned to the node owning its
+    first CPU), else each node split into `workers_per_node` contiguous groups.
+    """
+    if cpulists:
+        owner = {cpu: node["node"] for node in nodes for cpu in node["cpus"]}
+        groups = []
+        for text in cpulists:
+            cpus = parse_cpulist(text)
+            if not cpus:
+                raise ValueError(f"Empty core group '{text}'")
+            groups.append({"node": owner.get(cpus[0]), "cpus": cpus})
+        return groups
+    groups = []
+    for node in nodes:
+        parts = np.array_split(node["cpus"], min(workers_per_node, len(node["cpus"])))
+        groups.extend({"node": node["node"], "cpus": [int(cpu) for cpu in part]} for part in parts)
+    return groups
+
+
+def bind_command(group: dict, mode: str = "auto") -> list:
+    """Command prefix that binds a worker to its group (numactl), or [] when binding happens in-process."""
+    numactl = shutil.which("numactl")
+    if mode == "numactl" and numactl is None:
+        raise RuntimeError("--bind numactl requested but numactl is not installed")
+    if mode not in ("auto", "numactl") or numactl is None or not group["cpus"]:
+        return []
+    command = [numactl, f"--physcpubind={format_cpulist(group['cpus'])}"]
+    if group["node"] is not None:
+        command.append(f"--membind={group['node']}")
+    return command
+
+
+class WorkerProcess:
+    """One pinned worker subprocess and the futures of its in-flight requests."""
+
+    def __init__(self, index: int, group: dict, command: list):
+        self.index = index
+        self.group = group
+        self.info = {}
+        self.completed = 0
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+        self._reader = threading.Thread(target=self._read, name=f"numa-worker-{index}", daemon=True)
+        self._reader.start()
+
+    @property
+    def outstanding(self) -> int:
+        return len(self._futures)
+
+    def wait_ready(self, timeout: float = None) -> dict:
+        if not self._ready.wait(timeout) or not self.info:
+            raise RuntimeError(f"Worker {self.index} ({self.group}) failed to start")
+        return self.info
+
+    def submit(self, request_id: int, payload: dict) -> Future:
+        future = Future()
+        with self._lock:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Worker {self.index} exited with code {self.process.returncode}")
+            self._futures[request_id] = future
+            self.process.stdin.write(json.dumps(dict(payload, id=request_id)) + "\n")
+        return future
+
+    def close(self) -> None:
+        """Stop accepting requests; the worker exits after answering the in-flight ones."""
+        with self._lock:
+            if not self.process.stdin.closed:
+                self.process.stdin.close()
+        self.process.wait()
+        self._reader.join()
+
+    def _read(self) -> None:
+        for line in self.process.stdout:
+            message = json.loads(line)
+            if "ready" in message:
+                self.info = message
+                self._ready.set()
+                continue
+            with self._lock:
+                future = self._futures.pop(message.pop("id"))
+            if "error" in message:
+                future.set_exception(RuntimeError(f"worker {self.index}: {message['error']}"))
+            else:
+                self.completed += 1
+                future.set_result(dict(message, worker=self.index))
+        self._ready.set()
+        with self._lock:
+            futures, self._futures = list(self._futures.values()), {}
+        for future in futures:
+            future.set_exception(RuntimeError(f"Worker {self.index} exited with code {self.process.wait()}"))
+
+
+class NumaLauncher:
+    """Start one worker per core group and dispatch requests to the least-loaded one."""
+
+    def __init__(self, groups, worker_args: list, bind: str = "auto"):
+        self.groups = groups
+        self.workers = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        for index, group in enumerate(groups):
+            command = bind_command(group, bind) + [sys.executable, str(Path(__file__).resolve()), "--serve"]
+            command += worker_args + ["--cpus", format_cpulist(group["cpus"])]
+            if group["node"] is not None:
+                command += ["--node", str(group["node"])]
+            if bind == "none":
+                command.append("--no-pin")
+            self.workers.append(WorkerProcess(index, group, command))
+
+    def wait_ready(self, timeout: float = None) -> list:
+        return [worker.wait_ready(timeout) for worker in self.workers]
+
+    def submit(
+        self,
+        prompt_ids,
+        sampling: SamplingParams = None,
+        stop_criteria: StopCriteria = None,
+        prefix_length: int = None,
+    ) -> Future:
+        """Queue a prompt on the worker with the fewest in-flight requests per CPU; resolves to worker.py's result dict."""
+        sampling = sampling or SamplingParams()
+        payload = {"prompt_ids": [int(t) for t in prompt_ids], "prefix_length": prefix_length, "sampling": vars(sampling)}
+        if stop_criteria is not None:
+            payload["stop"] = {
+                "eos_token_ids": sorted(stop_criteria.eos_token_ids),
+                "stop_sequences": stop_criteria.stop_sequences,
+                "max_new_tokens": stop_criteria.max_new_tokens,
+            }
+        with self._lock:
+            worker = min(self.workers, key=lambda w: ((w.outstanding + 1) / len(w.group["cpus"]), w.index))
+            return worker.submit(next(self._ids), payload)
+
+    def close(self) -> None:
+        for worker in self.workers:
+            worker.close()
+
+
+def serve(args) -> int:
+    """Worker side: read requests from stdin, answer on stdout, exit at EOF once idle."""
+    from onnx_engine import ModelGeometry
+    from prefix_cache import PrefixCache
+    from worker import InferenceWorker
+
+    protocol = sys.stdout
+    sys.stdout = sys.stderr  # keep stray prints off the protocol stream
+    cpus = parse_cpulist(args.cpus)
+    if not args.no_pin:
+        pin_process(cpus)
+    start = time.perf_counter()
+    sess = create_session(
+        args.model,
+        args.opt_level,
+        cache_dir=None if args.no_ort_cache else args.ort_cache_dir,
+        shared_weights=args.shared_weights,
+        threads={"intra_op_num_threads": args.threads or len(cpus)},
+    )
+    prefix_cache = PrefixCache(int(args.prefix_cache_mb * 2**20)) if args.prefix_cache_mb > 0 else None
+    worker = InferenceWorker(
+        sess,
+        args.slots,
+        args.max_length,
+        ModelGeometry.from_session(sess),
+        args.eos_token_id,
+        prefill_chunk=args.prefill_chunk,
+        prefix_cache=prefix_cache,
+    ).start()
+    lock = threading.Lock()
+
+    def reply(message: dict) -> None:
+        with lock:
+            protocol.write(json.dumps(message) + "\n")
+            protocol.flush()
+
+    def on_done(request_id, future) -> None:
+        try:
+            reply(dict(future.result(), id=request_id))
+        except Exception as exc:  # noqa: BLE001
+            reply({"id": request_id, "error": str(exc)})
+
+    reply({"ready": True, "pid": os.getpid(), "node": args.node, "cpus": cpus, "load_s": time.perf_counter() - start})
+    in_flight = []
+    for line in sys.stdin:
+        message = json.loads(line)
+        request_id = message["id"]
+        try:
+            stop = message.get("stop")
+            request = worker.submit(
+                message["prompt_ids"],
+                SamplingParams(**message["sampling"]),
+                StopCriteria(**stop) if stop else None,
+                message.get("prefix_length"),
+            )
+        except Exception as exc:  # noqa: BLE001
+            reply({"id": request_id, "error": str(exc)})
+            continue
+        request.future.add_done_callback(lambda future, request_id=request_id: on_done(request_id, future))
+        in_flight.append(request.future)
+    for future in in_flight:
+        future.exception()
+    worker.stop()
+    return 0
+
+
+def replay(launcher: NumaLauncher, prompts, stop_criteria, prefix_length, args) -> dict:
+    rng = np.random.default_rng(args.seed)
+    start = time.perf_counter()
+    futures = []
+    for index, prompt in enumerate(prompts):
+        sampling = SamplingParams.from_args(args)
+        if args.seed is not None:
+            sampling.seed = args.seed + index
+        futures.append(launcher.submit(prompt, sampling, stop_criteria, prefix_length))
+        if args.rate > 0:
+            time.sleep(rng.exponential(1.0 / args.rate))
+    results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    latencies = [r["latency_s"] for r in results]
+    generated = sum(r["generated_tokens"] for r in results)
+    return {
+        "requests": len(results),
+        "generated": generated,
+        "tokens_per_s": generated / elapsed,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "per_worker": [worker.completed for worker in launcher.workers],
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="NUMA-aware multi-instance ONNX worker launcher (replay benchmark).")
+    parser.add_argument(
+        "--model",
+        default="epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx",
+        help="Path to ONNX model",
+    )
+    parser.add_argument(
+        "--tokenizer",
+        default=None,
+        help="Path to tokenizer directory (defaults to model's parent directory)",
+    )
+    parser.add_argument(
+        "--episodes",
+        default=str(Path(__file__).resolve().parents[2] / "datasets" / "dataset_epicrisis_350_completo.jsonl"),
+        help="Episodes (.jsonl with compact 'input' or .json)",
+    )
+    parser.add_argument("--limit", type=int, default=32, help="Number of requests to replay")
+    parser.add_argument("--workers-per-node", type=int, default=1, help="Core groups (workers) per NUMA node")
+    parser.add_argument(
+        "--core-groups",
+        nargs="+",
+        default=None,
+        metavar="CPULIST",
+        help="Explicit worker core groups, e.g. 0-15 16-31 (overrides --workers-per-node)",
+    )
+    parser.add_argument(
+        "--bind",
+        choices=BIND_MODES,
+        default="auto",
+        help="numactl CPU+memory binding, in-process affinity only, or none (auto: numactl if installed)",
+    )
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads per worker (default: its CPU count)")
+    parser.add_argument("--baseline", action="store_true", help="First replay on one unpinned worker using all CPUs")
+    parser.add_argument("--slots", type=int, default=4, help="Concurrent decode slots per worker")
+    parser.add_argument("--rate", type=float, default=0.0, help="Mean arrivals per second (0 = all at once)")
+    parser.add_argument("--max-new-tokens", type=int, default=128, help="New-token budget per request")
+    parser.add_argument("--temperature", type=float, default=0.0, help="Sampling temperature (0 = greedy)")
+    parser.add_argument("--top-k", type=int, default=0, help="Top-k sampling (0 = disabled)")
+    parser.add_argument("--top-p", type=float, default=0.0, help="Top-p (nucleus) sampling (0 = disabled)")
+    parser.add_argument("--min-p", type=float, default=0.0, help="Min-p sampling (0 = disabled)")
+    parser.add_argument("--repetition-penalty", type=float, default=1.0, help="Repetition penalty (>1.0 applies)")
+    parser.add_argument("--no-eos", action="store_true", help="Prevent eos_token_id from being selected")
+    parser.add_argument("--seed", type=int, default=None, help="Base seed (request i uses seed + i)")
+    parser.add_argument("--prefill-chunk", type=int, default=None, help="Prompt tokens prefilled per scheduler tick")
+    parser.add_argument("--prefix-cache-mb", type=float, default=0.0, help="KV prefix cache per worker (0 = disabled)")
+    add_session_arguments(parser)
+    # Worker-side options, set by the launcher.
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--node", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--cpus", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--no-pin", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--max-length", type=int, default=2048, help=argparse.SUPPRESS)
+    parser.add_argument("--eos-token-id", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args)
+
+    try:
+        from transformers import AutoTokenizer
+    except Exception as exc:
+        raise RuntimeError("transformers is required for the launcher replay") from exc
+
+    tokenizer_dir = args.tokenizer or Path(args.model).parent.parent
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir)
+    style = load_prompt_style(args.model)
+    prompts = [
+        tokenizer.encode(build_chatml_prompt(episode, style), add_special_tokens=False)
+        for episode in load_episodes(args.episodes, args.limit)
+    ]
+    prefix_length = len(tokenizer.encode(chatml_prefix(), add_special_tokens=False))
+    stop_criteria = StopCriteria.from_tokenizer(tokenizer, max_new_tokens=args.max_new_tokens)
+    max_length = max(len(p) for p in prompts) + args.max_new_tokens
+
+    worker_args = [
+        "--model", str(args.model),
+        "--opt-level", args.opt_level,
+        "--ort-cache-dir", str(args.ort_cache_dir),
+        "--slots", str(args.slots),
+        "--max-length", str(max_length),
+        "--prefix-cache-mb", str(args.prefix_cache_mb),
+    ]
+    worker_args += ["--no-ort-cache"] if args.no_ort_cache else []
+    worker_args += ["--shared-weights"] if args.shared_weights else []
+    worker_args += ["--threads", str(args.threads)] if args.threads else []
+    worker_args += ["--prefill-chunk", str(args.prefill_chunk)] if args.prefill_chunk else []
+    worker_args += ["--eos-token-id", str(tokenizer.eos_token_id)] if tokenizer.eos_token_id is not None else []
+    if not args.no_ort_cache:
+        # Build the optimized-graph cache once instead of optimizing the graph in every worker.
+        create_session(args.model, args.opt_level, cache_dir=args.ort_cache_dir, threads={})
+
+    nodes = numa_nodes()
+    layouts = []
+    if args.baseline:
+        layouts.append(("baseline", [{"node": None, "cpus": allowed_cpus()}], "none"))
+    layouts.append(("numa", core_groups(nodes, args.workers_per_node, args.core_groups), args.bind))
+    print("NUMA nodes: " + ", ".join(f"node{node['node']}={format_cpulist(node['cpus'])}" for node in nodes))
+
+    for name, groups, bind in layouts:
+        launcher = NumaLauncher(groups, worker_args, bind)
+        try:
+            for info in launcher.wait_ready():
+                print(
+                    f"  [{name}] worker pid={info['pid']} node={info['node']} "
+                    f"cpus={format_cpulist(info['cpus'])} load={info['load_s']:.1f}s"
+                )
+            stats = replay(launcher, prompts, stop_criteria, prefix_length, args)
+        finally:
+            launcher.close()
+        binding = bind if bind != "auto" else ("numactl" if bind_command(groups[0]) else "affinity")
+        print(
+            f"{name}: workers={len(groups)} bind={binding} requests={stats['requests']} "
+            f"generated={stats['generated']} tokens/s={stats['tokens_per_s']:.1f} "
+            f"latency p50={stats['p50_s']:.2f}s p95={stats['p95_s']:.2f}s per_worker={stats['per_worker']}"
+        )
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,406 @@
+"""
+IOBinding-backed decode engine for optimum-style decoder ONNX exports.
+
+The graphs exported by optimum / transformers.js take `past_key_values.{i}.key|value`
+with shape [batch, kv_heads, past, head_dim] and return `present.{i}.key|value`
+with shape [batch, kv_heads, past + seq, head_dim] (Concat inside the graph).
+
+Instead of building a feeds dict and collecting fresh output arrays every step,
+the engine allocates two flat KV buffers per tensor once, sized for `max_length`,
+and binds them through `IOBinding`: step N reads `past` from one buffer and ORT
+writes `present` straight into the other, then the roles swap. Only the
+last-position logits are copied out of the run.
+
+Graphs rewritten by conversion/last_token_logits.py take a `num_logits_to_keep`
+input and slice the hidden states before `lm_head`; the engine binds it to 1,
+so prefill also writes [batch, 1, vocab] into the preallocated logits buffer
+instead of materializing logits for every prompt position.
+
+Layer count, KV heads, head dim and KV dtype are read from the session input
+metadata (ModelGeometry), so the same engine serves the 1.5B and 0.5B Qwen
+exports and fp16-KV exports (transformers.js `kv_cache_dtype: float16`).
+"""
+
+import json
+import re
+from pathlib import Path
+
+import numpy as np
+import onnxruntime as ort
+
+ORT_DTYPES = {
+    "tensor(float)": np.float32,
+    "tensor(float16)": np.float16,
+}
+
+PAST_KEY_PATTERN = re.compile(r"^past_key_values\.(\d+)\.key$")
+LOGITS_TO_KEEP_NAME = "num_logits_to_keep"
+
+
+def _bind(io: ort.IOBinding, name: str, array: np.ndarray, output: bool = False) -> None:
+    if not array.flags.c_contiguous:
+        raise ValueError(f"Binding for {name} must be C-contiguous")
+    bind = io.bind_output if output else io.bind_input
+    bind(
+        name,
+        device_type="cpu",
+        device_id=0,
+        element_type=array.dtype.type,
+        shape=array.shape,
+        buffer_ptr=array.ctypes.data,
+    )
+
+
+class ModelGeometry:
+    """Decoder shape parameters needed to size the KV cache."""
+
+    def __init__(self, num_layers: int, num_kv_heads: int, head_dim: int, kv_dtype=np.float32, logits_dtype=np.float32):
+        self.num_layers = num_layers
+        self.num_kv_heads = num_kv_heads
+        self.head_dim = head_dim
+        self.kv_dtype = np.dtype(kv_dtype)
+        self.logits_dtype = np.dtype(logits_dtype)
+
+    @property
+    def kv_bytes_per_token(self) -> int:
+        return 2 * self.num_layers * self.num_kv_heads * self.head_dim * self.kv_dtype.itemsize
+
+    def __repr__(self) -> str:
+        return (
+            f"ModelGeometry(layers={self.num_layers}, kv_heads={self.num_kv_heads}, "
+            f"head_dim={self.head_dim}, kv_dtype={self.kv_dtype.name}, logits_dtype={self.logits_dtype.name})"
+        )
+
+    @classmethod
+    def from_session(cls, sess: ort.InferenceSession, config_path=None) -> "ModelGeometry":
+        """
+        Derive geometry from `past_key_values.*` input metadata.
+
+        Symbolic kv_heads/head_dim dims fall back to the HF config.json
+        (num_key_value_heads, hidden_size / num_attention_heads).
+        """
+        inputs = {i.name: i for i in sess.get_inputs()}
+        layers = [int(m.group(1)) for m in map(PAST_KEY_PATTERN.match, inputs) if m]
+        if not layers:
+            raise RuntimeError("No past_key_values.*.key inputs found; model was exported without KV cache.")
+        num_layers = max(layers) + 1
+
+        past = inputs["past_key_values.0.key"]
+        kv_dtype = ORT_DTYPES.get(past.type)
+        if kv_dtype is None:
+            raise RuntimeError(f"Unsupported KV cache type: {past.type}")
+        _, num_kv_heads, _, head_dim = past.shape
+
+        if not isinstance(num_kv_heads, int) or not isinstance(head_dim, int):
+            if config_path is None or not Path(config_path).exists():
+                raise RuntimeError("KV head dims are symbolic in the graph; pass the model config.json.")
+            config = json.loads(Path(config_path).read_text(encoding="utf-8"))
+            num_kv_heads = config.get("num_key_value_heads", config["num_attention_heads"])
+            head_dim = config.get("head_dim") or config["hidden_size"] // config["num_attention_heads"]
+
+        logits = next((o for o in sess.get_outputs() if "logits" in o.name), None)
+        logits_dtype = ORT_DTYPES.get(logits.type, np.float32) if logits is not None else np.float32
+        return cls(num_layers, num_kv_heads, head_dim, kv_dtype, logits_dtype)
+
+
+class KVCache:
+    """Two preallocated flat buffers per past/present tensor, used ping-pong."""
+
+    def __init__(
+        self,
+        num_layers: int,
+        batch: int,
+        num_kv_heads: int,
+        head_dim: int,
+        max_length: int,
+        dtype=np.float32,
+    ):
+        self.num_layers = num_layers
+        self.capacity = batch
+        self.batch = batch
+        self.num_kv_heads = num_kv_heads
+        self.head_dim = head_dim
+        self.max_length = max_length
+        self.dtype = np.dtype(dtype)
+        size = batch * num_kv_heads * max_length * head_dim
+        # [buffer, layer, key/value, flat]
+        self._buffers = np.zeros((2, num_layers, 2, size), dtype=self.dtype)
+        self._front = 0
+        self.length = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self._buffers.nbytes
+
+    def view(self, layer: int, kind: int, length: int, back: bool = False) -> np.ndarray:
+        """Contiguous [batch, kv_heads, length, head_dim] view of one buffer."""
+        buffer = self._front ^ 1 if back else self._front
+        count = self.batch * self.num_kv_heads * length * self.head_dim
+        flat = self._buffers[buffer, layer, kind, :count]
+        return flat.reshape(self.batch, self.num_kv_heads, length, self.head_dim)
+
+    def swap(self, new_length: int) -> None:
+        self._front ^= 1
+        self.length = new_length
+
+    def reset(self, length: int = 0, batch: int = None) -> None:
+        self.batch = self.capacity if batch is None else batch
+        self._buffers[self._front, :, :, : self.batch * self.num_kv_heads * length * self.head_dim] = 0
+        self.length = length
+
+    def select(self, rows, start: int = 0, end: int = None) -> None:
+        """Keep only `rows` and positions [start, end) (start: shared left padding, end: rollback)."""
+        rows = np.asarray(rows, dtype=np.int64)
+        end = self.length if end is None else end
+        new_length = end - start
+        for layer in range(self.num_layers):
+            for kind in range(2):
+                kept = self.view(layer, kind, self.length)[rows, :, start:end, :]
+                count = len(rows) * self.num_kv_heads * new_length * self.head_dim
+                back = self._buffers[self._front ^ 1, layer, kind, :count]
+                back.reshape(kept.shape)[...] = kept
+        self.batch = len(rows)
+        self.swap(new_length)
+
+    def snapshot(self, length: int) -> np.ndarray:
+        """Copy the first `length` positions of a single-row cache as [layers, 2, kv_heads, length, head_dim]."""
+        if self.batch != 1 or length > self.length:
+            raise ValueError("Snapshots need a single-row cache holding at least `length` positions")
+        kv = np.empty((self.num_layers, 2, self.num_kv_heads, length, self.head_dim), dtype=self.dtype)
+        for layer in range(self.num_layers):
+            for kind in range(2):
+                kv[layer, kind] = self.view(layer, kind, self.length)[0, :, :length]
+        return kv
+
+    def load(self, kv: np.ndarray) -> None:
+        """Replace the contents with a single-row snapshot from `snapshot()`."""
+        length = kv.shape[3]
+        self.batch = 1
+        for layer in range(self.num_layers):
+            for kind in range(2):
+                self.view(layer, kind, length)[0] = kv[layer, kind]
+        self.length = length
+
+    def append_row(self, source: "KVCache") -> None:
+        """Append the single row of `source` as a new last row, left-padding the shorter side."""
+        if self.batch >= self.capacity:
+            raise ValueError(f"KV cache is full ({self.capacity} rows)")
+        length = max(self.length, source.length)
+        shift = length - self.length
+        offset = length - source.length
+        shape = (self.batch + 1, self.num_kv_heads, length, self.head_dim)
+        for layer in range(self.num_layers):
+            for kind in range(2):
+                back = self._buffers[self._front ^ 1, layer, kind, : int(np.prod(shape))].reshape(shape)
+                back[: self.batch, :, :shift] = 0
+                back[: self.batch, :, shift:] = self.view(layer, kind, self.length)
+                back[self.batch, :, :offset] = 0
+                back[self.batch, :, offset:] = source.view(layer, kind, source.length)[0]
+        self.batch += 1
+        self.swap(length)
+
+
+class DecodeEngine:
+    """
+    Runs prefill/decode steps through IOBinding over a preallocated KVCache.
+
+    Rows may be left-padded: `attention_mask` marks real tokens per row and
+    position ids continue from each row's own length. `retain()` drops
+    finished rows between steps and `admit()` appends a row prefilled on a
+    single-row engine (continuous batching). `prefill()` splits long prompts
+    into fixed-size chunks that grow the cache incrementally, and
+    `snapshot_prefix()` / `restore_prefix()` move shared prompt prefixes in
+    and out of a PrefixCache.
+    """
+
+    def __init__(
+        self,
+        sess: ort.InferenceSession,
+        max_length: int,
+        geometry: ModelGeometry = None,
+        batch: int = 1,
+    ):
+        self.sess = sess
+        self.batch = batch
+        self.max_length = max_length
+        self.geometry = geometry or ModelGeometry.from_session(sess)
+
+        outputs_meta = {o.name: o for o in sess.get_outputs()}
+        self.logits_name = next((name for name in outputs_meta if "logits" in name), None)
+        if not self.logits_name:
+            raise RuntimeError("No logits output found in ONNX graph.")
+        vocab = outputs_meta[self.logits_name].shape[-1]
+        self.vocab_size = vocab if isinstance(vocab, int) else None
+        # The rewritten graph declares it with a default value, so ORT lists it as an overridable initializer.
+        self.last_token_logits = any(
+            i.name == LOGITS_TO_KEEP_NAME for i in [*sess.get_inputs(), *sess.get_overridable_initializers()]
+        )
+        self._logits_to_keep = np.ones((), dtype=np.int64)
+
+        self.past_names = []
+        self.present_names = []
+        for layer in range(self.geometry.num_layers):
+            for kind in ("key", "value"):
+                past_name = f"past_key_values.{layer}.{kind}"
+                present_name = f"present.{layer}.{kind}"
+                if present_name not in outputs_meta:
+                    raise RuntimeError(f"Missing output {present_name} in ONNX graph.")
+                self.past_names.append(past_name)
+                self.present_names.append(present_name)
+
+        geo = self.geometry
+        self.cache = KVCache(geo.num_layers, batch, geo.num_kv_heads, geo.head_dim, max_length, geo.kv_dtype)
+        self._io = sess.io_binding()
+        self._input_ids = np.zeros(batch * max_length, dtype=np.int64)
+        self._attention_mask = np.ones(batch * max_length, dtype=np.int64)
+        self.attention_mask = np.ones((batch, max_length), dtype=np.int64)
+        self.seq_lengths = np.zeros(batch, dtype=np.int64)
+        self._position_ids = np.zeros(batch * max_length, dtype=np.int64)
+        self._step_logits = None
+        if self.vocab_size:
+            self._step_logits = np.empty((batch, 1, self.vocab_size), dtype=geo.logits_dtype)
+
+    def reset(self, past_length: int = 0, batch: int = None) -> None:
+        self.cache.reset(past_length, batch)
+        self.batch = self.cache.batch
+        self.attention_mask[:, :past_length] = 1
+        self.seq_lengths[:] = past_length
+
+    def retain(self, rows) -> None:
+        """Keep only `rows` of the current batch, trimming padding columns no kept row needs."""
+        rows = np.asarray(rows, dtype=np.int64)
+        length = self.cache.length
+        mask = self.attention_mask[rows, :length]
+        valid = mask.any(axis=0)
+        start = int(np.argmax(valid)) if valid.any() else length
+        self.attention_mask[: len(rows), : length - start] = mask[:, start:]
+        self.seq_lengths[: len(rows)] = self.seq_lengths[rows]
+        self.cache.select(rows, start)
+        self.batch = len(rows)
+
+    def admit(self, source: "DecodeEngine") -> int:
+        """Append the prefilled single-row state of `source` as a new row; return its index."""
+        if source.batch != 1:
+            raise ValueError("Only single-row engines can be admitted")
+        length = self.cache.length if self.batch else 0
+        new_length = max(length, source.cache.length)
+        if new_length > self.max_length:
+            raise ValueError(f"Sequence length {new_length} exceeds max_length={self.max_length}")
+        shift = new_length - length
+        offset = new_length - source.cache.length
+        row = self.batch
+        self.attention_mask[:row, shift:new_length] = self.attention_mask[:row, :length].copy()
+        self.attention_mask[:row, :shift] = 0
+        self.attention_mask[row, :offset] = 0
+        self.attention_mask[row, offset:new_length] = source.attention_mask[0, : source.cache.length]
+        self.seq_lengths[row] = source.seq_lengths[0]
+        if not self.batch:
+            self.cache.length = 0
+        self.cache.append_row(source.cache)
+        self.batch += 1
+        return row
+
+    def truncate(self, length: int) -> None:
+        """Drop cached positions from `length` on (e.g. rejected speculative tokens)."""
+        if length >= self.cache.length:
+            return
+        self.seq_lengths[: self.batch] -= self.attention_mask[: self.batch, length : self.cache.length].sum(axis=1)
+        # The flat [batch, heads, length, head_dim] layout depends on length, so rows are repacked.
+        self.cache.select(np.arange(self.batch), 0, length)
+
+    def snapshot_prefix(self, length: int) -> np.ndarray:
+        """KV of the first `length` positions of an unpadded single-row engine (for PrefixCache)."""
+        if not self.attention_mask[0, :length].all():
+            raise ValueError("Prefix snapshots need an unpadded row")
+        return self.cache.snapshot(length)
+
+    def restore_prefix(self, kv: np.ndarray) -> None:
+        """Start a single-row sequence from a `snapshot_prefix()` result; prefill continues after it."""
+        length = kv.shape[3]
+        if length > self.max_length:
+            raise ValueError(f"Prefix length {length} exceeds max_length={self.max_length}")
+        self.cache.load(kv)
+        self.batch = 1
+        self.attention_mask[0, :length] = 1
+        self.seq_lengths[0] = length
+
+    def prefill(self, input_ids: np.ndarray, attention_mask: np.ndarray = None, chunk_size: int = None) -> np.ndarray:
+        """
+        Feed a prompt [batch, seq] in chunks of `chunk_size` positions; return last-position logits.
+
+        Each chunk attends to the KV written by the previous ones, so the result
+        matches a single forward while activations (and full-sequence logits)
+        are bounded by the chunk size.
+        """
+        seq_len = input_ids.shape[1]
+        chunk_size = chunk_size or seq_len
+        for start in range(0, seq_len, chunk_size):
+            chunk_mask = None if attention_mask is None else attention_mask[:, start : start + chunk_size]
+            logits = self.forward(input_ids[:, start : start + chunk_size], chunk_mask)
+        return logits
+
+    def forward(self, input_ids: np.ndarray, attention_mask: np.ndarray = None, num_logits: int = None) -> np.ndarray:
+        """
+        Run one step over `input_ids` [batch, seq]; return last-position logits [batch, vocab].
+
+        `attention_mask` [batch, seq] marks padding in the new tokens (left padding on prefill).
+        With `num_logits`, return the last `num_logits` positions [batch, num_logits, vocab]
+        instead (verification of several drafted tokens in one run).
+        """
+        batch, seq_len = input_ids.shape
+        if batch != self.batch:
+            raise ValueError(f"Engine holds batch={self.batch}, got {batch}")
+        past = self.cache.length
+        total = past + seq_len
+        if total > self.max_length:
+            raise ValueError(f"Sequence length {total} exceeds max_length={self.max_length}")
+
+        io = self._io
+        io.clear_binding_inputs()
+        io.clear_binding_outputs()
+
+        ids = self._input_ids[: batch * seq_len].reshape(batch, seq_len)
+        ids[...] = input_ids
+        _bind(io, "input_ids", ids)
+
+        positions = self._position_ids[: batch * seq_len].reshape(batch, seq_len)
+        if attention_mask is None:
+            self.attention_mask[:batch, past:total] = 1
+            positions[...] = self.seq_lengths[:batch, None] + np.arange(seq_len, dtype=np.int64)
+            self.seq_lengths[:batch] += seq_len
+        else:
+            self.attention_mask[:batch, past:total] = attention_mask
+            offsets = np.cumsum(attention_mask, axis=1) - 1
+            positions[...] = np.where(attention_mask > 0, self.seq_lengths[:batch, None] + offsets, 1)
+            self.seq_lengths[:batch] += attention_mask.sum(axis=1)
+
+        mask = self._attention_mask[: batch * total].reshape(batch, total)
+        mask[...] = self.attention_mask[:batch, :total]
+        _bind(io, "attention_mask", mask)
+        _bind(io, "position_ids", positions)
+        keep = num_logits or 1
+        if self.last_token_logits:
+            self._logits_to_keep[...] = keep
+            _bind(io, LOGITS_TO_KEEP_NAME, self._logits_to_keep)
+
+        for index, (past_name, present_name) in enumerate(zip(self.past_names, self.present_names)):
+            layer, kind = divmod(index, 2)
+            _bind(io, past_name, self.cache.view(layer, kind, past))
+            _bind(io, present_name, self.cache.view(layer, kind, total, back=True), output=True)
+
+        if keep == 1 and (seq_len == 1 or self.last_token_logits) and self._step_logits is not None:
+            logits = self._step_logits[:batch]
+            _bind(io, self.logits_name, logits, output=True)
+            self.sess.run_with_iobinding(io)
+        else:
+            io.bind_output(self.logits_name, "cpu")
+            self.sess.run_with_iobinding(io)
+            logits = io.get_outputs()[-1].numpy()
+            if self._step_logits is None:
+                self.vocab_size = logits.shape[-1]
+                self._step_logits = np.empty((self.cache.capacity, 1, self.vocab_size), dtype=self.geometry.logits_dtype)
+
+        self.cache.swap(total)
+        if num_logits is None:
+            return logits[:, -1, :].astype(np.float32)
+        return logits[:, -num_logits:, :].astype(np.float32)
@@ -14,15 +14,42 @@ Usage:
     --use-chat-template
 
 Notes:
-- Disables graph optimizations to avoid SimplifiedLayerNormFusion error in ORT.
-- past_key_values inputs are float32 (per model input types).
+- Graph optimizations run at --opt-level (default extended) with only
+  SimplifiedLayerNormFusion disabled; the optimized graph is cached
+  (see ort_session.py). --opt-level disable restores the old behaviour.
+- Layer count, KV heads, head dim and KV dtype (float32/float16) are read from
+  the model inputs, so fp16-KV and 0.5B exports run unchanged.
+- KV cache is preallocated for prompt + steps and bound through IOBinding
+  (see onnx_engine.py), so decode steps do not allocate.
+- Models rewritten by conversion/last_token_logits.py (`num_logits_to_keep`
+  input) only compute last-position logits on prefill; the run prints prefill
+  latency and peak RSS so both variants can be compared.
+- --prefill-chunk N feeds the prompt N tokens per sess.run, growing the KV
+  cache incrementally; activation memory is bounded by N instead of the
+  prompt length.
+- --stream prints text as it is generated (streaming.py: incremental
+  detokenization, stop strings held back until resolved).
+- --prompt-lookup K drafts up to K tokens per step by n-gram lookup in the
+  prompt (and the generate_narrative skeleton when the user message holds the
+  episode JSON) and verifies them in one forward (speculative.py).
+- Generation stops on EOS (<|im_end|>), on any --stop string (matched on
+  token ids through a trie) or after --max-new-tokens (default: --steps).
 - If --decode is set or --prompt is used, requires transformers to be installed.
 """
 
 import argparse
+import time
 from pathlib import Path
 import numpy as np
-import onnxruntime as ort
+
+from onnx_engine import DecodeEngine, ModelGeometry
+from ort_session import add_session_arguments, session_from_args
+from logits_processors import BatchSamplingParams, LogitsPipeline, TokenHistory
+from sampling import SamplingParams
+from shared_weights import memory_usage, peak_rss_mb
+from stopping import QWEN_EOS_TOKEN_ID, StopCriteria
+from speculative import PromptLookupDrafter, narrative_skeletons, payload_from_text, speculative_generate
+from streaming import IncrementalDetokenizer, stream_generate, stream_text
 
 
 def main() -> int:
@@ -40,6 +67,18 @@ def main() -> int:
     parser.add_argument("--seq-len", type=int, default=1, help="Current sequence length")
     parser.add_argument("--past-seq", type=int, default=0, help="Past sequence length")
     parser.add_argument("--steps", type=int, default=1, help="Autoregressive steps to run")
+    parser.add_argument(
+        "--max-new-tokens",
+        type=int,
+        default=None,
+        help="New-token budget (defaults to --steps)",
+    )
+    parser.add_argument(
+        "--stop",
+        action="append",
+        default=[],
+        help="Stop string (repeatable); matched on token ids, requires a tokenizer",
+    )
     parser.add_argument("--prompt", default=None, help="Optional plain text prompt")
     parser.add_argument("--system", default=None, help="System message (chat template)")
     parser.add_argument("--user", default=None, help="User message (chat template)")
@@ -86,6 +125,12 @@ def main() -> int:
         default=0.0,
         help="Top-p (nucleus) sampling (0 = disabled)",
     )
+    parser.add_argument(
+        "--min-p",
+        type=float,
+        default=0.0,
+        help="Min-p sampling: drop tokens below min_p * p(top token) (0 = disabled)",
+    )
     parser.add_argument(
         "--repetition-penalty",
         type=float,
@@ -98,15 +143,40 @@ def main() -> int:
         default=None,
         help="Random seed for sampling",
     )
+    parser.add_argument(
+        "--prefill-chunk",
+        type=int,
+        default=None,
+        help="Prefill the prompt in chunks of this many tokens (default: whole prompt)",
+    )
+    parser.add_argument(
+        "--prompt-lookup",
+        type=int,
+        default=0,
+        help="Speculative decoding: draft up to this many tokens from prompt n-grams (0 = disabled)",
+    )
     parser.add_argument("--decode", action="store_true", help="Decode tokens to text")
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Print decoded text deltas as tokens are generated (requires a tokenizer)",
+    )
+    parser.add_argument(
+        "--profile-sampling",
+        action="store_true",
+        help="Print per-stage sampling time against sess.run time",
+    )
+    add_session_arguments(parser)
     args = parser.parse_args()
+    if (args.max_new_tokens if args.max_new_tokens is not None else args.steps) < 1:
+        parser.error("--max-new-tokens/--steps must be at least 1")
 
     tokenizer = None
-    if args.decode or args.prompt is not None:
+    if args.decode or args.stream or args.prompt is not None:
         try:
             from transformers import AutoTokenizer
         except Exception as exc:
-            raise RuntimeError("transformers is required for --decode/--prompt") from exc
+            raise RuntimeError("transformers is required for --decode/--stream/--prompt") from exc
 
         if args.tokenizer:
             tokenizer_dir = args.tokenizer
@@ -119,16 +189,13 @@ def main() -> int:
         if tokenizer.eos_token_id is not None and tokenizer.eos_token_id != 151645:
             raise RuntimeError(f"Unexpected eos_token_id: {tokenizer.eos_token_id}")
 
-    so = ort.SessionOptions()
-    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
-
-    sess = ort.InferenceSession(args.model, sess_options=so, providers=["CPUExecutionProvider"])
+    sess = session_from_args(args, args.model)
 
-    batch = 1
     seq_len = args.seq_len
     past_seq = args.past_seq
-    num_kv_heads = 2
-    head_dim = 128
+    config_path = Path(args.tokenizer or Path(args.model).parent.parent) / "config.json"
+    geometry = ModelGeometry.from_session(sess, config_path=config_path)
+    print(f"geometry: {geometry} kv_bytes_per_token={geometry.kv_bytes_per_token}")
 
     if args.use_chat_template and (args.system or args.user):
         if not tokenizer:
@@ -190,92 +257,109 @@ def main() -> int:
     else:
         input_ids = np.array([[1] * seq_len], dtype=np.int64)
 
-    outputs_meta = {o.name: o for o in sess.get_outputs()}
-    logits_name = next((name for name in outputs_meta if "logits" in name), None)
-    if not logits_name:
-        raise RuntimeError("No logits output found in ONNX graph.")
-
-    past_kv = {}
+    budget = args.max_new_tokens if args.max_new_tokens is not None else args.steps
+    engine = DecodeEngine(sess, max_length=past_seq + seq_len + budget + args.prompt_lookup, geometry=geometry)
+    engine.reset(past_seq)
 
     generated_tokens = []
 
     eos_token_id = tokenizer.eos_token_id if tokenizer else None
+    if tokenizer:
+        stop_criteria = StopCriteria.from_tokenizer(tokenizer, args.stop, max_new_tokens=budget)
+    else:
+        if args.stop:
+            raise RuntimeError("--stop requires a tokenizer (use --decode or --prompt).")
+        # Assume the Qwen EOS id when the vocab has it, so --no-eos masks it as it does with a tokenizer.
+        if engine.vocab_size is None or QWEN_EOS_TOKEN_ID < engine.vocab_size:
+            eos_token_id = QWEN_EOS_TOKEN_ID
+        stop_criteria = StopCriteria([eos_token_id] if eos_token_id is not None else [], max_new_tokens=budget)
+    stop = stop_criteria.matcher()
 
-    if args.seed is not None:
-        np.random.seed(args.seed)
-
-    for step in range(args.steps):
-        position_ids = np.arange(past_seq, past_seq + seq_len, dtype=np.int64)
-        feeds = {
-            "input_ids": input_ids,
-            "attention_mask": np.ones((batch, past_seq + seq_len), dtype=np.int64),
-            "position_ids": position_ids.reshape(1, -1),
-        }
+    sampling = SamplingParams.from_args(args)
+    if args.prompt_lookup:
+        sources = [input_ids[0].tolist()]
+        payload = payload_from_text(args.user or args.prompt or "")
+        if tokenizer and payload:
+            sources += [tokenizer.encode(text, add_special_tokens=False) for text in narrative_skeletons(payload)]
+        eos_ids = [eos_token_id] if eos_token_id is not None else []
+        start = time.perf_counter()
+        generated_tokens, stats = speculative_generate(
+            engine,
+            input_ids[0].tolist(),
+            PromptLookupDrafter(sources),
+            stop_criteria,
+            sampling,
+            eos_ids,
+            args.prompt_lookup,
+            args.prefill_chunk,
+        )
+        elapsed = time.perf_counter() - start
+        print(
+            f"speculative: generated={stats['generated']} forwards={stats['forwards']} "
+            f"drafted={stats['drafted']} accepted={stats['accepted']} acceptance={stats['acceptance']:.2f} "
+            f"tokens/forward={stats['tokens_per_forward']:.2f} tokens/s={stats['generated'] / elapsed:.1f}"
+        )
+        if tokenizer:
+            print(f"decoded_text: {tokenizer.decode(generated_tokens, skip_special_tokens=True)}")
+        print("OK")
+        return 0
 
-        for layer in range(28):
-            k_name = f"past_key_values.{layer}.key"
-            v_name = f"past_key_values.{layer}.value"
-            if past_kv:
-                feeds[k_name] = past_kv[k_name]
-                feeds[v_name] = past_kv[v_name]
-            else:
-                feeds[k_name] = np.zeros((batch, num_kv_heads, past_seq, head_dim), dtype=np.float32)
-                feeds[v_name] = np.zeros((batch, num_kv_heads, past_seq, head_dim), dtype=np.float32)
+    if args.stream:
+        eos_ids = [eos_token_id] if eos_token_id is not None else []
+        start = time.perf_counter()
+        first_delta_s = None
+        token_ids = stream_generate(engine, input_ids[0].tolist(), stop_criteria, sampling, eos_ids, args.prefill_chunk)
+        for delta in stream_text(token_ids, IncrementalDetokenizer(tokenizer)):
+            if first_delta_s is None:
+                first_delta_s = time.perf_counter() - start
+            print(delta, end="", flush=True)
+        print()
+        first_delta_ms = (first_delta_s or 0.0) * 1000.0
+        print(f"stream: first_text={first_delta_ms:.1f}ms total={(time.perf_counter() - start) * 1000.0:.1f}ms")
+        print("OK")
+        return 0
 
-        outputs = sess.run(None, feeds)
-        output_map = dict(zip(outputs_meta.keys(), outputs))
-        logits = output_map[logits_name]
+    batch_params = BatchSamplingParams([sampling])
+    rngs = [sampling.rng()]
+    pipeline = LogitsPipeline(eos_token_ids=[eos_token_id] if eos_token_id is not None else [])
+    history = TokenHistory(1, budget)
+    run_s = 0.0
+    prefill_s = None
 
-        last_logits = logits[0, -1].copy()
-        if args.no_eos and eos_token_id is not None:
-            last_logits[eos_token_id] = -1e9
-        if args.repetition_penalty and args.repetition_penalty > 1.0:
-            for token_id in set(generated_tokens):
-                if last_logits[token_id] > 0:
-                    last_logits[token_id] /= args.repetition_penalty
-                else:
-                    last_logits[token_id] *= args.repetition_penalty
-        if args.temperature and args.temperature > 0:
-            last_logits = last_logits / float(args.temperature)
-            if args.top_k and args.top_k > 0:
-                top_k = min(args.top_k, last_logits.shape[0])
-                top_indices = np.argpartition(last_logits, -top_k)[-top_k:]
-                mask = np.full_like(last_logits, -1e9)
-                mask[top_indices] = last_logits[top_indices]
-                last_logits = mask
-            probs = np.exp(last_logits - np.max(last_logits))
-            probs = probs / probs.sum()
-            if args.top_p and args.top_p > 0.0:
-                sorted_idx = np.argsort(probs)[::-1]
-                sorted_probs = probs[sorted_idx]
-                cum_probs = np.cumsum(sorted_probs)
-                cutoff = cum_probs <= args.top_p
-                if not np.any(cutoff):
-                    cutoff[0] = True
-                keep_idx = sorted_idx[cutoff]
-                filtered = np.zeros_like(probs)
-                filtered[keep_idx] = probs[keep_idx]
-                probs = filtered / filtered.sum()
-            next_token = int(np.random.choice(len(probs), p=probs))
+    for step in range(budget):
+        start = time.perf_counter()
+        if prefill_s is None:
+            last_logits = engine.prefill(input_ids, chunk_size=args.prefill_chunk)
         else:
-            next_token = int(np.argmax(last_logits))
+            last_logits = engine.forward(input_ids)
+        elapsed = time.perf_counter() - start
+        if prefill_s is None:
+            prefill_s = elapsed
+        else:
+            run_s += elapsed
+        next_token = int(pipeline.sample(last_logits, history.view(), batch_params, rngs)[0])
+        history.append(next_token)
         generated_tokens.append(next_token)
-        print(f"step {step + 1}: next_token_id={next_token} logits_shape={logits.shape}")
-
-        present = {
-            name: value
-            for name, value in output_map.items()
-            if ("present" in name or "past_key_values" in name)
-            and (name.endswith(".key") or name.endswith(".value"))
-        }
-        past_kv = {}
-        for name, value in present.items():
-            past_name = name.replace("present", "past_key_values")
-            past_kv[past_name] = value
+        print(f"step {step + 1}: next_token_id={next_token} logits_shape={last_logits.shape[1:]}")
+        if stop.update(next_token):
+            break
 
-        past_seq += seq_len
         input_ids = np.array([[next_token]], dtype=np.int64)
-        seq_len = 1
+
+    if stop.reason in ("eos", "stop_sequence"):
+        del generated_tokens[-stop.matched_length :]
+    print(f"stopped: reason={stop.reason} steps={stop.num_tokens} saved_steps={budget - stop.num_tokens}")
+    memory = f"peak_rss={peak_rss_mb():.0f}MB"
+    usage = memory_usage()
+    if usage:
+        memory += f" pss={usage['pss_mb']:.0f}MB private={usage['private_mb']:.0f}MB"
+    print(
+        f"prefill: {prefill_s * 1000.0:.1f}ms prompt_tokens={seq_len} "
+        f"last_token_logits={engine.last_token_logits} {memory}"
+    )
+    if args.profile_sampling:
+        stages = " ".join(f"{name}={ms:.3f}ms" for name, ms in pipeline.report().items())
+        print(f"sess.run={run_s * 1000.0 / max(stop.num_tokens - 1, 1):.3f}ms/token sampling: {stages}")
 
     if tokenizer:
         text = tokenizer.decode(generated_tokens, skip_special_tokens=True)
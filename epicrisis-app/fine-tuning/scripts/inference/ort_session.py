@@ -0,0 +1,401 @@
+"""
+ONNX Runtime session factory with an offline graph-optimization cache.
+
+The runners used ORT_DISABLE_ALL because SimplifiedLayerNormFusion breaks on
+the exported Qwen2 graph, which also throws away constant folding, MatMul+Add,
+GELU and attention fusions. create_session() keeps the optimization level at
+ORT_ENABLE_EXTENDED (or ALL) and disables only the optimizers listed in
+DISABLED_OPTIMIZERS.
+
+The optimized graph is written next to a cache key made of the source model
+fingerprint, the ORT version, the level and the disabled optimizers (plus the
+CPU architecture for ENABLE_ALL, whose layout transforms are hardware
+specific), with prepacked MatMul weights saved as external data. Later
+startups load the cached graph with optimizations off and skip both the
+optimization pass and prepacking.
+
+ORT memory-maps external-data initializers, including prepacked weights
+saved by the cache. Unmodified mapped pages stay in the page cache and are
+shared by every process that loads the same file. Weights prepacked at load
+time are private heap copies instead. With shared_weights=True, sessions
+built without a saved graph skip prepacking (see shared_weights.py).
+
+Thread settings (intra/inter-op threads, execution mode, spinning) and CPU
+affinity come from the tuned profile written by autotune.py
+(`ort_profile.json` next to the model, or $EPICRISIS_ORT_PROFILE) when one
+exists for this machine; otherwise ORT defaults apply. The ORT GenAI runners
+(run_epicrisis_onnx.load_model) get the same threads and spinning policy as
+genai_config.json decoder session_options (genai_session_options); GenAI has
+no execution-mode option, so ORT_PARALLEL profiles run sequentially there.
+
+Models precompiled by conversion/precompile_ort.py (`*.ort`, `*.opt.onnx`)
+are loaded as they are: no optimization pass, no cache; `.ort` initializers
+are used in place from the model buffer.
+
+Usage (per-token latency with and without the fusions):
+  python3 epicrisis-app/fine-tuning/scripts/inference/ort_session.py \\
+    --model epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx \\
+    --levels disable extended all --decode-steps 32
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import time
+import uuid
+import warnings
+from pathlib import Path
+
+import numpy as np
+import onnxruntime as ort
+
+OPT_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+DEFAULT_OPT_LEVEL = "extended"
+DISABLED_OPTIMIZERS = ("SimplifiedLayerNormFusion",)
+DEFAULT_CACHE_DIR = Path(os.environ.get("EPICRISIS_ORT_CACHE", Path.home() / ".cache" / "epicrisis-onnx" / "optimized"))
+# Initializers above this size go to the cached model's external data file.
+EXTERNAL_MIN_BYTES = 1024
+PROFILE_NAME = "ort_profile.json"
+# Measurement workers (autotune.py, shared_weights.py): wait at most this long at a start barrier,
+# and for the whole run.
+BARRIER_TIMEOUT_S = 600
+WORKER_TIMEOUT_S = 3600
+EXECUTION_MODES = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def model_fingerprint(model_path) -> str:
+    """
+    Hash of the model file plus its sibling external-data files.
+
+    The .onnx protobuf is hashed whole (it is small when weights are external);
+    data files contribute name, size and mtime so multi-GB weights are not read.
+    """
+    model_path = Path(model_path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(model_path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    for data in sorted(model_path.parent.glob(model_path.name + "*")):
+        if data != model_path:
+            stat = data.stat()
+            digest.update(f"{data.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def cache_key(model_path, opt_level: str, disabled_optimizers=DISABLED_OPTIMIZERS) -> str:
+    parts = [model_fingerprint(model_path), f"ort{ort.__version__}", opt_level]
+    parts += sorted(disabled_optimizers)
+    if opt_level == "all":
+        parts.append(platform.machine())
+    return hashlib.blake2b("|".join(parts).encode(), digest_size=12).hexdigest()
+
+
+def is_precompiled(model_path) -> bool:
+    """ORT-format or already optimized + prepacked model (conversion/precompile_ort.py)."""
+    model_path = Path(model_path)
+    return model_path.suffix == ".ort" or model_path.name.endswith(".opt.onnx")
+
+
+def host_info() -> dict:
+    return {"machine": platform.machine(), "cpu_count": os.cpu_count(), "ort": ort.__version__}
+
+
+def find_profile(model_path):
+    """$EPICRISIS_ORT_PROFILE, else ort_profile.json in the model's directory or its parent."""
+    if os.environ.get("EPICRISIS_ORT_PROFILE"):
+        return Path(os.environ["EPICRISIS_ORT_PROFILE"])
+    model_path = Path(model_path)
+    for directory in (model_path.parent, model_path.parent.parent):
+        if (directory / PROFILE_NAME).exists():
+            return directory / PROFILE_NAME
+    return None
+
+
+def load_profile(model_path=None, path=None) -> dict:
+    """Tuned profile for this machine, or {} if there is none (or it was tuned elsewhere)."""
+    path = Path(path) if path else find_profile(model_path)
+    if path is None or not path.exists():
+        return {}
+    profile = json.loads(path.read_text(encoding="utf-8"))
+    host = profile.get("host", {})
+    if host.get("cpu_count") != os.cpu_count() or host.get("machine") != platform.machine():
+        warnings.warn(f"Ignoring {path}: tuned on {host}, this host is {host_info()}")
+        return {}
+    return profile
+
+
+def profile_settings(profile: dict, worker_index: int = None) -> tuple:
+    """(thread settings, CPU list or None) for a single process or for worker `worker_index`."""
+    if worker_index is not None and profile.get("worker_session"):
+        worker_cpus = profile.get("worker_cpus") or []
+        cpus = worker_cpus[worker_index % len(worker_cpus)] if worker_cpus else None
+        return profile["worker_session"], cpus
+    return profile.get("session", {}), profile.get("cpus")
+
+
+def apply_thread_settings(so: ort.SessionOptions, settings: dict) -> ort.SessionOptions:
+    if settings.get("intra_op_num_threads"):
+        so.intra_op_num_threads = settings["intra_op_num_threads"]
+    if settings.get("inter_op_num_threads"):
+        so.inter_op_num_threads = settings["inter_op_num_threads"]
+    if settings.get("execution_mode"):
+        so.execution_mode = EXECUTION_MODES[settings["execution_mode"]]
+    if "allow_spinning" in settings:
+        spinning = "1" if settings["allow_spinning"] else "0"
+        so.add_session_config_entry("session.intra_op.allow_spinning", spinning)
+        so.add_session_config_entry("session.inter_op.allow_spinning", spinning)
+    return so
+
+
+def genai_session_options(settings: dict) -> dict:
+    """Thread settings as ORT GenAI decoder `session_options` (execution_mode has no GenAI equivalent)."""
+    options = {}
+    for key in ("intra_op_num_threads", "inter_op_num_threads"):
+        if settings.get(key):
+            options[key] = settings[key]
+    if "allow_spinning" in settings:
+        spinning = "1" if settings["allow_spinning"] else "0"
+        options["config_entries"] = {
+            "session.intra_op.allow_spinning": spinning,
+            "session.inter_op.allow_spinning": spinning,
+        }
+    return options
+
+
+def allowed_cpus() -> list:
+    """CPUs this process may run on (its affinity mask where the OS has one)."""
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+
+
+def percentile(values, q: float) -> float:
+    """q-th percentile of `values` (0.0 when empty), for latency reports."""
+    return float(np.percentile(values, q)) if len(values) else 0.0
+
+
+def pin_process(cpus) -> None:
+    """Restrict this process (and the ORT threads it creates afterwards) to `cpus`."""
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+
+
+def join_workers(workers, barrier, timeout: float = WORKER_TIMEOUT_S) -> list:
+    """
+    Join processes that meet at `barrier`; returns their exit codes.
+
+    A worker that dies (say, before it reaches the barrier) aborts the barrier,
+    so the others get BrokenBarrierError instead of waiting for it forever.
+    Workers still alive after `timeout` are terminated.
+    """
+    deadline = time.monotonic() + timeout
+    for worker in workers:
+        while worker.is_alive() and time.monotonic() < deadline:
+            worker.join(timeout=0.5)
+            if any(other.exitcode not in (None, 0) for other in workers):
+                barrier.abort()
+    for worker in workers:
+        if worker.is_alive():
+            barrier.abort()
+            worker.terminate()
+            worker.join()
+    return [worker.exitcode for worker in workers]
+
+
+def session_options(opt_level: str = DEFAULT_OPT_LEVEL, intra_op_threads: int = None) -> ort.SessionOptions:
+    if opt_level not in OPT_LEVELS:
+        raise ValueError(f"Unknown opt level '{opt_level}' (expected one of {', '.join(OPT_LEVELS)})")
+    so = ort.SessionOptions()
+    so.graph_optimization_level = OPT_LEVELS[opt_level]
+    if intra_op_threads:
+        so.intra_op_num_threads = intra_op_threads
+    return so
+
+
+def create_session(
+    model_path,
+    opt_level: str = DEFAULT_OPT_LEVEL,
+    disabled_optimizers=DISABLED_OPTIMIZERS,
+    cache_dir=DEFAULT_CACHE_DIR,
+    providers=("CPUExecutionProvider",),
+    sess_options: ort.SessionOptions = None,
+    shared_weights: bool = False,
+    threads: dict = None,
+) -> ort.InferenceSession:
+    """
+    Create a session at `opt_level`, reusing a cached optimized graph when one exists.
+
+    `sess_options` carries everything but the optimization settings (threads,
+    execution mode); it is copied field by field, not mutated. With
+    opt_level="disable", cache_dir=None or a precompiled model no cache is used.
+    With `shared_weights`, no weight is copied into private memory: uncached
+    sessions skip prepacking, and .ort models (read into a private buffer) are
+    rejected. Weights embedded in a .onnx only become external through the cache.
+    `threads` (see apply_thread_settings) defaults to the tuned profile's
+    session settings; pass {} for ORT defaults.
+    """
+    model_path = Path(model_path)
+    so = session_options(opt_level)
+    if sess_options is not None:
+        so.intra_op_num_threads = sess_options.intra_op_num_threads
+        so.inter_op_num_threads = sess_options.inter_op_num_threads
+        so.execution_mode = sess_options.execution_mode
+    if threads is None:
+        threads = profile_settings(load_profile(model_path))[0]
+    apply_thread_settings(so, threads)
+    disabled = list(disabled_optimizers) if opt_level != "disable" else []
+    if shared_weights and model_path.suffix == ".ort":
+        raise ValueError("ORT-format models are read into private memory; use the .opt.onnx build to share weights")
+
+    if is_precompiled(model_path):
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        if model_path.suffix == ".ort":
+            so.add_session_config_entry("session.use_ort_model_bytes_directly", "1")
+            so.add_session_config_entry("session.use_ort_model_bytes_for_initializers", "1")
+        return ort.InferenceSession(str(model_path), sess_options=so, providers=list(providers))
+
+    if opt_level == "disable" or cache_dir is None:
+        if shared_weights:
+            so.add_session_config_entry("session.disable_prepacking", "1")
+        return ort.InferenceSession(str(model_path), sess_options=so, providers=list(providers), disabled_optimizers=disabled)
+
+    cache_dir = Path(cache_dir)
+    cached = cache_dir / f"{model_path.stem}-{cache_key(model_path, opt_level, disabled)}.onnx"
+    if cached.exists():
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        return ort.InferenceSession(str(cached), sess_options=so, providers=list(providers))
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # Each build writes its own files: the weights under a unique name (the graph refers to it, so it is
+    # never renamed or rewritten while other sessions map it), the graph under a temporary name that is
+    # renamed last, so a present model file is complete. Concurrent cold starts do not share any file.
+    build = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    partial = cached.with_name(f"{cached.name}.{build}.partial")
+    data = cached.with_name(f"{cached.name}.{build}.data")
+    so.optimized_model_filepath = str(partial)
+    so.add_session_config_entry("session.optimized_model_external_initializers_file_name", data.name)
+    so.add_session_config_entry(
+        "session.optimized_model_external_initializers_min_size_in_bytes", str(EXTERNAL_MIN_BYTES)
+    )
+    so.add_session_config_entry("session.save_external_prepacked_constant_initializers", "1")
+    sess = ort.InferenceSession(str(model_path), sess_options=so, providers=list(providers), disabled_optimizers=disabled)
+    if not partial.exists():
+        return sess
+    try:
+        # A hard link publishes the graph without replacing one another build published in between.
+        os.link(partial, cached)
+    except FileExistsError:
+        # Another process finished first; its graph (and data file) stay in place, drop this build.
+        data.unlink(missing_ok=True)
+    except OSError:
+        # No hard links on this filesystem (some FUSE/SMB/overlay mounts): a rename still publishes
+        # a complete graph, though a racing build may replace it and leave its own data file behind.
+        os.replace(partial, cached)
+        return sess
+    partial.unlink()
+    return sess
+
+
+def add_session_arguments(parser: argparse.ArgumentParser) -> None:
+    """--opt-level / --ort-cache-dir / --no-ort-cache / --shared-weights / --ort-profile, shared by the inference CLIs."""
+    parser.add_argument(
+        "--opt-level",
+        choices=list(OPT_LEVELS),
+        default=DEFAULT_OPT_LEVEL,
+        help=f"ORT graph optimization level (always without {', '.join(DISABLED_OPTIMIZERS)})",
+    )
+    parser.add_argument("--ort-cache-dir", default=str(DEFAULT_CACHE_DIR), help="Optimized-graph cache directory")
+    parser.add_argument("--no-ort-cache", action="store_true", help="Optimize on every start, do not cache")
+    parser.add_argument(
+        "--shared-weights",
+        action="store_true",
+        help="Keep weights in mmap'd external data only (no load-time prepacking) so processes share one copy",
+    )
+    parser.add_argument(
+        "--ort-profile",
+        default="auto",
+        help=f"Tuned thread/affinity profile: 'auto' ({PROFILE_NAME} next to the model), a path, or 'none'",
+    )
+
+
+def session_from_args(args, model_path, worker_index: int = None) -> ort.InferenceSession:
+    """Session for a runner CLI; also pins the process to the profile's CPUs."""
+    if args.ort_profile == "none":
+        profile = {}
+    else:
+        profile = load_profile(model_path, None if args.ort_profile == "auto" else args.ort_profile)
+    threads, cpus = profile_settings(profile, worker_index)
+    pin_process(cpus)
+    return create_session(
+        model_path,
+        args.opt_level,
+        cache_dir=None if args.no_ort_cache else args.ort_cache_dir,
+        shared_weights=args.shared_weights,
+        threads=threads,
+    )
+
+
+def _decode_benchmark(sess, prompt_length: int, steps: int, seed: int = 0) -> dict:
+    from onnx_engine import DecodeEngine, ModelGeometry
+
+    engine = DecodeEngine(sess, prompt_length + steps + 1, ModelGeometry.from_session(sess))
+    prompt = np.random.default_rng(seed).integers(1, 1000, size=(1, prompt_length), dtype=np.int64)
+    engine.reset(batch=1)
+    start = time.perf_counter()
+    logits = engine.prefill(prompt)
+    prefill_s = time.perf_counter() - start
+    first = logits.copy()
+    start = time.perf_counter()
+    for _ in range(steps):
+        token = np.argmax(logits, axis=-1).astype(np.int64)[:, None]
+        logits = engine.forward(token)
+    decode_s = time.perf_counter() - start
+    return {"prefill_ms": prefill_s * 1000, "token_ms": decode_s * 1000 / max(steps, 1), "logits": first}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="ORT optimization levels: session setup and per-token latency.")
+    parser.add_argument(
+        "--model",
+        default="epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx",
+        help="Path to ONNX model",
+    )
+    parser.add_argument("--levels", nargs="+", choices=list(OPT_LEVELS), default=["disable", "extended", "all"])
+    parser.add_argument("--ort-cache-dir", default=str(DEFAULT_CACHE_DIR), help="Optimized-graph cache directory")
+    parser.add_argument("--prompt-length", type=int, default=128, help="Prefill length")
+    parser.add_argument("--decode-steps", type=int, default=32, help="Greedy decode steps timed per level")
+    args = parser.parse_args()
+
+    results = {}
+    for level in args.levels:
+        timings = []
+        for _ in range(2):  # cold (optimize + save), then warm (cached graph)
+            start = time.perf_counter()
+            sess = create_session(args.model, level, cache_dir=args.ort_cache_dir)
+            timings.append(time.perf_counter() - start)
+        results[level] = _decode_benchmark(sess, args.prompt_length, args.decode_steps)
+        results[level]["session_s"] = timings
+        print(
+            f"{level:>8}: session cold={timings[0]:.2f}s warm={timings[1]:.2f}s "
+            f"prefill={results[level]['prefill_ms']:.1f}ms token={results[level]['token_ms']:.2f}ms"
+        )
+
+    reference = results[args.levels[0]]
+    for level in args.levels[1:]:
+        diff = np.abs(results[level]["logits"].astype(np.float32) - reference["logits"].astype(np.float32)).max()
+        speedup = reference["token_ms"] / results[level]["token_ms"]
+        print(f"{level} vs {args.levels[0]}: per-token speedup={speedup:.2f}x max|dlogits|={diff:.4g}")
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
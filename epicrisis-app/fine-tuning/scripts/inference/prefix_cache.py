@@ -0,0 +1,84 @@
+"""
+KV prefix cache for prompts that share a fixed head.
+
+Every epicrisis prompt starts with the same ChatML system block
+(SYSTEM_INSTRUCTION) and the `<|im_start|>user` header, so their KV tensors
+are identical across requests. PrefixCache keeps single-row KV snapshots
+([layers, 2, kv_heads, length, head_dim], see DecodeEngine.snapshot_prefix)
+keyed by a hash of the prefix token ids; a new request restores the longest
+cached prefix and only prefills its episode-specific suffix.
+
+Entries are evicted least-recently-used once their total size exceeds
+`max_bytes`. The cache is not thread-safe; it belongs to one worker.
+"""
+
+import hashlib
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+
+def prefix_key(token_ids) -> str:
+    return hashlib.blake2b(np.asarray(token_ids, dtype=np.int64).tobytes(), digest_size=16).hexdigest()
+
+
+class PrefixCache:
+    """LRU map from token-id prefixes to KV snapshots, bounded by bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self._entries = OrderedDict()
+        self._lengths = Counter()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, token_ids, max_length: int = None):
+        """Return (length, kv) for the longest cached prefix of `token_ids`, or (0, None)."""
+        token_ids = np.asarray(token_ids, dtype=np.int64)
+        limit = len(token_ids) if max_length is None else min(max_length, len(token_ids))
+        for length in sorted(self._lengths, reverse=True):
+            if length > limit:
+                continue
+            key = prefix_key(token_ids[:length])
+            entry = self._entries.get(key)
+            if entry is not None and np.array_equal(entry[0], token_ids[:length]):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.hit_tokens += length
+                return length, entry[1]
+        self.misses += 1
+        return 0, None
+
+    def insert(self, token_ids, kv: np.ndarray) -> bool:
+        """Store `kv` for the prefix `token_ids`; return False if it does not fit at all."""
+        token_ids = np.array(token_ids, dtype=np.int64)
+        key = prefix_key(token_ids)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return True
+        if kv.nbytes > self.max_bytes:
+            return False
+        self._entries[key] = (token_ids, kv)
+        self._lengths[len(token_ids)] += 1
+        self.nbytes += kv.nbytes
+        while self.nbytes > self.max_bytes:
+            _, (evicted_ids, evicted_kv) = self._entries.popitem(last=False)
+            self._lengths[len(evicted_ids)] -= 1
+            if not self._lengths[len(evicted_ids)]:
+                del self._lengths[len(evicted_ids)]
+            self.nbytes -= evicted_kv.nbytes
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_tokens": self.hit_tokens,
+        }
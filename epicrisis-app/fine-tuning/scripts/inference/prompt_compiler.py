@@ -0,0 +1,267 @@
+"""
+Shared prompt compiler for training and inference.
+
+Every prompt is ChatML: the fixed system block (SYSTEM_INSTRUCTION), the
+compact episode JSON as the user turn, then the assistant header. The
+training sets (conversion/convert_to_chatml.py, training/unify_datasets.py,
+training/mlx_finetune.py) and the runners (build_chatml_prompt,
+run_epicrisis_onnx.build_prompt) all build it here, so inference sees exactly
+the text the model was trained on.
+
+Styles for the episode JSON:
+  compact   fields in canonical order (dx, proc, tto, evo, dx_alta, med),
+            empty fields dropped, no whitespace (separators "," and ":")
+  indent    json.dumps(indent=2) as given, the format of the datasets built
+            before this module and of every model fine-tuned so far
+A model must be prompted in the style it was trained on, so the style travels
+with it: training writes PROMPT_STYLE_FILE next to the adapters / merged
+model (save_prompt_style), the ONNX exports copy it, and the runners read it
+when they load the model (load_prompt_style). A model without the file is an
+indent model; DEFAULT_STYLE stays indent until a compact-trained model exists.
+
+With a tokenizer, PromptCompiler.field_tokens() reports the tokens of each
+field and compile() enforces a prompt budget. Prefill time is linear in
+prompt length and dominates TTFT. Fields are trimmed in TRIM_ORDER: the
+free-text `evo` is cut word by word, then in-hospital treatments (`tto`) and procedures (`proc`)
+lose items from the end. Diagnoses and discharge medication are never
+trimmed; a prompt that does not fit without them raises ValueError.
+
+Usage (tokens per style and per field over the dataset, and the effect of a budget):
+  python3 epicrisis-app/fine-tuning/scripts/inference/prompt_compiler.py \\
+    --tokenizer epicrisis-app/models/epicrisis-q4f16-finetuned --limit 350 --budget 384
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+
+SYSTEM_INSTRUCTION = (
+    "Genera una epicrisis narrativa en UN SOLO PARRAFO. "
+    "USA SOLO la informacion del JSON, NO inventes datos. "
+    "IMPORTANTE: Incluye TODOS los codigos entre parentesis: "
+    "diagnostico de ingreso con codigo CIE-10 (ej: I20.0), "
+    "procedimientos con codigo K (ej: K492, K493), "
+    "medicacion con dosis y codigo ATC (ej: B01AC06). "
+    "Estructura: dx ingreso -> procedimientos -> evolucion -> dx alta -> medicacion alta. "
+    "Abreviaturas: DA=descendente anterior, CD=coronaria derecha, CX=circunfleja, "
+    "SDST=supradesnivel ST, IAM=infarto agudo miocardio."
+)
+FIELDS = ("dx", "proc", "tto", "evo", "dx_alta", "med")
+TRIM_ORDER = ("evo", "tto", "proc")
+PROMPT_STYLES = ("compact", "indent")
+DEFAULT_STYLE = "indent"
+PROMPT_STYLE_FILE = "prompt_style.json"
+
+
+def _check_style(style: str) -> str:
+    if style not in PROMPT_STYLES:
+        raise ValueError(f"Unknown prompt style '{style}' (expected one of {', '.join(PROMPT_STYLES)})")
+    return style
+
+
+def save_prompt_style(directory, style: str) -> Path:
+    """Record the prompt style a model is trained with in `directory` (PROMPT_STYLE_FILE)."""
+    path = Path(directory) / PROMPT_STYLE_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({"style": _check_style(style)}) + "\n", encoding="utf-8")
+    return path
+
+
+def find_prompt_style(model_path):
+    """PROMPT_STYLE_FILE in the model directory (or a model file's directory), or their parents; else None."""
+    model_path = Path(model_path)
+    directory = model_path if model_path.is_dir() else model_path.parent
+    for candidate in (directory, directory.parent, directory.parent.parent):
+        if (candidate / PROMPT_STYLE_FILE).exists():
+            return candidate / PROMPT_STYLE_FILE
+    return None
+
+
+def load_prompt_style(model_path) -> str:
+    """Prompt style a model was trained with; DEFAULT_STYLE when it has no PROMPT_STYLE_FILE."""
+    path = find_prompt_style(model_path)
+    if path is None:
+        return DEFAULT_STYLE
+    return _check_style(json.loads(path.read_text(encoding="utf-8"))["style"])
+
+
+def chatml_prefix() -> str:
+    """Prompt head shared by every episode (system block + user header)."""
+    return f"<|im_start|>system\n{SYSTEM_INSTRUCTION}<|im_end|>\n<|im_start|>user\n"
+
+
+def canonical(payload: dict) -> dict:
+    """Known fields in FIELDS order, then any others; empty values dropped."""
+    keys = [key for key in FIELDS if key in payload] + [key for key in payload if key not in FIELDS]
+    return {key: payload[key] for key in keys if payload[key] not in (None, "", [], {})}
+
+
+def serialize(payload: dict, style: str = DEFAULT_STYLE) -> str:
+    if _check_style(style) == "compact":
+        return json.dumps(canonical(payload), ensure_ascii=False, separators=(",", ":"))
+    return json.dumps(payload, ensure_ascii=False, indent=2)
+
+
+def build_chatml_prompt(payload: dict, style: str = DEFAULT_STYLE) -> str:
+    return f"{chatml_prefix()}{serialize(payload, style)}<|im_end|>\n<|im_start|>assistant\n"
+
+
+def build_training_text(payload: dict, output: str, style: str = DEFAULT_STYLE) -> str:
+    """Full training example: the inference prompt followed by the reference epicrisis."""
+    return f"{build_chatml_prompt(payload, style)}{output}<|im_end|>"
+
+
+def encode(tokenizer, text: str) -> list:
+    """Token ids from an HF tokenizer (no added special tokens) or an og.Tokenizer."""
+    try:
+        ids = tokenizer.encode(text, add_special_tokens=False)
+    except TypeError:
+        ids = tokenizer.encode(text)
+    return [int(token) for token in ids]
+
+
+class CompiledPrompt:
+    """A rendered prompt, its token ids and what was trimmed to fit the budget."""
+
+    def __init__(self, text: str, token_ids: list, payload: dict, trimmed: dict):
+        self.text = text
+        self.token_ids = token_ids
+        self.payload = payload
+        self.trimmed = trimmed
+
+    @property
+    def num_tokens(self) -> int:
+        return len(self.token_ids)
+
+
+class PromptCompiler:
+    """Render episodes with a tokenizer at hand: per-field token counts and an optional prompt budget."""
+
+    def __init__(self, tokenizer, style: str = DEFAULT_STYLE, budget: int = None, trim_order=TRIM_ORDER):
+        self.tokenizer = tokenizer
+        self.style = _check_style(style)
+        self.budget = budget
+        self.trim_order = tuple(trim_order)
+        self.prefix_length = len(encode(tokenizer, chatml_prefix()))
+
+    def tokenize(self, payload: dict) -> list:
+        return encode(self.tokenizer, build_chatml_prompt(payload, self.style))
+
+    def field_tokens(self, payload: dict) -> dict:
+        """Tokens of each field's `"key":value` segment; `_template` is everything else (system block, ChatML, braces)."""
+        fields = canonical(payload) if self.style == "compact" else payload
+        counts = {}
+        for key, value in fields.items():
+            segment = serialize({key: value}, self.style)
+            counts[key] = len(encode(self.tokenizer, segment[2:-2] if self.style == "indent" else segment[1:-1]))
+        counts["_template"] = len(self.tokenize(payload)) - sum(counts.values())
+        return counts
+
+    def compile(self, payload: dict) -> CompiledPrompt:
+        """Render `payload`, trimming TRIM_ORDER fields until the prompt fits the budget."""
+        payload = dict(payload)
+        token_ids = self.tokenize(payload)
+        trimmed = {}
+        for field in self.trim_order:
+            if self.budget is None or len(token_ids) <= self.budget:
+                break
+            if payload.get(field):
+                token_ids = self._trim(payload, field, trimmed)
+        if self.budget is not None and len(token_ids) > self.budget:
+            raise ValueError(
+                f"Prompt needs {len(token_ids)} tokens after trimming {', '.join(self.trim_order)}; "
+                f"budget is {self.budget}"
+            )
+        text = build_chatml_prompt(payload, self.style)
+        return CompiledPrompt(text, token_ids, payload, trimmed)
+
+    def _trim(self, payload: dict, field: str, trimmed: dict) -> list:
+        """Keep the longest head of `payload[field]` (words of a string, items of a list) that fits; return token ids."""
+        value = payload[field]
+        parts = value.split() if isinstance(value, str) else list(value)
+
+        def render(count: int):
+            return " ".join(parts[:count]) if isinstance(value, str) else parts[:count]
+
+        # The full value does not fit; binary-search the largest head that does (0 = field emptied).
+        low, high = 0, len(parts) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            payload[field] = render(middle)
+            if len(self.tokenize(payload)) <= self.budget:
+                low = middle
+            else:
+                high = middle - 1
+        payload[field] = render(low)
+        trimmed[field] = {"kept": low, "of": len(parts)}
+        return self.tokenize(payload)
+
+
+def main() -> int:
+    from batch_generate import load_episodes
+    from ort_session import percentile
+
+    parser = argparse.ArgumentParser(description="Prompt token counts per style and per field.")
+    parser.add_argument(
+        "--tokenizer",
+        default="epicrisis-app/models/epicrisis-q4f16-finetuned",
+        help="Path to tokenizer directory",
+    )
+    parser.add_argument(
+        "--episodes",
+        default=str(Path(__file__).resolve().parents[2] / "datasets" / "dataset_epicrisis_350_completo.jsonl"),
+        help="Episodes (.jsonl with compact 'input' or .json)",
+    )
+    parser.add_argument("--limit", type=int, default=None, help="Number of episodes (default: all)")
+    parser.add_argument("--budget", type=int, default=None, help="Prompt token budget to apply to the model's style")
+    parser.add_argument("--show", action="store_true", help="Print the first compiled prompt")
+    args = parser.parse_args()
+
+    try:
+        from transformers import AutoTokenizer
+    except Exception as exc:
+        raise RuntimeError("transformers is required for token counts") from exc
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    episodes = load_episodes(args.episodes, args.limit)
+
+    print(f"{'style':<8} {'mean':>7} {'p95':>6} {'max':>6}   (prompt tokens over {len(episodes)} episodes)")
+    for style in PROMPT_STYLES:
+        lengths = [len(PromptCompiler(tokenizer, style).tokenize(episode)) for episode in episodes]
+        print(f"{style:<8} {np.mean(lengths):>7.1f} {percentile(lengths, 95):>6.0f} {max(lengths):>6}")
+
+    compiler = PromptCompiler(tokenizer, load_prompt_style(args.tokenizer))
+    counts = [compiler.field_tokens(episode) for episode in episodes]
+    print(f"\n{compiler.style}: tokens per field (mean / max), system block + user header = {compiler.prefix_length}")
+    for key in list(FIELDS) + ["_template"]:
+        values = [count.get(key, 0) for count in counts]
+        print(f"  {key:<10} {np.mean(values):>7.1f} {max(values):>6}")
+
+    if args.budget:
+        compiler.budget = args.budget
+        results, rejected = [], 0
+        for episode in episodes:
+            try:
+                results.append(compiler.compile(episode))
+            except ValueError:
+                rejected += 1
+        trimmed = [r for r in results if r.trimmed]
+        print(f"\nbudget={args.budget}: trimmed={len(trimmed)} rejected={rejected} of {len(episodes)}")
+        for field in compiler.trim_order:
+            cuts = [r.trimmed[field] for r in trimmed if field in r.trimmed]
+            if cuts:
+                kept = sum(cut["kept"] for cut in cuts) / max(sum(cut["of"] for cut in cuts), 1)
+                print(f"  {field:<10} trimmed in {len(cuts)} prompts, {100 * kept:.0f}% of its words/items kept")
+        if results:
+            print(f"  prompt tokens after budget: mean={np.mean([r.num_tokens for r in results]):.1f}")
+
+    if args.show and episodes:
+        print("\n" + compiler.compile(episodes[0]).text)
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
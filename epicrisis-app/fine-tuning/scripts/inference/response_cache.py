@@ -0,0 +1,248 @@
+"""
+Content-addressed cache of finished generations.
+
+The same episode is often generated again with the same settings: a user
+re-opens it, the backend retries, or an eval re-runs. A repeat is served from
+disk instead of paying prefill and decode again. The key is a hash of:
+  - the compact input, canonicalized (prompt_compiler.canonical, sorted keys)
+  - the model directory fingerprint (model_dir_fingerprint)
+  - the prompt template version (system block, ChatML layout, style) and the
+    prompt budget
+  - the sampling parameters, only when the result is reproducible: greedy
+    (temperature 0 / do_sample off) or sampling with a fixed seed
+response_key() returns None for unseeded sampling; those requests bypass the
+cache and are counted as `bypass`.
+
+Entries are JSON files under `cache_dir` (<key[:2]>/<key>.json, written
+atomically). The store is LRU, bounded by `max_bytes`: a hit refreshes the
+file's mtime, the index is rebuilt from mtimes when a process starts, and
+the oldest entries are evicted once the total size exceeds the bound. The
+latest entries are also kept decoded in memory (`memory_entries`), so a
+repeat in the same process does not read the file. Thread-safe.
+
+Usage (cache statistics, or clear):
+  python3 epicrisis-app/fine-tuning/scripts/inference/response_cache.py --cache-dir outputs/response_cache
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from prompt_compiler import DEFAULT_STYLE, build_chatml_prompt, canonical
+
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parent / "outputs" / "response_cache"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# Files up to this size are hashed whole (configs, tokenizer); larger ones
+# (weights) by name, size and mtime, as in ort_session.model_fingerprint.
+FULL_HASH_BYTES = 4 * 1024 * 1024
+# Bump when run_epicrisis_onnx.postprocess changes what is stored as text.
+POSTPROCESS_VERSION = 1
+
+_fingerprints = {}
+
+
+def model_dir_fingerprint(model_dir) -> str:
+    """Hash of the files of a model directory (computed once per process and directory)."""
+    model_dir = Path(model_dir).resolve()
+    if model_dir in _fingerprints:
+        return _fingerprints[model_dir]
+    digest = hashlib.blake2b(digest_size=16)
+    paths = [model_dir] if model_dir.is_file() else sorted(p for p in model_dir.rglob("*") if p.is_file())
+    for path in paths:
+        stat = path.stat()
+        digest.update(f"{path.relative_to(model_dir.parent)}:{stat.st_size}".encode())
+        if stat.st_size <= FULL_HASH_BYTES:
+            digest.update(path.read_bytes())
+        else:
+            digest.update(str(stat.st_mtime_ns).encode())
+    _fingerprints[model_dir] = digest.hexdigest()
+    return _fingerprints[model_dir]
+
+
+def template_version(style: str = DEFAULT_STYLE) -> str:
+    """Hash of the prompt around the episode JSON (system block, ChatML markers, style)."""
+    skeleton = build_chatml_prompt({"dx": ["{dx}"]}, style)
+    return hashlib.blake2b(f"{skeleton}|{POSTPROCESS_VERSION}".encode(), digest_size=8).hexdigest()
+
+
+def is_deterministic(sampling: dict) -> bool:
+    if sampling.get("do_sample") is False or not sampling.get("temperature"):
+        return True
+    return sampling.get("seed") is not None
+
+
+def response_key(
+    payload: dict,
+    model_fingerprint: str,
+    sampling: dict,
+    style: str = DEFAULT_STYLE,
+    prompt_budget: int = None,
+):
+    """Cache key for a generation, or None when its output is not reproducible."""
+    if not is_deterministic(sampling):
+        return None
+    parts = {
+        "input": canonical(payload) if style == "compact" else payload,
+        "model": model_fingerprint,
+        "template": template_version(style),
+        "prompt_budget": prompt_budget,
+        "sampling": sampling,
+    }
+    text = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(text.encode(), digest_size=20).hexdigest()
+
+
+class ResponseCache:
+    """On-disk LRU of generation results keyed by response_key(), bounded by total bytes."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES, memory_entries: int = 1024):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypass = 0
+        self.evictions = 0
+        self.hit_s = 0.0
+        self._index = OrderedDict()
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        entries = []
+        for path in self.cache_dir.glob("*/*.json"):
+            stat = path.stat()
+            entries.append((stat.st_mtime_ns, path.stem, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self.nbytes += size
+        with self._lock:
+            self._evict()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key):
+        """Cached result for `key`; None on a miss (and for key None, counted as bypass)."""
+        if key is None:
+            with self._lock:
+                self.bypass += 1
+            return None
+        start = time.perf_counter()
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+        path = self._path(key)
+        if value is None:
+            try:
+                value = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                with self._lock:
+                    self.nbytes -= self._index.pop(key, 0)
+                    self.misses += 1
+                return None
+            with self._lock:
+                self._remember(key, value)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+            self.hit_s += time.perf_counter() - start
+        return dict(value)
+
+    def put(self, key, value: dict) -> bool:
+        """Store `value` (JSON-serializable) under `key`; False if key is None or the entry exceeds max_bytes."""
+        if key is None:
+            return False
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        if len(data) > self.max_bytes:
+            return False
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        handle, temp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(handle, "wb") as f:
+            f.write(data)
+        os.replace(temp, path)
+        with self._lock:
+            self.nbytes += len(data) - self._index.pop(key, 0)
+            self._index[key] = len(data)
+            self._remember(key, dict(value))
+            self._evict()
+        return True
+
+    def _remember(self, key: str, value: dict) -> None:
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self) -> None:
+        while self.nbytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._memory.pop(key, None)
+            self.nbytes -= size
+            self.evictions += 1
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._index):
+                try:
+                    self._path(key).unlink()
+                except OSError:
+                    pass
+            self._index.clear()
+            self._memory.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._index),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypass": self.bypass,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "hit_us": self.hit_s * 1e6 / self.hits if self.hits else 0.0,
+        }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Response cache statistics.")
+    parser.add_argument("--cache-dir", default=str(DEFAULT_CACHE_DIR), help="Response cache directory")
+    parser.add_argument("--clear", action="store_true", help="Delete every cached response")
+    args = parser.parse_args()
+
+    cache = ResponseCache(args.cache_dir, max_bytes=float("inf"))
+    if args.clear:
+        cache.clear()
+    stats = cache.stats()
+    print(f"{args.cache_dir}: {stats['entries']} entries, {stats['bytes'] / 1e6:.2f} MB")
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -4,16 +4,97 @@ from pathlib import Path
 
 import onnxruntime_genai as og
 
+from prompt_compiler import DEFAULT_STYLE, PromptCompiler, build_chatml_prompt, load_prompt_style
+from response_cache import DEFAULT_MAX_BYTES, ResponseCache, model_dir_fingerprint, response_key
+
+
+def load_model(model_dir, ort_profile: str = "auto"):
+    """
+    og.Model with the tuned thread settings of autotune.py (ort_profile.json).
+
+    The profile ('auto': next to the model, a path, or 'none') is applied as
+    the decoder's session_options through og.Config.overlay, and the process
+    is pinned to its CPUs, as session_from_args() does for the ORT runners.
+    """
+    config = og.Config(str(model_dir))
+    if ort_profile != "none":
+        from ort_session import genai_session_options, load_profile, pin_process, profile_settings
+
+        profile = load_profile(Path(model_dir) / "genai_config.json", None if ort_profile == "auto" else ort_profile)
+        threads, cpus = profile_settings(profile)
+        pin_process(cpus)
+        options = genai_session_options(threads)
+        if options:
+            config.overlay(json.dumps({"model": {"decoder": {"session_options": options}}}))
+    return og.Model(config)
+
+
+def build_prompt(payload: dict, compiler: PromptCompiler = None, style: str = DEFAULT_STYLE) -> str:
+    """ChatML prompt in the training format (the model's `style`); with a compiler, trimmed to its token budget."""
+    if compiler is not None:
+        return compiler.compile(payload).text
+    return build_chatml_prompt(payload, style)
+
+
+def postprocess(output: str, prompt: str = "") -> str:
+    """Strip the echoed prompt and `Respuesta:`, collapse whitespace and drop repeated sentences."""
+    if prompt and output.startswith(prompt):
+        output = output[len(prompt) :].lstrip()
+    if "Respuesta:" in output:
+        output = output.split("Respuesta:", 1)[1].lstrip()
+    output = output.replace("<|endoftext|>", "").strip()
+    output = " ".join(output.split())
+    sentences = [s.strip() for s in output.split(".") if s.strip()]
+    deduped = []
+    seen = set()
+    for sentence in sentences:
+        key = sentence.lower()
+        if key in seen:
+            continue
+        seen.add(key)
+        deduped.append(sentence)
+    output = ". ".join(deduped)
+    if output and not output.endswith("."):
+        output += "."
+    return output
 
-def build_prompt(payload: dict) -> str:
-    json_str = json.dumps(payload, ensure_ascii=False)
-    return (
-        "Genera la epicrisis en un solo parrafo, sin bullets.\n"
-        "Usa SOLO los datos del JSON, no inventes.\n\n"
-        "Epicrisis:\n"
-        f"{json_str}\n\n"
-        "Respuesta:"
-    )
+
+def create_generator(
+    model, tokenizer, prompt: str, max_new_tokens: int, temperature: float, top_p: float, seed: int = None
+):
+    """Generator with the prompt appended; returns (generator, prompt_length)."""
+    tokens = tokenizer.encode(prompt)
+    params = og.GeneratorParams(model)
+    options = {
+        "max_length": len(tokens) + max_new_tokens,
+        "temperature": temperature,
+        "top_p": top_p,
+        "do_sample": True,
+    }
+    if seed is not None:
+        options["random_seed"] = seed
+    params.set_search_options(**options)
+    generator = og.Generator(model, params)
+    generator.append_tokens(tokens)
+    return generator, len(tokens)
+
+
+def generate(
+    model,
+    tokenizer,
+    payload: dict,
+    max_new_tokens: int = 200,
+    temperature: float = 0.2,
+    top_p: float = 0.8,
+    compiler: PromptCompiler = None,
+    seed: int = None,
+    style: str = DEFAULT_STYLE,
+) -> str:
+    prompt = build_prompt(payload, compiler, style)
+    generator, prompt_length = create_generator(model, tokenizer, prompt, max_new_tokens, temperature, top_p, seed)
+    while not generator.is_done():
+        generator.generate_next_token()
+    return postprocess(tokenizer.decode(generator.get_sequence(0)[prompt_length:]))
 
 
 def main() -> None:
@@ -38,49 +119,59 @@ def main() -> None:
     parser.add_argument("--max-new-tokens", type=int, default=200)
     parser.add_argument("--temperature", type=float, default=0.2)
     parser.add_argument("--top-p", type=float, default=0.8)
+    parser.add_argument(
+        "--prompt-budget",
+        type=int,
+        default=None,
+        help="Máximo de tokens del prompt; recorta evo, luego tto y proc (ver prompt_compiler.py)",
+    )
+    parser.add_argument("--seed", type=int, default=None, help="Semilla de muestreo (hace la salida reproducible)")
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Caché de respuestas en disco; solo para salidas reproducibles, con --seed (ver response_cache.py)",
+    )
+    parser.add_argument("--cache-max-mb", type=float, default=DEFAULT_MAX_BYTES / 2**20, help="Tamaño máximo del caché")
+    parser.add_argument(
+        "--ort-profile",
+        default="auto",
+        help="Perfil de hilos de autotune.py: 'auto' (ort_profile.json junto al modelo), una ruta, o 'none'",
+    )
 
     args = parser.parse_args()
 
     payload = json.loads(args.input_json)
-    prompt = build_prompt(payload)
+    style = load_prompt_style(args.model_dir)
 
-    model = og.Model(args.model_dir)
+    # El caché se consulta antes de cargar el modelo: una repetición no paga la carga.
+    cache, key = None, None
+    if args.cache_dir:
+        cache = ResponseCache(args.cache_dir, max_bytes=int(args.cache_max_mb * 2**20))
+        sampling = {
+            "max_new_tokens": args.max_new_tokens,
+            "temperature": args.temperature,
+            "top_p": args.top_p,
+            "do_sample": True,
+            "seed": args.seed,
+        }
+        key = response_key(
+            payload, model_dir_fingerprint(args.model_dir), sampling, style, prompt_budget=args.prompt_budget
+        )
+        cached = cache.get(key)
+        if cached is not None:
+            print(cached["text"])
+            return
+
+    model = load_model(args.model_dir, args.ort_profile)
     tokenizer = og.Tokenizer(model)
 
-    tokens = tokenizer.encode(prompt)
-    params = og.GeneratorParams(model)
-    params.set_search_options(
-        max_length=len(tokens) + args.max_new_tokens,
-        temperature=args.temperature,
-        top_p=args.top_p,
-        do_sample=True,
+    compiler = PromptCompiler(tokenizer, style, budget=args.prompt_budget) if args.prompt_budget else None
+    text = generate(
+        model, tokenizer, payload, args.max_new_tokens, args.temperature, args.top_p, compiler, args.seed, style
     )
-    generator = og.Generator(model, params)
-    generator.append_tokens(tokens)
-
-    while not generator.is_done():
-        generator.generate_next_token()
-
-    output = tokenizer.decode(generator.get_sequence(0))
-    if output.startswith(prompt):
-        output = output[len(prompt) :].lstrip()
-    if "Respuesta:" in output:
-        output = output.split("Respuesta:", 1)[1].lstrip()
-    output = output.replace("<|endoftext|>", "").strip()
-    output = " ".join(output.split())
-    sentences = [s.strip() for s in output.split(".") if s.strip()]
-    deduped = []
-    seen = set()
-    for sentence in sentences:
-        key = sentence.lower()
-        if key in seen:
-            continue
-        seen.add(key)
-        deduped.append(sentence)
-    output = ". ".join(deduped)
-    if output and not output.endswith("."):
-        output += "."
-    print(output)
+    if cache is not None:
+        cache.put(key, {"text": text})
+    print(text)
 
 
 if __name__ == "__main__":
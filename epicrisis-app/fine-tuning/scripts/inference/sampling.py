@@ -0,0 +1,42 @@
+"""
+Per-request sampling parameters (token selection lives in logits_processors.py).
+"""
+
+import numpy as np
+
+
+class SamplingParams:
+    """Sampling options for one request (temperature 0 = greedy)."""
+
+    def __init__(
+        self,
+        temperature: float = 0.0,
+        top_k: int = 0,
+        top_p: float = 0.0,
+        repetition_penalty: float = 1.0,
+        no_eos: bool = False,
+        seed: int = None,
+        min_p: float = 0.0,
+    ):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.no_eos = no_eos
+        self.seed = seed
+        self.min_p = min_p
+
+    @classmethod
+    def from_args(cls, args) -> "SamplingParams":
+        return cls(
+            temperature=args.temperature,
+            top_k=args.top_k,
+            top_p=args.top_p,
+            repetition_penalty=args.repetition_penalty,
+            no_eos=args.no_eos,
+            seed=args.seed,
+            min_p=getattr(args, "min_p", 0.0),
+        )
+
+    def rng(self) -> np.random.Generator:
+        return np.random.default_rng(self.seed)
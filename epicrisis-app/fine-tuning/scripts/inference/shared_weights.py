@@ -0,0 +1,185 @@
+"""
+Memory accounting for several inference processes on one node.
+
+ORT memory-maps external-data initializers. Pages that are only read stay in
+the page cache, and every process that loads the same file shares them. The
+weights then count once in the node total: proportional set size (PSS)
+splits them between processes, and per-process private memory is reduced to
+activations, KV cache and the runtime.
+
+Two things break sharing: prepacking MatMul weights at load time, which copies
+them into each process's heap, and weights embedded in the .onnx. The
+optimized-graph cache of ort_session.py avoids both, because it saves
+initializers and prepacked weights as external data. Without the cache
+(--opt-level disable), create_session(shared_weights=True) skips prepacking.
+
+The two modes compare those loads at the same --opt-level:
+  private   no cache: each process optimizes the graph and prepacks its
+            weights into its own heap (a runner started with --no-ort-cache)
+  shared    weights mapped from external data: the cached optimized graph,
+            or at --opt-level disable the source model without prepacking
+
+Usage (N worker processes, with and without prepacking):
+  python3 epicrisis-app/fine-tuning/scripts/inference/shared_weights.py \\
+    --model epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx \\
+    --processes 4 --decode-steps 16
+"""
+
+import argparse
+import multiprocessing as mp
+import resource
+import sys
+import threading
+import time
+
+import numpy as np
+
+from ort_session import (
+    BARRIER_TIMEOUT_S,
+    DEFAULT_CACHE_DIR,
+    DEFAULT_OPT_LEVEL,
+    OPT_LEVELS,
+    create_session,
+    join_workers,
+    load_profile,
+    pin_process,
+    profile_settings,
+)
+
+SMAPS_FIELDS = {
+    "Rss": "rss_mb",
+    "Pss": "pss_mb",
+    "Shared_Clean": "shared_clean_mb",
+    "Shared_Dirty": "shared_dirty_mb",
+    "Private_Clean": "private_clean_mb",
+    "Private_Dirty": "private_dirty_mb",
+}
+
+
+def memory_usage(pid="self") -> dict:
+    """RSS / PSS / shared / private memory of a process in MB (Linux, /proc/<pid>/smaps_rollup)."""
+    usage = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", encoding="ascii") as handle:
+            for line in handle:
+                parts = line.split()
+                field = parts[0].rstrip(":")
+                if field in SMAPS_FIELDS:
+                    usage[SMAPS_FIELDS[field]] = int(parts[1]) / 1024
+    except OSError:
+        return {}
+    usage["private_mb"] = usage.get("private_clean_mb", 0.0) + usage.get("private_dirty_mb", 0.0)
+    return usage
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS and KiB on Linux.
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def _worker(index, model, opt_level, cache_dir, shared, prompt_length, steps, barrier, results) -> None:
+    from onnx_engine import DecodeEngine, ModelGeometry
+
+    threads, cpus = profile_settings(load_profile(model), index)
+    pin_process(cpus)
+    sess = create_session(model, opt_level, cache_dir=cache_dir, shared_weights=shared, threads=threads)
+    engine = DecodeEngine(sess, prompt_length + steps + 1, ModelGeometry.from_session(sess))
+    prompt = np.random.default_rng(index).integers(1, 1000, size=(1, prompt_length), dtype=np.int64)
+    engine.reset(batch=1)
+    logits = engine.prefill(prompt)
+    start = time.perf_counter()
+    for _ in range(steps):
+        logits = engine.forward(np.argmax(logits, axis=-1).astype(np.int64)[:, None])
+    token_ms = (time.perf_counter() - start) * 1000 / max(steps, 1)
+    # Measure while every process still holds its session, so shared pages are split N ways.
+    try:
+        barrier.wait(timeout=BARRIER_TIMEOUT_S)
+        usage = memory_usage()
+        usage["token_ms"] = token_ms
+        results[index] = usage
+        barrier.wait(timeout=BARRIER_TIMEOUT_S)
+    except threading.BrokenBarrierError:
+        return  # another worker failed; run_processes() reports the missing rows
+
+
+def run_processes(model, processes: int, shared: bool, opt_level: str, cache_dir, prompt_length: int, steps: int):
+    if shared:
+        # Build the optimized-graph cache first, so every worker loads the cached graph and maps its weights.
+        create_session(model, opt_level, cache_dir=cache_dir, shared_weights=shared)
+    else:
+        # A cached graph would map prepacked weights here too: private mode prepacks at load time.
+        cache_dir = None
+    ctx = mp.get_context("spawn")
+    manager = ctx.Manager()
+    barrier = ctx.Barrier(processes)
+    results = manager.dict()
+    workers = [
+        ctx.Process(
+            target=_worker,
+            args=(index, model, opt_level, cache_dir, shared, prompt_length, steps, barrier, results),
+        )
+        for index in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        exitcodes = join_workers(workers, barrier)
+        rows = [results[index] for index in sorted(results.keys())]
+    finally:
+        manager.shutdown()
+    if len(rows) != processes or any(exitcodes):
+        raise RuntimeError(f"{processes - len(rows)} worker(s) failed (exit codes {exitcodes})")
+    return rows
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Per-process memory of N inference workers (shared vs private weights).")
+    parser.add_argument(
+        "--model",
+        default="epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx",
+        help="Path to ONNX model",
+    )
+    parser.add_argument("--processes", type=int, default=4, help="Worker processes per mode")
+    parser.add_argument("--modes", nargs="+", choices=["private", "shared"], default=["private", "shared"])
+    parser.add_argument(
+        "--opt-level",
+        choices=list(OPT_LEVELS),
+        default=DEFAULT_OPT_LEVEL,
+        help="Graph optimization level of both modes; with 'disable' shared mode skips prepacking instead of using the cache",
+    )
+    parser.add_argument("--ort-cache-dir", default=str(DEFAULT_CACHE_DIR), help="Optimized-graph cache directory")
+    parser.add_argument("--prompt-length", type=int, default=64, help="Prefill length per worker")
+    parser.add_argument("--decode-steps", type=int, default=16, help="Greedy decode steps per worker")
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        rows = run_processes(
+            args.model,
+            args.processes,
+            mode == "shared",
+            args.opt_level,
+            args.ort_cache_dir,
+            args.prompt_length,
+            args.decode_steps,
+        )
+        print(f"\n{mode}: {args.processes} processes")
+        print(f"{'proc':>4} {'RSS MB':>8} {'PSS MB':>8} {'shared MB':>10} {'private MB':>11} {'token ms':>9}")
+        for index, row in enumerate(rows):
+            shared_mb = row.get("shared_clean_mb", 0.0) + row.get("shared_dirty_mb", 0.0)
+            print(
+                f"{index:>4} {row.get('rss_mb', 0):>8.0f} {row.get('pss_mb', 0):>8.0f} {shared_mb:>10.0f} "
+                f"{row.get('private_mb', 0):>11.0f} {row['token_ms']:>9.2f}"
+            )
+        print(
+            f"total: RSS={sum(r.get('rss_mb', 0) for r in rows):.0f}MB "
+            f"PSS={sum(r.get('pss_mb', 0) for r in rows):.0f}MB "
+            f"private={sum(r.get('private_mb', 0) for r in rows):.0f}MB"
+        )
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
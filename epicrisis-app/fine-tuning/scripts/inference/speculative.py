@@ -0,0 +1,396 @@
+"""
+Speculative decoding over the ONNX decode engine.
+
+A drafter proposes the next k tokens; the target model scores the last
+accepted token plus the k drafts in one multi-token forward
+(DecodeEngine.forward(num_logits=k + 1)) and keeps the longest prefix it
+agrees with. Every verification run yields at least one token, and on
+rejection the KV cache is rolled back to the accepted length
+(DecodeEngine.truncate).
+
+Acceptance follows speculative sampling: draft token d is kept with
+probability min(1, p(d) / q(d)) and a rejection resamples from
+max(p - q, 0), so the output distribution is the target's. Greedy requests
+use one-hot p, i.e. the draft must equal the argmax. Drafters without a
+distribution (prompt lookup) count as q(d) = 1.
+
+PromptLookupDrafter matches the last n generated tokens against token
+sources - the prompt itself and the generate_narrative() skeleton of the
+episode - and proposes what followed the match. Epicrisis text copies CIE-10,
+ATC and K codes and drug + dose strings from the input JSON, so those spans
+are usually accepted whole.
+
+DraftModelDrafter runs a smaller model with the same tokenizer (the 0.5B
+fine-tune drafting for the 1.5B one) on its own DecodeEngine. Before each
+proposal its KV cache is rolled back to the prefix it shares with the
+accepted sequence, so rejected drafts never leak into later steps.
+
+Usage (benchmark against plain decoding):
+  python3 epicrisis-app/fine-tuning/scripts/inference/speculative.py \
+    --model epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx \
+    --limit 8 --num-draft 8
+
+  python3 epicrisis-app/fine-tuning/scripts/inference/speculative.py \
+    --model epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx \
+    --draft-model epicrisis-app/models/epicrisis-0.5b-q4f16/onnx/model_q4f16.onnx \
+    --num-draft 4 --temperature 0.3 --top-p 0.9 --seed 0
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from batch_generate import load_episodes
+from logits_processors import BatchSamplingParams, LogitsPipeline, TokenHistory
+from onnx_engine import DecodeEngine, ModelGeometry
+from ort_session import add_session_arguments, session_from_args
+from prompt_compiler import build_chatml_prompt, load_prompt_style
+from sampling import SamplingParams
+from stopping import StopCriteria
+from streaming import stream_generate
+
+TRAINING_DIR = Path(__file__).resolve().parents[1] / "training"
+
+
+def payload_from_text(text: str):
+    """First JSON object embedded in `text` (e.g. a `--user "Epicrisis: {...}"` message), or None."""
+    start = text.find("{")
+    if start < 0:
+        return None
+    try:
+        payload, _ = json.JSONDecoder().raw_decode(text[start:])
+    except json.JSONDecodeError:
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+def narrative_skeletons(payload: dict, variants: int = 4) -> list:
+    """generate_narrative() renderings of an episode; each seed picks different connector templates."""
+    if str(TRAINING_DIR) not in sys.path:
+        sys.path.append(str(TRAINING_DIR))
+    from generate_extra_datasets import generate_narrative
+
+    state = random.getstate()
+    texts = []
+    try:
+        for seed in range(variants):
+            random.seed(seed)
+            texts.append(
+                generate_narrative(
+                    payload["dx"][0],
+                    payload.get("proc", []),
+                    payload.get("tto", []),
+                    payload.get("evo", ""),
+                    payload.get("dx_alta", []),
+                    payload.get("med", []),
+                )
+            )
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return []
+    finally:
+        random.setstate(state)
+    return list(dict.fromkeys(texts))
+
+
+class PromptLookupDrafter:
+    """Propose continuations by matching the generated suffix against n-grams of token sources."""
+
+    def __init__(self, sources, max_ngram: int = 3, min_ngram: int = 2):
+        self.sources = [list(source) for source in sources]
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+        # n-gram -> (source, end); later sources (skeletons) and later positions win.
+        self._index = {}
+        for index, source in enumerate(self.sources):
+            for n in range(min_ngram, max_ngram + 1):
+                for end in range(n, len(source)):
+                    self._index[tuple(source[end - n : end])] = (index, end)
+
+    def start(self, prompt_ids) -> None:
+        pass
+
+    def propose(self, tokens, count: int):
+        """Return (draft token ids, None); drafts are deterministic."""
+        if count <= 0:
+            return [], None
+        for n in range(min(self.max_ngram, len(tokens)), self.min_ngram - 1, -1):
+            hit = self._index.get(tuple(tokens[-n:]))
+            if hit is not None:
+                index, end = hit
+                return self.sources[index][end : end + count], None
+        return [], None
+
+
+class DraftModelDrafter:
+    """Propose tokens sampled from a smaller model; returns their distributions for rejection sampling."""
+
+    def __init__(self, engine: DecodeEngine, sampling: SamplingParams = None, eos_token_ids=()):
+        sampling = sampling or SamplingParams()
+        self.engine = engine
+        self.params = BatchSamplingParams([sampling])
+        self.rng = np.random.default_rng(None if sampling.seed is None else [sampling.seed, 1])
+        self.pipeline = LogitsPipeline(eos_token_ids=eos_token_ids)
+        self.forwards = 0
+        self._prompt_length = 0
+        self._cached = []
+
+    def start(self, prompt_ids) -> None:
+        self._prompt_length = len(prompt_ids)
+        self._cached = []
+        self.engine.reset(batch=1)
+
+    def propose(self, tokens, count: int):
+        """Return (draft token ids, [q distribution per draft token])."""
+        if count <= 0:
+            return [], None
+        # Reuse the KV of the longest shared prefix; at least one token is fed to get fresh logits.
+        limit = min(len(self._cached), len(tokens) - 1)
+        common = 0
+        while common < limit and self._cached[common] == tokens[common]:
+            common += 1
+        if common:
+            self.engine.truncate(common)
+        else:
+            self.engine.reset(batch=1)
+        logits = self.engine.prefill(np.array([tokens[common:]], dtype=np.int64))
+        self.forwards += 1
+        self._cached = list(tokens)
+
+        history = TokenHistory(1, len(tokens) - self._prompt_length + count)
+        for token_id in tokens[self._prompt_length :]:
+            history.append(token_id)
+        draft, probs = [], []
+        for position in range(count):
+            q = _target_probs(self.pipeline, logits[0], history, self.params)
+            token_id = _pick(q, self.rng)
+            draft.append(token_id)
+            probs.append(q)
+            if position == count - 1:
+                break
+            history.append(token_id)
+            logits = self.engine.forward(np.array([[token_id]], dtype=np.int64))
+            self.forwards += 1
+            self._cached.append(token_id)
+        return draft, probs
+
+
+def _target_probs(pipeline: LogitsPipeline, logits: np.ndarray, history: TokenHistory, params) -> np.ndarray:
+    """Next-token distribution after the processor chain (one-hot for greedy rows)."""
+    processed, floor = pipeline(logits[None, :], history.view(), params)
+    row = processed[0].astype(np.float64)
+    row[row < floor[0]] = -np.inf
+    probs = np.zeros_like(row)
+    if not params.sampled[0]:
+        probs[int(np.argmax(row))] = 1.0
+        return probs
+    np.exp(row - row.max(), out=probs)
+    return probs / probs.sum()
+
+
+def _pick(probs: np.ndarray, rng) -> int:
+    if probs.max() == 1.0:
+        return int(np.argmax(probs))
+    return int(rng.choice(len(probs), p=probs))
+
+
+def speculative_generate(
+    engine: DecodeEngine,
+    prompt_ids,
+    drafter,
+    stop_criteria: StopCriteria,
+    sampling: SamplingParams = None,
+    eos_token_ids=(),
+    num_draft: int = 8,
+    prefill_chunk: int = None,
+):
+    """
+    Generate from a single-row engine with draft-and-verify steps.
+
+    The engine needs room for prompt + max_new_tokens + num_draft positions.
+    Returns (token ids with stop tokens trimmed, stats dict).
+    """
+    sampling = sampling or SamplingParams()
+    params = BatchSamplingParams([sampling])
+    rng = sampling.rng()
+    pipeline = LogitsPipeline(eos_token_ids=eos_token_ids)
+    budget = stop_criteria.max_new_tokens or engine.max_length - len(prompt_ids) - num_draft
+    history = TokenHistory(1, budget + 1)
+    stop = stop_criteria.matcher()
+    context = list(prompt_ids)
+    tokens = []
+    stats = {"forwards": 1, "drafted": 0, "accepted": 0}
+
+    def emit(token_id: int) -> bool:
+        tokens.append(token_id)
+        history.append(token_id)
+        return stop.update(token_id)
+
+    drafter.start(context)
+    engine.reset(batch=1)
+    logits = engine.prefill(np.array([context], dtype=np.int64), chunk_size=prefill_chunk)
+    done = emit(_pick(_target_probs(pipeline, logits[0], history, params), rng))
+    while not done:
+        draft, draft_probs = drafter.propose(context + tokens, min(num_draft, budget - len(tokens) - 1))
+        inputs = [tokens[-1]] + list(draft)
+        past = engine.cache.length
+        all_logits = engine.forward(np.array([inputs], dtype=np.int64), num_logits=len(inputs))[0]
+        stats["forwards"] += 1
+        stats["drafted"] += len(draft)
+
+        accepted = 0
+        for position in range(len(inputs)):
+            probs = _target_probs(pipeline, all_logits[position], history, params)
+            if position == len(draft):
+                done = emit(_pick(probs, rng))
+                break
+            token_id = draft[position]
+            q = 1.0 if draft_probs is None else draft_probs[position][token_id]
+            if probs[token_id] >= q or rng.random() * q < probs[token_id]:
+                accepted += 1
+                done = emit(token_id)
+                if done:
+                    break
+                continue
+            residual = probs.copy()
+            if draft_probs is None:
+                residual[token_id] = 0.0
+            else:
+                np.maximum(residual - draft_probs[position], 0.0, out=residual)
+            done = emit(_pick(residual / residual.sum(), rng))
+            break
+        stats["accepted"] += accepted
+        engine.truncate(past + 1 + accepted)
+
+    if stop.reason in ("eos", "stop_sequence"):
+        del tokens[len(tokens) - stop.matched_length :]
+    stats["generated"] = stop.num_tokens
+    stats["acceptance"] = stats["accepted"] / stats["drafted"] if stats["drafted"] else 0.0
+    stats["tokens_per_forward"] = stop.num_tokens / stats["forwards"]
+    return tokens, stats
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Speculative decoding benchmark (ONNX Runtime).")
+    parser.add_argument(
+        "--model",
+        default="epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx",
+        help="Path to ONNX model",
+    )
+    parser.add_argument(
+        "--tokenizer",
+        default=None,
+        help="Path to tokenizer directory (defaults to model's parent directory)",
+    )
+    parser.add_argument(
+        "--episodes",
+        default=str(Path(__file__).resolve().parents[2] / "datasets" / "dataset_epicrisis_350_completo.jsonl"),
+        help="Episodes (.jsonl with compact 'input' or .json)",
+    )
+    parser.add_argument("--limit", type=int, default=8, help="Number of episodes to generate")
+    parser.add_argument("--max-new-tokens", type=int, default=256, help="New-token budget per episode")
+    parser.add_argument("--num-draft", type=int, default=8, help="Draft tokens verified per forward")
+    parser.add_argument("--max-ngram", type=int, default=3, help="Longest suffix n-gram to look up")
+    parser.add_argument("--min-ngram", type=int, default=2, help="Shortest suffix n-gram to look up")
+    parser.add_argument("--no-skeleton", action="store_true", help="Only look up in the prompt")
+    parser.add_argument(
+        "--draft-model",
+        default=None,
+        help="Smaller ONNX model (same tokenizer) used as drafter instead of prompt lookup",
+    )
+    parser.add_argument(
+        "--draft-config",
+        default=None,
+        help="config.json of the draft model (defaults to its model's parent directory)",
+    )
+    parser.add_argument("--temperature", type=float, default=0.0, help="Sampling temperature (0 = greedy)")
+    parser.add_argument("--top-k", type=int, default=0, help="Top-k sampling (0 = disabled)")
+    parser.add_argument("--top-p", type=float, default=0.0, help="Top-p (nucleus) sampling (0 = disabled)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for sampling")
+    parser.add_argument("--no-baseline", action="store_true", help="Skip plain decoding (no speedup figure)")
+    add_session_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        from transformers import AutoTokenizer
+    except Exception as exc:
+        raise RuntimeError("transformers is required for speculative decoding") from exc
+
+    tokenizer_dir = args.tokenizer or Path(args.model).parent.parent
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir)
+    style = load_prompt_style(args.model)
+
+    sess = session_from_args(args, args.model)
+    geometry = ModelGeometry.from_session(sess, config_path=Path(tokenizer_dir) / "config.json")
+
+    episodes = load_episodes(args.episodes, args.limit)
+    prompts = [tokenizer.encode(build_chatml_prompt(e, style), add_special_tokens=False) for e in episodes]
+    stop_criteria = StopCriteria.from_tokenizer(tokenizer, max_new_tokens=args.max_new_tokens)
+    eos_ids = [tokenizer.eos_token_id] if tokenizer.eos_token_id is not None else []
+    max_length = max(len(p) for p in prompts) + args.max_new_tokens + args.num_draft
+    engine = DecodeEngine(sess, max_length, geometry)
+    sampling = SamplingParams(args.temperature, args.top_k, args.top_p, seed=args.seed)
+
+    draft_drafter = None
+    if args.draft_model:
+        draft_sess = session_from_args(args, args.draft_model)
+        draft_config = args.draft_config or Path(args.draft_model).parent.parent / "config.json"
+        draft_engine = DecodeEngine(draft_sess, max_length, ModelGeometry.from_session(draft_sess, draft_config))
+        if draft_engine.vocab_size and engine.vocab_size and draft_engine.vocab_size != engine.vocab_size:
+            raise RuntimeError(f"Vocab mismatch: draft {draft_engine.vocab_size} vs target {engine.vocab_size}")
+        draft_drafter = DraftModelDrafter(draft_engine, sampling, eos_ids)
+
+    totals = {"forwards": 0, "drafted": 0, "accepted": 0, "generated": 0, "spec_s": 0.0, "base_s": 0.0, "same": 0}
+    for index, (episode, prompt) in enumerate(zip(episodes, prompts)):
+        if draft_drafter is not None:
+            drafter = draft_drafter
+        else:
+            sources = [prompt]
+            if not args.no_skeleton:
+                sources += [tokenizer.encode(t, add_special_tokens=False) for t in narrative_skeletons(episode)]
+            drafter = PromptLookupDrafter(sources, args.max_ngram, args.min_ngram)
+
+        start = time.perf_counter()
+        tokens, stats = speculative_generate(engine, prompt, drafter, stop_criteria, sampling, eos_ids, args.num_draft)
+        spec_s = time.perf_counter() - start
+        for key in ("forwards", "drafted", "accepted", "generated"):
+            totals[key] += stats[key]
+        totals["spec_s"] += spec_s
+
+        line = (
+            f"[{index}] generated={stats['generated']} forwards={stats['forwards']} "
+            f"acceptance={stats['acceptance']:.2f} tokens/forward={stats['tokens_per_forward']:.2f} "
+            f"time={spec_s:.2f}s"
+        )
+        if not args.no_baseline:
+            start = time.perf_counter()
+            baseline = list(stream_generate(engine, prompt, stop_criteria, sampling, eos_ids))
+            base_s = time.perf_counter() - start
+            totals["base_s"] += base_s
+            totals["same"] += baseline == tokens
+            line += f" baseline={base_s:.2f}s same={baseline == tokens}"
+        print(line)
+
+    acceptance = totals["accepted"] / totals["drafted"] if totals["drafted"] else 0.0
+    print(
+        f"episodes={len(prompts)} generated={totals['generated']} forwards={totals['forwards']} "
+        f"acceptance={acceptance:.2f} tokens/forward={totals['generated'] / max(totals['forwards'], 1):.2f} "
+        f"tokens/s={totals['generated'] / totals['spec_s']:.1f}"
+    )
+    if draft_drafter is not None:
+        print(f"draft forwards={draft_drafter.forwards}")
+    if not args.no_baseline and totals["spec_s"]:
+        speedup = f"speedup: {totals['base_s'] / totals['spec_s']:.2f}x"
+        if not sampling.temperature:
+            speedup += f" (identical greedy outputs: {totals['same']}/{len(prompts)})"
+        print(speedup)
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
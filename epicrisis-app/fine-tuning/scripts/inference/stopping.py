@@ -0,0 +1,114 @@
+"""
+Token-level stop conditions for the ONNX decode loop.
+
+Stop strings are tokenized once into a TokenTrie. Each generated token only
+advances the set of live trie nodes (at most one per possible match start),
+so checking a step never decodes text and costs O(live matches).
+"""
+
+QWEN_EOS_TOKEN_ID = 151645
+QWEN_STOP_TOKENS = ("<|im_end|>", "<|endoftext|>")
+
+
+class TokenTrie:
+    """Prefix tree over token-id sequences."""
+
+    def __init__(self):
+        self.root = {}
+        self.max_depth = 0
+
+    def insert(self, token_ids) -> None:
+        token_ids = list(token_ids)
+        if not token_ids:
+            return
+        node = self.root
+        for token_id in token_ids:
+            node = node.setdefault(token_id, {})
+        node[None] = len(token_ids)
+        self.max_depth = max(self.max_depth, len(token_ids))
+
+    def __bool__(self) -> bool:
+        return bool(self.root)
+
+
+class StopCriteria:
+    """EOS ids, multi-token stop sequences and a new-token budget."""
+
+    def __init__(self, eos_token_ids=(), stop_sequences=(), max_new_tokens: int = None):
+        self.eos_token_ids = frozenset(eos_token_ids)
+        self.max_new_tokens = max_new_tokens
+        self.stop_sequences = [list(sequence) for sequence in stop_sequences]
+        self.trie = TokenTrie()
+        for sequence in self.stop_sequences:
+            self.trie.insert(sequence)
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, stop_strings=(), max_new_tokens: int = None) -> "StopCriteria":
+        """Build criteria from a HF tokenizer; each stop string is also matched with a leading space."""
+        eos_ids = {tokenizer.eos_token_id} if tokenizer.eos_token_id is not None else set()
+        for token in QWEN_STOP_TOKENS:
+            token_id = tokenizer.convert_tokens_to_ids(token)
+            if isinstance(token_id, int) and token_id != tokenizer.unk_token_id:
+                eos_ids.add(token_id)
+        sequences = []
+        for text in stop_strings:
+            for variant in (text, " " + text):
+                encoded = tokenizer.encode(variant, add_special_tokens=False)
+                if len(encoded) == 1:
+                    eos_ids.add(encoded[0])
+                else:
+                    sequences.append(encoded)
+        return cls(eos_ids, sequences, max_new_tokens)
+
+    def matcher(self) -> "StopMatcher":
+        return StopMatcher(self)
+
+
+class StopMatcher:
+    """Per-sequence stop state; feed it every generated token."""
+
+    def __init__(self, criteria: StopCriteria):
+        self.criteria = criteria
+        self.num_tokens = 0
+        self.reason = None
+        self.matched_length = 0
+        self._live = []
+
+    @property
+    def done(self) -> bool:
+        return self.reason is not None
+
+    @property
+    def pending(self) -> int:
+        """Trailing tokens that may still turn out to start a stop sequence (hold them back when streaming)."""
+        return max((depth for _, depth in self._live), default=0)
+
+    def update(self, token_id: int) -> bool:
+        """Register one token; return True once generation should stop."""
+        if self.reason is not None:
+            return True
+        criteria = self.criteria
+        self.num_tokens += 1
+
+        if token_id in criteria.eos_token_ids:
+            self.reason = "eos"
+            self.matched_length = 1
+            return True
+
+        if criteria.trie:
+            live = []
+            for node, depth in self._live + [(criteria.trie.root, 0)]:
+                child = node.get(token_id)
+                if child is None:
+                    continue
+                if None in child:
+                    self.reason = "stop_sequence"
+                    self.matched_length = child[None]
+                    return True
+                live.append((child, depth + 1))
+            self._live = live
+
+        if criteria.max_new_tokens is not None and self.num_tokens >= criteria.max_new_tokens:
+            self.reason = "max_new_tokens"
+            return True
+        return False
@@ -0,0 +1,111 @@
+"""
+Token streaming over the ONNX decode engine.
+
+stream_generate() is an iterator over generated token ids, yielded as soon as
+they are sampled. Tokens that could still be the start of a stop sequence are
+held back until the match fails, so a stop string never reaches the client.
+
+IncrementalDetokenizer turns those ids into text deltas without decoding the
+whole sequence every step. It decodes only a short window of recent tokens,
+and holds output while the window ends in an incomplete UTF-8 sequence
+(U+FFFD). That happens when a byte-level BPE token splits a multi-byte
+character such as "ó" or "ñ".
+"""
+
+import numpy as np
+
+from logits_processors import BatchSamplingParams, LogitsPipeline, TokenHistory
+from sampling import SamplingParams
+from stopping import StopCriteria
+
+REPLACEMENT_CHAR = "\ufffd"
+
+
+class IncrementalDetokenizer:
+    """Text deltas from a growing token sequence (HF tokenizer)."""
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.tokens = []
+        self.text = ""
+        self._prefix_offset = 0
+        self._read_offset = 0
+        self._prefix_text = ""
+
+    def _decode(self, tokens) -> str:
+        return self.tokenizer.decode(tokens, skip_special_tokens=self.skip_special_tokens)
+
+    def push(self, token_id: int) -> str:
+        """Add one token; return the newly completed text (may be empty)."""
+        self.tokens.append(token_id)
+        window_text = self._decode(self.tokens[self._prefix_offset :])
+        if len(window_text) <= len(self._prefix_text) or window_text.endswith(REPLACEMENT_CHAR):
+            return ""
+        delta = window_text[len(self._prefix_text) :]
+        self._prefix_offset = self._read_offset
+        self._read_offset = len(self.tokens)
+        self._prefix_text = self._decode(self.tokens[self._prefix_offset : self._read_offset])
+        self.text += delta
+        return delta
+
+    def flush(self) -> str:
+        """Return whatever is still held back (e.g. a trailing incomplete character)."""
+        window_text = self._decode(self.tokens[self._prefix_offset :])
+        delta = window_text[len(self._prefix_text) :]
+        self._prefix_offset = self._read_offset = len(self.tokens)
+        self._prefix_text = ""
+        self.text += delta
+        return delta
+
+
+def stream_generate(
+    engine,
+    prompt_ids,
+    stop_criteria: StopCriteria,
+    sampling: SamplingParams = None,
+    eos_token_ids=(),
+    prefill_chunk: int = None,
+):
+    """
+    Generate from a single-row DecodeEngine, yielding token ids as they are produced.
+
+    EOS and stop-sequence tokens are never yielded. The engine must have room
+    for the prompt plus stop_criteria.max_new_tokens.
+    """
+    sampling = sampling or SamplingParams()
+    params = BatchSamplingParams([sampling])
+    rngs = [sampling.rng()]
+    pipeline = LogitsPipeline(eos_token_ids=eos_token_ids)
+    budget = stop_criteria.max_new_tokens or engine.max_length - len(prompt_ids)
+    history = TokenHistory(1, budget)
+    stop = stop_criteria.matcher()
+
+    engine.reset(batch=1)
+    logits = engine.prefill(np.array([prompt_ids], dtype=np.int64), chunk_size=prefill_chunk)
+    tokens = []
+    emitted = 0
+    while True:
+        token_id = int(pipeline.sample(logits, history.view(), params, rngs)[0])
+        history.append(token_id)
+        tokens.append(token_id)
+        if stop.update(token_id) or len(tokens) >= budget:
+            break
+        ready = len(tokens) - stop.pending
+        yield from tokens[emitted:ready]
+        emitted = max(emitted, ready)
+        logits = engine.forward(np.array([[token_id]], dtype=np.int64))
+    if stop.reason in ("eos", "stop_sequence"):
+        del tokens[len(tokens) - stop.matched_length :]
+    yield from tokens[emitted:]
+
+
+def stream_text(token_ids, detokenizer: IncrementalDetokenizer):
+    """Map an iterator of token ids to non-empty text deltas."""
+    for token_id in token_ids:
+        delta = detokenizer.push(token_id)
+        if delta:
+            yield delta
+    delta = detokenizer.flush()
+    if delta:
+        yield delta
@@ -0,0 +1,388 @@
+"""
+Resident ONNX inference worker with a continuous-batching scheduler.
+
+One session stays loaded; requests are queued and admitted into the running
+decode batch at token boundaries, and finished rows are evicted as soon as
+they stop, so a long generation never holds back short ones.
+
+Each slot is one row of the shared KV cache (its own region, left-padded to
+the batch length) and carries its own SamplingParams, RNG and StopCriteria.
+
+With `prefill_chunk` set, each tick spends at most that many prompt tokens on
+prefill before the decode step, so a long incoming prompt is fed over several
+ticks instead of stalling every running generation for one big prefill.
+
+With a PrefixCache, a request submitted with `prefix_length` (the shared
+ChatML system block) restores that prefix's KV instead of prefilling it; the
+first request to prefill a prefix stores it for the rest.
+
+Usage (replays episodes with Poisson arrivals and reports latency percentiles):
+  python3 epicrisis-app/fine-tuning/scripts/inference/worker.py \
+    --model epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx \
+    --limit 16 --slots 4 --rate 0.5 --temperature 0.3 --top-p 0.9 --prefill-chunk 256 \
+    --prefix-cache-mb 64
+"""
+
+import argparse
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+
+import numpy as np
+import onnxruntime as ort
+
+from batch_generate import load_episodes
+from onnx_engine import DecodeEngine, ModelGeometry
+from ort_session import add_session_arguments, percentile, session_from_args
+from logits_processors import BatchSamplingParams, LogitsPipeline, TokenHistory
+from prefix_cache import PrefixCache
+from prompt_compiler import build_chatml_prompt, chatml_prefix, load_prompt_style
+from sampling import SamplingParams
+from stopping import StopCriteria
+
+
+class GenerationRequest:
+    """One queued/running generation and its per-request state."""
+
+    def __init__(self, prompt_ids, sampling: SamplingParams, stop_criteria: StopCriteria, prefix_length: int = None):
+        self.prompt_ids = list(prompt_ids)
+        self.prefix_length = prefix_length
+        self.sampling = sampling
+        self.rng = sampling.rng()
+        self.stop = stop_criteria.matcher()
+        self.tokens = []
+        self.prefilled = 0
+        self.cached_tokens = 0
+        self.future = Future()
+        self.submitted_at = time.perf_counter()
+        self.admitted_at = None
+        self.first_token_at = None
+
+    def result(self, timeout: float = None) -> dict:
+        return self.future.result(timeout)
+
+
+class InferenceWorker:
+    """Continuous-batching scheduler around a DecodeEngine."""
+
+    def __init__(
+        self,
+        sess: ort.InferenceSession,
+        max_slots: int = 4,
+        max_length: int = 2048,
+        geometry: ModelGeometry = None,
+        eos_token_id: int = None,
+        prefill_chunk: int = None,
+        prefix_cache: PrefixCache = None,
+    ):
+        geometry = geometry or ModelGeometry.from_session(sess)
+        self.max_slots = max_slots
+        self.prefill_chunk = prefill_chunk
+        self.prefix_cache = prefix_cache
+        self.max_length = max_length
+        self.eos_token_id = eos_token_id
+        self.decoder = DecodeEngine(sess, max_length, geometry, batch=max_slots)
+        self.decoder.reset(batch=0)
+        self.prefiller = DecodeEngine(sess, max_length, geometry, batch=1)
+        self._pending = queue.Queue()
+        self._prefilling = None
+        self._slots = []
+        self._next_tokens = np.zeros(max_slots, dtype=np.int64)
+        self.pipeline = LogitsPipeline(eos_token_ids=[eos_token_id] if eos_token_id is not None else [])
+        self._history = TokenHistory(max_slots, max_length)
+        self._history.reset(0)
+        self._params = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def submit(
+        self,
+        prompt_ids,
+        sampling: SamplingParams = None,
+        stop_criteria: StopCriteria = None,
+        prefix_length: int = None,
+    ) -> GenerationRequest:
+        """Queue a prompt; `prefix_length` marks its leading tokens as shareable through the prefix cache."""
+        budget = self.max_length - len(prompt_ids)
+        if budget <= 0:
+            raise ValueError(f"Prompt of {len(prompt_ids)} tokens does not fit max_length={self.max_length}")
+        if stop_criteria is None:
+            eos = [self.eos_token_id] if self.eos_token_id is not None else []
+            stop_criteria = StopCriteria(eos, max_new_tokens=budget)
+        elif stop_criteria.max_new_tokens is None or stop_criteria.max_new_tokens > budget:
+            raise ValueError(f"max_new_tokens must be set and <= {budget} for this prompt")
+        request = GenerationRequest(prompt_ids, sampling or SamplingParams(), stop_criteria, prefix_length)
+        self._pending.put(request)
+        return request
+
+    def start(self) -> "InferenceWorker":
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="inference-worker", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    @property
+    def active(self) -> int:
+        return len(self._slots)
+
+    def step(self) -> bool:
+        """One scheduler tick: prefill/admit waiting requests, then one decode step. Returns False when idle."""
+        budget = self.prefill_chunk
+        while len(self._slots) < self.max_slots and (budget is None or budget > 0):
+            if self._prefilling is None:
+                try:
+                    request = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                self._start_prefill(request)
+            consumed = self._prefill(budget)
+            if budget is not None:
+                budget -= consumed
+        if not self._slots:
+            return self._prefilling is not None
+
+        batch = len(self._slots)
+        logits = self.decoder.forward(self._next_tokens[:batch, None])
+        if self._params is None:
+            self._params = BatchSamplingParams([request.sampling for request in self._slots])
+        tokens = self.pipeline.sample(
+            logits, self._history.view(), self._params, [request.rng for request in self._slots]
+        )
+        self._history.append(tokens)
+        keep = []
+        for row, request in enumerate(self._slots):
+            token_id = int(tokens[row])
+            request.tokens.append(token_id)
+            if request.stop.update(token_id):
+                self._finish(request)
+            else:
+                self._next_tokens[len(keep)] = token_id
+                keep.append(row)
+        if len(keep) < batch:
+            self.decoder.retain(keep)
+            self._history.retain(keep)
+            self._slots = [self._slots[row] for row in keep]
+            self._params = None
+        return True
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                if self.step():
+                    continue
+                try:
+                    request = self._pending.get(timeout=0.05)
+                except queue.Empty:
+                    continue
+                self._start_prefill(request)
+            except Exception as exc:  # noqa: BLE001
+                self._fail_all(exc)
+
+    def _fail_all(self, exc: Exception) -> None:
+        """Fail every running, prefilling and queued request with `exc` and reset the batch state."""
+        requests = list(self._slots)
+        if self._prefilling is not None:
+            requests.append(self._prefilling)
+        while True:
+            try:
+                requests.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        self._slots = []
+        self._prefilling = None
+        self._params = None
+        self.decoder.reset(batch=0)
+        self.prefiller.reset()
+        self._history.reset(0)
+        for request in requests:
+            if not request.future.done():
+                request.future.set_exception(exc)
+
+    def _start_prefill(self, request: GenerationRequest) -> None:
+        request.admitted_at = time.perf_counter()
+        # Tracked before the cache restore, so a failure there reaches this request's future.
+        self._prefilling = request
+        self.prefiller.reset()
+        if self.prefix_cache is not None:
+            # Keep at least one prompt token to prefill: its logits pick the first generated token.
+            length, kv = self.prefix_cache.lookup(request.prompt_ids, len(request.prompt_ids) - 1)
+            if kv is not None:
+                self.prefiller.restore_prefix(kv)
+                request.prefilled = request.cached_tokens = length
+
+    def _prefill(self, budget: int = None) -> int:
+        """Feed the next prompt chunk of the prefilling request (admitting it when done); return tokens fed."""
+        request = self._prefilling
+        end = len(request.prompt_ids) if budget is None else request.prefilled + budget
+        prefix_length = request.prefix_length if self.prefix_cache is not None else None
+        if prefix_length and request.prefilled < prefix_length:
+            # Stop the chunk at the prefix boundary so the prefix KV can be stored alone.
+            end = min(end, prefix_length)
+        chunk = request.prompt_ids[request.prefilled : end]
+        try:
+            logits = self.prefiller.forward(np.array([chunk], dtype=np.int64))
+        except Exception as exc:  # noqa: BLE001
+            self._prefilling = None
+            request.future.set_exception(exc)
+            return len(chunk)
+        request.prefilled += len(chunk)
+        if prefix_length and request.prefilled == prefix_length:
+            self.prefix_cache.insert(request.prompt_ids[:prefix_length], self.prefiller.snapshot_prefix(prefix_length))
+        if request.prefilled == len(request.prompt_ids):
+            self._prefilling = None
+            self._admit(request, logits)
+        return len(chunk)
+
+    def _admit(self, request: GenerationRequest, logits: np.ndarray) -> None:
+        try:
+            params = BatchSamplingParams([request.sampling])
+            token_id = int(self.pipeline.sample(logits, np.empty((1, 0), dtype=np.int64), params, [request.rng])[0])
+            request.tokens.append(token_id)
+            request.first_token_at = time.perf_counter()
+            if request.stop.update(token_id):
+                self._finish(request)
+                return
+            row = self.decoder.admit(self.prefiller)
+        except Exception as exc:  # noqa: BLE001
+            request.future.set_exception(exc)
+            return
+        self._next_tokens[row] = token_id
+        self._history.add_row(request.tokens)
+        self._slots.append(request)
+        self._params = None
+
+    def _finish(self, request: GenerationRequest) -> None:
+        stop = request.stop
+        tokens = request.tokens
+        if stop.reason in ("eos", "stop_sequence"):
+            tokens = tokens[: len(tokens) - stop.matched_length]
+        finished_at = time.perf_counter()
+        request.future.set_result(
+            {
+                "tokens": tokens,
+                "reason": stop.reason,
+                "generated_tokens": stop.num_tokens,
+                "cached_tokens": request.cached_tokens,
+                "queue_s": request.admitted_at - request.submitted_at,
+                "ttft_s": request.first_token_at - request.submitted_at,
+                "latency_s": finished_at - request.submitted_at,
+            }
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Continuous-batching ONNX inference worker (replay benchmark).")
+    parser.add_argument(
+        "--model",
+        default="epicrisis-app/models/epicrisis-q4f16-finetuned/onnx/model_q4f16.onnx",
+        help="Path to ONNX model",
+    )
+    parser.add_argument(
+        "--tokenizer",
+        default=None,
+        help="Path to tokenizer directory (defaults to model's parent directory)",
+    )
+    parser.add_argument(
+        "--episodes",
+        default=str(Path(__file__).resolve().parents[2] / "datasets" / "dataset_epicrisis_350_completo.jsonl"),
+        help="Episodes (.jsonl with compact 'input' or .json)",
+    )
+    parser.add_argument("--limit", type=int, default=16, help="Number of requests to replay")
+    parser.add_argument("--slots", type=int, default=4, help="Concurrent decode slots")
+    parser.add_argument("--rate", type=float, default=1.0, help="Mean arrivals per second (0 = all at once)")
+    parser.add_argument("--max-new-tokens", type=int, default=256, help="New-token budget per request")
+    parser.add_argument("--temperature", type=float, default=0.0, help="Sampling temperature (0 = greedy)")
+    parser.add_argument("--top-k", type=int, default=0, help="Top-k sampling (0 = disabled)")
+    parser.add_argument("--top-p", type=float, default=0.0, help="Top-p (nucleus) sampling (0 = disabled)")
+    parser.add_argument("--min-p", type=float, default=0.0, help="Min-p sampling (0 = disabled)")
+    parser.add_argument("--repetition-penalty", type=float, default=1.0, help="Repetition penalty (>1.0 applies)")
+    parser.add_argument("--no-eos", action="store_true", help="Prevent eos_token_id from being selected")
+    parser.add_argument("--seed", type=int, default=None, help="Base seed (request i uses seed + i)")
+    parser.add_argument(
+        "--prefill-chunk",
+        type=int,
+        default=None,
+        help="Prompt tokens prefilled per scheduler tick (default: whole prompt at admission)",
+    )
+    parser.add_argument(
+        "--prefix-cache-mb",
+        type=float,
+        default=0.0,
+        help="KV prefix cache size for the shared system block (0 = disabled)",
+    )
+    add_session_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        from transformers import AutoTokenizer
+    except Exception as exc:
+        raise RuntimeError("transformers is required for the worker replay") from exc
+
+    tokenizer_dir = args.tokenizer or Path(args.model).parent.parent
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir)
+    style = load_prompt_style(args.model)
+
+    sess = session_from_args(args, args.model)
+    geometry = ModelGeometry.from_session(sess, config_path=Path(tokenizer_dir) / "config.json")
+
+    prompts = [
+        tokenizer.encode(build_chatml_prompt(episode, style), add_special_tokens=False)
+        for episode in load_episodes(args.episodes, args.limit)
+    ]
+    max_length = max(len(p) for p in prompts) + args.max_new_tokens
+    prefix_length = len(tokenizer.encode(chatml_prefix(), add_special_tokens=False))
+    prefix_cache = PrefixCache(int(args.prefix_cache_mb * 2**20)) if args.prefix_cache_mb > 0 else None
+    worker = InferenceWorker(
+        sess,
+        args.slots,
+        max_length,
+        geometry,
+        tokenizer.eos_token_id,
+        prefill_chunk=args.prefill_chunk,
+        prefix_cache=prefix_cache,
+    ).start()
+    stop_criteria = StopCriteria.from_tokenizer(tokenizer, max_new_tokens=args.max_new_tokens)
+
+    rng = np.random.default_rng(args.seed)
+    start = time.perf_counter()
+    requests = []
+    for index, prompt in enumerate(prompts):
+        sampling = SamplingParams.from_args(args)
+        if args.seed is not None:
+            sampling.seed = args.seed + index
+        requests.append(worker.submit(prompt, sampling, stop_criteria, prefix_length))
+        if args.rate > 0:
+            time.sleep(rng.exponential(1.0 / args.rate))
+    results = [request.result() for request in requests]
+    elapsed = time.perf_counter() - start
+    worker.stop()
+
+    latencies = [r["latency_s"] for r in results]
+    ttfts = [r["ttft_s"] for r in results]
+    generated = sum(r["generated_tokens"] for r in results)
+    print(f"requests={len(results)} slots={args.slots} generated={generated} tokens/s={generated / elapsed:.1f}")
+    print(
+        f"latency p50={percentile(latencies, 50):.2f}s p95={percentile(latencies, 95):.2f}s "
+        f"p99={percentile(latencies, 99):.2f}s"
+    )
+    print(f"ttft p50={percentile(ttfts, 50):.2f}s p95={percentile(ttfts, 95):.2f}s")
+    if prefix_cache is not None:
+        prompt_tokens = sum(len(p) for p in prompts)
+        cached = sum(r["cached_tokens"] for r in results)
+        print(
+            f"prefix cache: prefix={prefix_length} tokens cached={cached}/{prompt_tokens} prompt tokens "
+            f"({100.0 * cached / prompt_tokens:.0f}%) {prefix_cache.stats()}"
+        )
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -19,10 +19,23 @@ Uso:
 import argparse
 import json
 import os
+import sys
 from pathlib import Path
 
+# Prompt compartido con la inferencia (inference/prompt_compiler.py)
+sys.path.append(str(Path(__file__).resolve().parents[1] / "inference"))
+from prompt_compiler import (  # noqa: E402
+    DEFAULT_STYLE,
+    PROMPT_STYLE_FILE,
+    PROMPT_STYLES,
+    build_chatml_prompt,
+    build_training_text,
+    load_prompt_style,
+    save_prompt_style,
+)
 
-def prepare_datasets():
+
+def prepare_datasets(style: str = DEFAULT_STYLE):
     """Combina los datasets y los prepara en formato ChatML completo para MLX."""
     datasets_dir = Path(__file__).parent / "datasets"
     output_dir = Path(__file__).parent / "mlx_data"
@@ -70,34 +83,14 @@ def prepare_datasets():
 
     print(f"\nTotal de ejemplos: {len(all_examples)}")
 
-    # System instruction actualizada (igual que en app.js)
-    system_instruction = (
-        "Genera una epicrisis narrativa en UN SOLO PARRAFO. "
-        "USA SOLO la informacion del JSON, NO inventes datos. "
-        "IMPORTANTE: Incluye TODOS los codigos entre parentesis: "
-        "diagnostico de ingreso con codigo CIE-10 (ej: I20.0), "
-        "procedimientos con codigo K (ej: K492, K493), "
-        "medicacion con dosis y codigo ATC (ej: B01AC06). "
-        "Estructura: dx ingreso -> procedimientos -> evolucion -> dx alta -> medicacion alta. "
-        "Abreviaturas: DA=descendente anterior, CD=coronaria derecha, CX=circunfleja, "
-        "SDST=supradesnivel ST, IAM=infarto agudo miocardio."
-    )
-
     # Convertir a formato ChatML completo para Qwen2.5-Instruct
     chatml_examples = []
     for example in all_examples:
         input_data = example.get("input", {})
         output_text = example.get("output", "")
-        json_str = json.dumps(input_data, ensure_ascii=False, indent=2)
 
-        # Formato ChatML completo con tokens especiales
-        chatml_text = (
-            f"<|im_start|>system\n{system_instruction}<|im_end|>\n"
-            f"<|im_start|>user\n{json_str}<|im_end|>\n"
-            f"<|im_start|>assistant\n{output_text}<|im_end|>"
-        )
-
-        chatml_examples.append({"text": chatml_text})
+        # Formato ChatML completo con tokens especiales (el mismo prompt que en inferencia)
+        chatml_examples.append({"text": build_training_text(input_data, output_text, style)})
 
     # Dividir en train/valid (90/10)
     import random
@@ -120,9 +113,12 @@ def prepare_datasets():
         for example in valid_examples:
             f.write(json.dumps(example, ensure_ascii=False) + "\n")
 
+    save_prompt_style(output_dir, style)
+
     print(f"\nDatasets guardados en {output_dir}/")
     print(f"  - train.jsonl: {len(train_examples)} ejemplos")
     print(f"  - valid.jsonl: {len(valid_examples)} ejemplos")
+    print(f"  - {PROMPT_STYLE_FILE}: estilo de prompt '{style}'")
 
     return output_dir
 
@@ -194,6 +190,9 @@ lora_parameters:
         print(f"\nError durante el entrenamiento (código: {result.returncode})")
         return None
 
+    # El modelo debe consultarse con el mismo estilo de prompt con que se entrenó
+    save_prompt_style(output_path, load_prompt_style(data_dir))
+
     print(f"\n{'='*60}")
     print(f"Fine-tuning completado!")
     print(f"Adaptadores guardados en: {output_path}")
@@ -239,6 +238,8 @@ def merge_and_export(
         print(f"\nError durante la fusión (código: {result.returncode})")
         return None
 
+    save_prompt_style(output_full_path, load_prompt_style(adapter_full_path))
+
     print(f"\nModelo fusionado guardado en: {output_full_path}")
     return output_full_path
 
@@ -261,6 +262,7 @@ def test_model(
         adapter_full_path = Path(__file__).parent / adapter_path
         print(f"Cargando modelo base con adaptadores de: {adapter_full_path}")
         model, tokenizer = load(model_to_load, adapter_path=str(adapter_full_path))
+        style = load_prompt_style(adapter_full_path)
     else:
         model_full_path = Path(__file__).parent / model_path
         if not model_full_path.exists():
@@ -268,6 +270,7 @@ def test_model(
             return
         print(f"Cargando modelo fusionado de: {model_full_path}")
         model, tokenizer = load(str(model_full_path))
+        style = load_prompt_style(model_full_path)
 
     # Prompt de prueba
     test_input = {
@@ -285,16 +288,8 @@ def test_model(
         ],
     }
 
-    system_instruction = (
-        "Genera una epicrisis narrativa en UN SOLO PARRAFO. "
-        "USA SOLO la informacion del JSON, NO inventes datos. "
-        "Incluye: diagnostico de ingreso, procedimientos con codigos, evolucion, "
-        "diagnostico de alta y medicacion de alta con dosis y codigos ATC. "
-        "Abreviaturas: DA=descendente anterior, CD=coronaria derecha, CX=circunfleja, "
-        "SDST=supradesnivel ST, IAM=infarto agudo miocardio."
-    )
-
-    prompt = f"{system_instruction}\n\nEpicrisis:\n{json.dumps(test_input, ensure_ascii=False)}"
+    # Mismo prompt ChatML que en el entrenamiento y la inferencia
+    prompt = build_chatml_prompt(test_input, style)
 
     print(f"\n{'='*60}")
     print("Prueba del modelo")
@@ -380,6 +375,12 @@ def main():
         default="Qwen/Qwen2.5-0.5B-Instruct",
         help="Modelo base de HuggingFace",
     )
+    parser.add_argument(
+        "--prompt-style",
+        choices=PROMPT_STYLES,
+        default=DEFAULT_STYLE,
+        help=f"Estilo del JSON de entrada en el prompt; se guarda con el modelo (default: {DEFAULT_STYLE})",
+    )
 
     args = parser.parse_args()
 
@@ -398,7 +399,7 @@ def main():
 
     # Preparar datasets
     if args.prepare_only or args.train:
-        data_dir = prepare_datasets()
+        data_dir = prepare_datasets(args.prompt_style)
 
     # Entrenar
     if args.train:
@@ -6,20 +6,12 @@ Formato ChatML listo para fine-tuning en Google Colab.
 
 import json
 import random
+import sys
 from pathlib import Path
 
-# System instruction (igual que en app.js)
-SYSTEM_INSTRUCTION = (
-    "Genera una epicrisis narrativa en UN SOLO PARRAFO. "
-    "USA SOLO la informacion del JSON, NO inventes datos. "
-    "IMPORTANTE: Incluye TODOS los codigos entre parentesis: "
-    "diagnostico de ingreso con codigo CIE-10 (ej: I20.0), "
-    "procedimientos con codigo K (ej: K492, K493), "
-    "medicacion con dosis y codigo ATC (ej: B01AC06). "
-    "Estructura: dx ingreso -> procedimientos -> evolucion -> dx alta -> medicacion alta. "
-    "Abreviaturas: DA=descendente anterior, CD=coronaria derecha, CX=circunfleja, "
-    "SDST=supradesnivel ST, IAM=infarto agudo miocardio."
-)
+# Prompt compartido con la inferencia (inference/prompt_compiler.py)
+sys.path.append(str(Path(__file__).resolve().parents[1] / "inference"))
+from prompt_compiler import DEFAULT_STYLE, build_training_text, save_prompt_style  # noqa: E402
 
 
 def load_all_datasets():
@@ -73,15 +65,7 @@ def convert_to_chatml(example):
     """Convierte un ejemplo al formato ChatML."""
     input_data = example.get("input", {})
     output_text = example.get("output", "")
-    json_str = json.dumps(input_data, ensure_ascii=False, indent=2)
-
-    chatml_text = (
-        f"<|im_start|>system\n{SYSTEM_INSTRUCTION}<|im_end|>\n"
-        f"<|im_start|>user\n{json_str}<|im_end|>\n"
-        f"<|im_start|>assistant\n{output_text}<|im_end|>"
-    )
-
-    return {"text": chatml_text}
+    return {"text": build_training_text(input_data, output_text)}
 
 
 def main():
@@ -120,10 +104,13 @@ def main():
         for example in valid_examples:
             f.write(json.dumps(example, ensure_ascii=False) + "\n")
 
+    style_path = save_prompt_style(output_dir, DEFAULT_STYLE)
+
     print(f"\n" + "=" * 60)
     print("Datasets unificados guardados:")
     print(f"  - {train_path} ({len(train_examples)} ejemplos)")
     print(f"  - {valid_path} ({len(valid_examples)} ejemplos)")
+    print(f"  - {style_path} (estilo de prompt '{DEFAULT_STYLE}')")
     print("=" * 60)
 
     # Mostrar ejemplo
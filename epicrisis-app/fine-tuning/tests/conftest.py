@@ -0,0 +1,148 @@
+"""
+Shared pytest setup for the inference modules.
+
+The inference scripts import each other as top-level modules, so their
+directory is put on sys.path. test_model.py is a manual script for the
+fine-tuned checkpoint (torch + peft), not a pytest module.
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+INFERENCE_DIR = Path(__file__).resolve().parents[1] / "scripts" / "inference"
+DATA_DIR = Path(__file__).resolve().parents[3] / "data_example"
+sys.path.insert(0, str(INFERENCE_DIR))
+
+collect_ignore = ["test_model.py"]
+
+TOY_VOCAB = 64
+
+
+def build_toy_decoder(
+    path: Path, layers: int = 1, heads: int = 2, head_dim: int = 4, vocab: int = TOY_VOCAB, seed: int = 0
+):
+    """Tiny random decoder with the optimum-style I/O of the exported models (past_key_values.* / present.*)."""
+    onnx = pytest.importorskip("onnx")
+    from onnx import TensorProto, helper, numpy_helper
+
+    rng = np.random.default_rng(seed)
+    hidden = heads * head_dim
+    initializers, nodes = [], []
+
+    def const(name, array):
+        initializers.append(numpy_helper.from_array(array, name))
+
+    const("emb", rng.standard_normal((vocab, hidden)).astype(np.float32))
+    const("pos_emb", (rng.standard_normal((512, hidden)) * 0.1).astype(np.float32))
+    const("lm_head", (rng.standard_normal((hidden, vocab)) * 2).astype(np.float32))
+    const("heads_shape", np.array([0, 0, heads, head_dim], np.int64))
+    const("hidden_shape", np.array([0, 0, hidden], np.int64))
+    const("axes_12", np.array([1, 2], np.int64))
+    const("i2", np.array([2], np.int64))
+    const("i3", np.array([3], np.int64))
+    const("i4", np.array([4], np.int64))
+    const("one", np.array(1.0, np.float32))
+    const("big", np.array(1e9, np.float32))
+    const("scale", np.array(1.0 / np.sqrt(head_dim), np.float32))
+    inputs = [
+        helper.make_tensor_value_info("input_ids", TensorProto.INT64, ["batch", "seq"]),
+        helper.make_tensor_value_info("attention_mask", TensorProto.INT64, ["batch", "total"]),
+        helper.make_tensor_value_info("position_ids", TensorProto.INT64, ["batch", "seq"]),
+    ]
+    outputs = [helper.make_tensor_value_info("logits", TensorProto.FLOAT, ["batch", "seq", vocab])]
+    node = nodes.append
+    node(helper.make_node("Gather", ["emb", "input_ids"], ["tok"]))
+    node(helper.make_node("Gather", ["pos_emb", "position_ids"], ["pos"]))
+    node(helper.make_node("Add", ["tok", "pos"], ["x0"]))
+    node(helper.make_node("Cast", ["attention_mask"], ["mask_f"], to=TensorProto.FLOAT))
+    node(helper.make_node("Unsqueeze", ["mask_f", "axes_12"], ["mask4"]))
+    x = "x0"
+    for layer in range(layers):
+        p = f"l{layer}_"
+        for w in "qkvo":
+            const(p + w, (rng.standard_normal((hidden, hidden)) / np.sqrt(hidden)).astype(np.float32))
+        for w in "qkv":
+            node(helper.make_node("MatMul", [x, p + w], [p + w + "_flat"]))
+            node(helper.make_node("Reshape", [p + w + "_flat", "heads_shape"], [p + w + "_bshd"]))
+            node(helper.make_node("Transpose", [p + w + "_bshd"], [p + w + "_h"], perm=[0, 2, 1, 3]))
+        for kind, source in (("key", "k"), ("value", "v")):
+            inputs.append(
+                helper.make_tensor_value_info(
+                    f"past_key_values.{layer}.{kind}", TensorProto.FLOAT, ["batch", heads, "past", head_dim]
+                )
+            )
+            outputs.append(
+                helper.make_tensor_value_info(
+                    f"present.{layer}.{kind}", TensorProto.FLOAT, ["batch", heads, "total", head_dim]
+                )
+            )
+            node(
+                helper.make_node(
+                    "Concat", [f"past_key_values.{layer}.{kind}", p + source + "_h"], [f"present.{layer}.{kind}"], axis=2
+                )
+            )
+        # Causal mask over [past + seq], combined with the attention mask (left padding).
+        node(helper.make_node("Transpose", [f"present.{layer}.key"], [p + "kT"], perm=[0, 1, 3, 2]))
+        node(helper.make_node("MatMul", [p + "q_h", p + "kT"], [p + "s0"]))
+        node(helper.make_node("Mul", [p + "s0", "scale"], [p + "s1"]))
+        node(helper.make_node("Shape", [p + "s1"], [p + "shape"]))
+        node(helper.make_node("Slice", [p + "shape", "i2", "i4"], [p + "st"]))
+        node(helper.make_node("Slice", [p + "shape", "i2", "i3"], [p + "S"]))
+        node(helper.make_node("Slice", [p + "shape", "i3", "i4"], [p + "T"]))
+        node(helper.make_node("Sub", [p + "T", p + "S"], [p + "past1"]))
+        node(helper.make_node("Squeeze", [p + "past1"], [p + "past"]))
+        node(
+            helper.make_node(
+                "ConstantOfShape", [p + "st"], [p + "ones"], value=numpy_helper.from_array(np.array([1.0], np.float32))
+            )
+        )
+        node(helper.make_node("Trilu", [p + "ones", p + "past"], [p + "tri"], upper=0))
+        node(helper.make_node("Mul", [p + "tri", "mask4"], [p + "m"]))
+        node(helper.make_node("Sub", [p + "m", "one"], [p + "m1"]))
+        node(helper.make_node("Mul", [p + "m1", "big"], [p + "bias"]))
+        node(helper.make_node("Add", [p + "s1", p + "bias"], [p + "s2"]))
+        node(helper.make_node("Softmax", [p + "s2"], [p + "probs"], axis=-1))
+        node(helper.make_node("MatMul", [p + "probs", f"present.{layer}.value"], [p + "ctx"]))
+        node(helper.make_node("Transpose", [p + "ctx"], [p + "ctx_t"], perm=[0, 2, 1, 3]))
+        node(helper.make_node("Reshape", [p + "ctx_t", "hidden_shape"], [p + "ctx_flat"]))
+        node(helper.make_node("MatMul", [p + "ctx_flat", p + "o"], [p + "out"]))
+        node(helper.make_node("Add", [x, p + "out"], [p + "x"]))
+        x = p + "x"
+    node(helper.make_node("MatMul", [x, "lm_head"], ["logits"]))
+    model = helper.make_model(
+        helper.make_graph(nodes, "toy_decoder", inputs, outputs, initializers),
+        opset_imports=[helper.make_opsetid("", 17)],
+    )
+    model.ir_version = 8
+    onnx.save(model, str(path))
+    return path
+
+
+@pytest.fixture(scope="session")
+def toy_model(tmp_path_factory) -> Path:
+    return build_toy_decoder(tmp_path_factory.mktemp("toy") / "model.onnx")
+
+
+@pytest.fixture
+def toy_session(toy_model):
+    ort = pytest.importorskip("onnxruntime")
+    return ort.InferenceSession(str(toy_model), providers=["CPUExecutionProvider"])
+
+
+@pytest.fixture(scope="session")
+def byte_tokenizer():
+    """HF fast tokenizer over raw bytes (no merges): every non-ASCII character spans several tokens."""
+    pytest.importorskip("tokenizers")
+    transformers = pytest.importorskip("transformers")
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+
+    alphabet = sorted(pre_tokenizers.ByteLevel.alphabet())
+    vocab = {"<|im_end|>": 0, **{char: index + 1 for index, char in enumerate(alphabet)}}
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.add_special_tokens(["<|im_end|>"])
+    return transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|im_end|>")
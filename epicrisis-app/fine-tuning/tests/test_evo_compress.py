@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from conftest import DATA_DIR
+from evo_compress import EvolutionCompressor, estimate_tokens, sentences
+
+
+def _words(text: str) -> int:
+    return len(text.split())
+
+
+def test_sentences():
+    note = "TORAX ESTABLE, 550 CC EN 24 HRS. EN ESPERA DE RETIRO DE SEP. POR AHORA SIN CAMBIOS | Dr. Perez: 1.-afebril"
+    assert sentences(note) == [
+        "TORAX ESTABLE, 550 CC EN 24 HRS",
+        "EN ESPERA DE RETIRO DE SEP. POR AHORA SIN CAMBIOS",
+        "Dr. Perez",
+        "afebril",
+    ]
+    # A lowercase word after the period continues the sentence; "p." is an abbreviation.
+    assert sentences("abdomen distendido. con dolor. PLAN: p. hepaticas; control") == [
+        "abdomen distendido. con dolor",
+        "PLAN: p. hepaticas",
+        "control",
+    ]
+
+
+def test_repeated_sentences_are_dropped():
+    notes = [
+        "KNT R Y M + TRIFLO. PACIENTE FEBRIL CON DOLOR ABDOMINAL",
+        "KNT R Y M + TRIFLO. AFEBRIL, SIN DOLOR",
+        "KNT  R Y M + TRIFLO. AFEBRIL, SIN DOLOR. ALTA",
+    ]
+    texts = [text for _, _, _, text in EvolutionCompressor().candidates(notes)]
+    # Whitespace differences do not make a sentence new.
+    assert texts == ["KNT R Y M + TRIFLO", "PACIENTE FEBRIL CON DOLOR ABDOMINAL", "AFEBRIL, SIN DOLOR"]
+
+
+@pytest.mark.parametrize("budget", [8, 16, 32])
+def test_kept_sentences_fit_the_budget(budget):
+    notes = [
+        "PACIENTE FEBRIL CON DOLOR ABDOMINAL INTENSO. TAC CON COLECCION PELVIANA",
+        "SE INICIA MEROPENEM POR SEPSIS DE FOCO ABDOMINAL. DRENAJE PERCUTANEO SIN INCIDENTES",
+        "AFEBRIL, PCR EN DESCENSO. EVOLUCION FAVORABLE, SE DECIDE ALTA",
+    ]
+    kept = EvolutionCompressor(budget, count_tokens=_words).select(notes)
+    assert kept
+    assert sum(map(_words, kept)) + len(kept) - 1 <= budget
+
+
+def test_kept_sentences_stay_in_note_order():
+    notes = ["AFEBRIL, SIN DOLOR ABDOMINAL", "SHOCK SEPTICO, TRASLADO A UCI", "EVOLUCION FAVORABLE, ALTA"]
+    compressor = EvolutionCompressor(budget=20, count_tokens=_words)
+    scores = {text: score for score, _, _, text in compressor.candidates(notes)}
+    # The second day scores highest but is not listed first.
+    assert max(scores, key=scores.get) == "SHOCK SEPTICO, TRASLADO A UCI"
+    assert compressor.select(notes) == notes
+
+
+def test_plans_alone_give_the_default():
+    notes = ["PLAN: MANTENER KNT Y TRIFLO", "SE SUGIERE: CONTROL MANANA"]
+    assert EvolutionCompressor().compress(notes, default="Favorable") == "Favorable"
+
+
+def test_example_notes():
+    path = DATA_DIR / "evolucion_resultado.json"
+    if not path.exists():
+        pytest.skip("data_example not available")
+    entries = json.loads(path.read_text(encoding="utf-8"))["evolucion_resumen"]
+    notes = [entry["texto"] for entry in sorted(entries, key=lambda entry: entry["dia"])]
+    evo = EvolutionCompressor().compress(notes)
+    assert evo
+    assert estimate_tokens(evo) <= 48 + len(evo.split(". "))
+    assert estimate_tokens(evo) < estimate_tokens(" ".join(notes)) / 10
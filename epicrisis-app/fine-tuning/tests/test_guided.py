@@ -0,0 +1,59 @@
+from pathlib import Path
+
+import pytest
+
+from guided import SkeletonGuide, replay
+from normalize_episodes import iter_episodes
+
+DATASETS = Path(__file__).resolve().parents[1] / "datasets"
+
+
+def _records():
+    """(input, output) of every compact-format training record (datasets/*.jsonl)."""
+    for path in sorted(DATASETS.glob("*.jsonl")):
+        for record in iter_episodes(path):
+            if isinstance(record.get("input"), dict) and isinstance(record.get("output"), str):
+                yield record["input"], record["output"]
+
+
+def test_replay_forces_no_wrong_span():
+    records = list(_records())
+    if not records:
+        pytest.skip("no training datasets")
+    forced = wrong = 0
+    for payload, output in records:
+        spans, bad = replay(SkeletonGuide(payload), output)
+        forced += spans
+        wrong += bad
+    assert forced > 0
+    assert wrong == 0
+
+
+PAYLOAD = {
+    "dx": ["Polipo endometrial (N84.0)"],
+    "proc": ["Histeroscopia y polipectomia (68.12)"],
+    "tto": ["Ceftriaxona 2g EV c/24h 7d (J01DD04)"],
+    "dx_alta": ["Polipo endometrial resecado (N84.0)"],
+    "med": ["Amoxicilina/Ac.clavulanico 875mg VO c/12h 5d (J01CR02)"],
+}
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("Ingresa por polipo endometrial (", "N84.0)"),
+        # Another item's word in the clause: abstain.
+        ("Se realiza histeroscopia con reseccion de polipo endometrial (", ""),
+        # Prefix-only match ("polipectomia" vs "polipo"): abstain.
+        ("Ingresa por polipectomia (", ""),
+        # The opening clause codes the admission dx, never a procedure.
+        ("Ingresa para histeroscopia y polipectomia (", ""),
+        ("Ingresa por polipo endometrial (N84.0). Se realiza histeroscopia y polipectomia (", "68.12)"),
+        ("Recibio ceftriaxona", ""),
+        ("Recibio ceftriaxona 2", ""),
+        ("Alta con polipo endometrial resecado (N84.0), indicandose amoxicilina/acido clavulanico 8", "75"),
+        ("Alta con diagnostico", " de"),
+    ],
+)
+def test_forced(text, expected):
+    assert SkeletonGuide(PAYLOAD).forced(text) == expected
@@ -0,0 +1,108 @@
+import csv
+import json
+import unicodedata
+
+import pytest
+
+from conftest import DATA_DIR
+from lab_summary import RESULT_COLUMNS, lab_summaries
+
+
+def _fold(text: str) -> str:
+    return unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
+
+
+def _as_v2(item: dict) -> dict:
+    """The fields of the v2 export: no n / fuera_rango / tendencia, test names without accents (Oracle spool)."""
+    periodo = {"min": item["periodo"]["min"], "max": item["periodo"]["max"]}
+    item = dict(item, prueba=_fold(item["prueba"]), periodo=periodo)
+    item.pop("tendencia")
+    return item
+
+
+@pytest.mark.parametrize("exams", [None, "d_exa.txt"])
+def test_matches_the_sql_export(exams):
+    results = DATA_DIR / "d_res.txt"
+    if not results.exists():
+        pytest.skip("data_example not available")
+    expected = json.loads((DATA_DIR / "laboratorios_resumen_v2.json").read_text(encoding="utf-8"))
+    summaries = lab_summaries(results, DATA_DIR / exams if exams else None)
+    assert [summary["id_atencion"] for summary in summaries] == [expected["id_atencion"]]
+    assert [_as_v2(item) for item in summaries[0]["laboratorios_resumen"]] == expected["laboratorios_resumen"]
+
+
+def _write_results(path, rows):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(RESULT_COLUMNS)
+        for row in rows:
+            writer.writerow([row.get(name, "") for name in RESULT_COLUMNS])
+    return path
+
+
+def _row(episode, prueba, valor, fecha, flag="N", code="03-01-001-00"):
+    return {
+        "ID_ATENCION": episode,
+        "COD_PRESTACION": code,
+        "NOMBRE_PRUEBA_LIS": prueba,
+        "VALOR_RESULTADO": valor,
+        "UNIDAD_MEDIDA": "mg/dL",
+        "RANGO_INFERIOR": "0,7",
+        "RANGO_SUPERIOR": "1.3",
+        "FECHA_INTEGRACION": fecha,
+        "IND_RANGO_RESULTADO": flag,
+    }
+
+
+def test_group_with_several_results(tmp_path):
+    rows = [
+        # Out of date order on purpose; "-" and ">60" are not numeric and are dropped.
+        _row("7", "Creatinina", "1,9", "27/12/2025 08:00:00", "H"),
+        _row("7", "Creatinina", "2.4", "25/12/2025 07:00:00", "H"),
+        _row("7", "Creatinina", "-", "26/12/2025 07:00:00"),
+        _row("7", "Creatinina", ">60", "26/12/2025 09:00:00"),
+        _row("7", "Creatinina", "1.1", "26/12/2025 08:00:00"),
+        _row("7", "Potasio", "4.1", "25/12/2025 07:00:00"),
+        _row("7", "Potasio", "4.1005", "26/12/2025 07:00:00"),
+        _row("8", "Creatinina", "0.9", "25/12/2025 07:00:00", ""),
+    ]
+    summaries = lab_summaries(_write_results(tmp_path / "d_res.txt", rows))
+    # Episode 8 only has a result without a range flag: the SQL drops it.
+    assert [summary["id_atencion"] for summary in summaries] == [7]
+    creatinina, potasio = summaries[0]["laboratorios_resumen"]
+    assert creatinina == {
+        "prueba": "Creatinina",
+        "unidad": "mg/dL",
+        "ingreso": {
+            "valor": 2.4,
+            "fecha": "2025-12-25T07:00:00",
+            "rango_inferior": 0.7,
+            "rango_superior": 1.3,
+            "estado": "alto",
+        },
+        "ultimo": {
+            "valor": 1.9,
+            "fecha": "2025-12-27T08:00:00",
+            "rango_inferior": 0.7,
+            "rango_superior": 1.3,
+            "estado": "alto",
+        },
+        "periodo": {"min": 1.1, "max": 2.4, "n": 3, "fuera_rango": 2},
+        "tendencia": "baja",
+    }
+    # A change within 0.001 is no change: no `ultimo`, tendencia estable.
+    assert "ultimo" not in potasio
+    assert potasio["periodo"] == {"min": 4.1, "max": 4.1005, "n": 2, "fuera_rango": 0}
+    assert potasio["tendencia"] == "estable"
+
+
+def test_exams_keep_only_ordered_results(tmp_path):
+    rows = [
+        _row("7", "Creatinina", "1.0", "25/12/2025 07:00:00", code="A"),
+        _row("7", "Glucosa", "90", "25/12/2025 07:00:00", code="B"),
+    ]
+    results = _write_results(tmp_path / "d_res.txt", rows)
+    exams = tmp_path / "d_exa.txt"
+    exams.write_text("ID_ATENCION,CAMPO4\n7,A\n8,B\n", encoding="utf-8")
+    summaries = lab_summaries(results, exams)
+    assert [item["prueba"] for item in summaries[0]["laboratorios_resumen"]] == ["Creatinina"]
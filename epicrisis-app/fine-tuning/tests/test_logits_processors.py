@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+from logits_processors import BatchSamplingParams, LogitsPipeline, TokenHistory
+from sampling import SamplingParams
+
+
+def _softmax(logits):
+    exp = np.exp(logits - logits.max())
+    return exp / exp.sum()
+
+
+def reference_keep(logits, history, params: SamplingParams):
+    """Tokens one row may sample from, computed the textbook way: one filter after another, full sorts."""
+    logits = logits.astype(np.float64).copy()
+    if params.repetition_penalty > 1.0:
+        for token in set(history):
+            value = logits[token]
+            logits[token] = value / params.repetition_penalty if value > 0 else value * params.repetition_penalty
+    if not params.temperature:
+        keep = np.zeros(len(logits), dtype=bool)
+        keep[np.argmax(logits)] = True
+        return logits, keep
+    logits /= params.temperature
+    keep = np.ones(len(logits), dtype=bool)
+    if params.top_k:
+        keep &= logits >= np.sort(logits)[-params.top_k]
+    if 0 < params.top_p < 1:
+        # Nucleus of the distribution left by top-k: the most probable tokens whose cumulative mass <= top_p.
+        probs = _softmax(np.where(keep, logits, -np.inf))
+        order = np.argsort(-probs)
+        kept = max(int((np.cumsum(probs[order]) <= params.top_p).sum()), 1)
+        keep &= logits >= logits[order[kept - 1]]
+    if params.min_p:
+        probs = _softmax(logits)
+        keep &= probs >= params.min_p * probs.max()
+    return logits, keep
+
+
+def _pipeline_keep(logits, histories, params_list):
+    history = TokenHistory(len(params_list), max(len(h) for h in histories) or 1)
+    for row, tokens in enumerate(histories):
+        history._buffer[row, : len(tokens)] = tokens
+        history.lengths[row] = len(tokens)
+    processed, floor = LogitsPipeline()(logits.copy(), history.view(), BatchSamplingParams(params_list))
+    return processed, processed >= floor[:, None]
+
+
+ROWS = [
+    SamplingParams(temperature=0.7, top_p=0.9),
+    SamplingParams(temperature=1.0, top_p=0.5, top_k=40),
+    SamplingParams(temperature=1.3, min_p=0.05),
+    SamplingParams(temperature=0.8, top_p=0.95, min_p=0.02, repetition_penalty=1.3),
+    SamplingParams(temperature=1.0, repetition_penalty=1.5),
+    SamplingParams(repetition_penalty=1.2),
+]
+
+
+@pytest.mark.parametrize("vocab, scale", [(64, 3.0), (1000, 3.0), (1000, 0.3)])
+def test_chain_matches_reference(vocab, scale):
+    # scale 0.3 gives a flat distribution: the top-p nucleus outgrows the partitioned candidates.
+    rng = np.random.default_rng(vocab)
+    logits = (rng.standard_normal((len(ROWS), vocab)) * scale).astype(np.float32)
+    histories = [list(rng.integers(0, vocab, size=size)) for size in (0, 5, 12, 30, 8, 3)]
+    processed, keep = _pipeline_keep(logits, histories, ROWS)
+    for row, params in enumerate(ROWS):
+        expected_logits, expected_keep = reference_keep(logits[row], histories[row], params)
+        if params.temperature:
+            np.testing.assert_allclose(processed[row], expected_logits, rtol=1e-5, atol=1e-5)
+            np.testing.assert_array_equal(keep[row], expected_keep)
+        else:
+            assert np.argmax(processed[row]) == np.argmax(expected_logits)
+
+
+def test_repetition_penalty_counts_repeats_once():
+    logits = np.array([[2.0, -2.0, 1.0, 0.5]], dtype=np.float32)
+    params = [SamplingParams(temperature=1.0, repetition_penalty=2.0)]
+    processed, _ = _pipeline_keep(logits, [[0, 0, 1, 0]], params)
+    np.testing.assert_allclose(processed[0], [1.0, -4.0, 1.0, 0.5])
+
+
+def test_greedy_rows_take_the_argmax():
+    logits = np.array([[0.1, 3.0, 2.9], [5.0, 1.0, 0.0]], dtype=np.float32)
+    params = BatchSamplingParams([SamplingParams(), SamplingParams(repetition_penalty=4.0)])
+    history = np.array([[-1], [0]])
+    tokens = LogitsPipeline().sample(logits.copy(), history, params, [None, None])
+    # Row 1: the penalty divides token 0 down to 1.25, still the largest.
+    assert tokens.tolist() == [1, 0]
+
+
+def test_samples_follow_the_filtered_distribution():
+    logits = np.log(np.array([[0.5, 0.25, 0.15, 0.06, 0.04]], dtype=np.float32))
+    sampling = SamplingParams(temperature=1.0, top_p=0.8, seed=0)
+    params = BatchSamplingParams([sampling])
+    rngs = [sampling.rng()]
+    pipeline = LogitsPipeline()
+    draws = 20000
+    counts = np.bincount(
+        [int(pipeline.sample(logits.copy(), np.zeros((1, 0), np.int64), params, rngs)[0]) for _ in range(draws)],
+        minlength=5,
+    )
+    # top_p=0.8 keeps {0, 1}; Gumbel-max then samples them 2:1.
+    assert counts[2:].sum() == 0
+    np.testing.assert_allclose(counts[:2] / draws, [2 / 3, 1 / 3], atol=0.015)
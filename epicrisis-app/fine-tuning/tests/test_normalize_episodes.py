@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+from conftest import DATA_DIR
+from normalize_episodes import (
+    DEFAULT_EVO,
+    NOT_RECORDED,
+    days_between,
+    dedupe_by_code,
+    duration,
+    frequency,
+    iter_episodes,
+    medications,
+    normalize_episode,
+)
+
+
+def test_example_episode():
+    path = DATA_DIR / "epicrisis_ejemplo.json"
+    if not path.exists():
+        pytest.skip("data_example not available")
+    (raw,) = iter_episodes(path)
+    compact = normalize_episode(raw)
+    assert list(compact) == ["dx", "proc", "tto", "evo", "dx_alta", "med"]
+    assert compact["dx"] == [
+        "Tumor maligno del recto (C20)",
+        "Cirrosis hepatica, otra y la no especificada (K74.6)",
+        "Derrame pleural no clasificado en otra parte (J90)",
+    ]
+    assert compact["proc"][0] == "Cirugia de Miles (reseccion abdominoperineal) (48.52)"
+    assert len(compact["proc"]) == 5
+    # No duration recorded: days between inicio and fin; "c/8h" already in the name is not repeated.
+    assert compact["tto"] == [
+        "Piperacilina/Tazobactam EV 4d (J01CR05)",
+        "Meropenem 1g c/8h EV 7d (J01DH02)",
+        "Ceftriaxona EV 2d (J01XA01)",
+        "Metronidazol EV 2d (J01XD01)",
+    ]
+    assert compact["dx_alta"][0] == "Tumor maligno del recto - Post operatorio cirugia de Miles (C20)"
+    assert compact["med"] == ["Meropenem 1g EV c/8h Completar esquema segun infectologia (J01DH02)"]
+    assert compact["evo"] and compact["evo"] != DEFAULT_EVO
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [("cada 8 horas", "c/8h"), ("cada 12 hrs", "c/12h"), ("Cada 6h", "c/6h"), ("SOS", "SOS"), (None, "")],
+)
+def test_frequency(value, expected):
+    assert frequency(value) == expected
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [("7 dias", "7d"), ("por 10 días", "10d"), ("2 semanas", "2sem"), ("3 meses", "3m"), ("indefinido", "indefinido")],
+)
+def test_duration(value, expected):
+    assert duration(value) == expected
+
+
+def test_days_between():
+    assert days_between("2025-12-15", "2025-12-19T10:00:00") == "4d"
+    # Started and stopped the same day: one day.
+    assert days_between("2025-12-15", "2025-12-15") == "1d"
+    assert days_between("2025-12-15", None) == ""
+
+
+def test_medications_and_dedupe_by_code():
+    items = [
+        {"codigo": "ATC:B01AC06", "nombre": "Aspirina", "dosis": "100mg", "via": "oral", "frecuencia": "cada 24 horas"},
+        {"codigo": "B01AC06", "nombre": "Acido acetilsalicilico", "dosis": "100 mg"},
+        {"nombre": "Paracetamol", "dosis": "1g", "via": "sonda"},
+        {"nombre": "paracetamol 1g SONDA"},
+        {"nombre": None},
+    ]
+    meds = medications(json.dumps(items))
+    assert meds == [
+        "Aspirina 100mg VO c/24h (B01AC06)",
+        "Acido acetilsalicilico 100 mg (B01AC06)",
+        "Paracetamol 1g SONDA",
+        "paracetamol 1g SONDA",
+    ]
+    # The first item per ATC code, or per lowercased text without one.
+    assert dedupe_by_code(meds) == ["Aspirina 100mg VO c/24h (B01AC06)", "Paracetamol 1g SONDA"]
+
+
+def test_empty_episode_defaults():
+    compact = normalize_episode({"diagnostico_ingreso": "[]", "evolucion_resumen": [{"dia": 1, "texto": "  "}]})
+    # dx_alta falls back to the admission diagnoses as recorded (none), as in the frontend.
+    assert compact == {"dx": [NOT_RECORDED], "proc": [], "tto": [], "evo": DEFAULT_EVO, "dx_alta": [], "med": []}
+
+
+def test_jsonl_lines_with_several_records(tmp_path):
+    path = tmp_path / "episodes.jsonl"
+    path.write_text('{"id": 1} {"id": 2}\n\n{"id": 3}{"id": 4} not json\n', encoding="utf-8")
+    with pytest.warns(UserWarning, match="episodes.jsonl:3"):
+        assert [record["id"] for record in iter_episodes(path)] == [1, 2, 3, 4]
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from onnx_engine import DecodeEngine
+
+PROMPT = [1, 2, 3, 4, 5, 6, 7]
+STEPS = 12
+
+
+def _full_logits(sess, tokens) -> np.ndarray:
+    """Last-position logits of a full recompute over `tokens` (no KV cache, no IOBinding)."""
+    feeds = {
+        "input_ids": np.array([tokens], dtype=np.int64),
+        "attention_mask": np.ones((1, len(tokens)), dtype=np.int64),
+        "position_ids": np.arange(len(tokens), dtype=np.int64)[None],
+    }
+    for meta in sess.get_inputs():
+        if meta.name.startswith("past_key_values."):
+            feeds[meta.name] = np.zeros((1, meta.shape[1], 0, meta.shape[3]), dtype=np.float32)
+    return sess.run(["logits"], feeds)[0][0, -1]
+
+
+def _naive_greedy(sess, prompt, steps) -> list:
+    tokens = list(prompt)
+    for _ in range(steps):
+        tokens.append(int(np.argmax(_full_logits(sess, tokens))))
+    return tokens[len(prompt) :]
+
+
+def _engine_greedy(engine, logits, steps) -> np.ndarray:
+    """Continue greedy decoding from prefill `logits` [batch, vocab]; returns [batch, steps]."""
+    out = [np.argmax(logits, axis=-1)]
+    for _ in range(steps - 1):
+        logits = engine.forward(out[-1][:, None].astype(np.int64))
+        out.append(np.argmax(logits, axis=-1))
+    return np.stack(out, axis=1)
+
+
+def test_single_row_matches_full_recompute(toy_session):
+    engine = DecodeEngine(toy_session, len(PROMPT) + STEPS)
+    engine.reset()
+    logits = engine.prefill(np.array([PROMPT], dtype=np.int64))
+    np.testing.assert_allclose(logits[0], _full_logits(toy_session, PROMPT), rtol=1e-4, atol=1e-4)
+    generated = _engine_greedy(engine, logits, STEPS)[0].tolist()
+    assert generated == _naive_greedy(toy_session, PROMPT, STEPS)
+    # The last token is picked but not fed back.
+    assert engine.cache.length == len(PROMPT) + STEPS - 1
+
+
+def test_left_padded_batch_matches_each_row_alone(toy_session):
+    prompts = [PROMPT, PROMPT[:3], [6, 2, 9, 11, 40]]
+    width = max(map(len, prompts))
+    ids = np.zeros((len(prompts), width), dtype=np.int64)
+    mask = np.zeros_like(ids)
+    for row, prompt in enumerate(prompts):
+        ids[row, width - len(prompt) :] = prompt
+        mask[row, width - len(prompt) :] = 1
+    engine = DecodeEngine(toy_session, width + STEPS, batch=len(prompts))
+    engine.reset()
+    logits = engine.prefill(ids, mask)
+    for row, prompt in enumerate(prompts):
+        np.testing.assert_allclose(logits[row], _full_logits(toy_session, prompt), rtol=1e-4, atol=1e-4)
+    generated = _engine_greedy(engine, logits, STEPS)
+    for row, prompt in enumerate(prompts):
+        assert generated[row].tolist() == _naive_greedy(toy_session, prompt, STEPS)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, len(PROMPT)])
+def test_chunked_prefill_matches_one_forward(toy_session, chunk_size):
+    engine = DecodeEngine(toy_session, len(PROMPT) + STEPS)
+    engine.reset()
+    logits = engine.prefill(np.array([PROMPT], dtype=np.int64), chunk_size=chunk_size)
+    assert engine.cache.length == len(PROMPT)
+    np.testing.assert_allclose(logits[0], _full_logits(toy_session, PROMPT), rtol=1e-4, atol=1e-4)
+    assert _engine_greedy(engine, logits, STEPS)[0].tolist() == _naive_greedy(toy_session, PROMPT, STEPS)
+
+
+def test_truncate_rolls_back_to_an_earlier_position(toy_session):
+    engine = DecodeEngine(toy_session, len(PROMPT) + STEPS)
+    engine.reset()
+    generated = _engine_greedy(engine, engine.prefill(np.array([PROMPT], dtype=np.int64)), 6)[0].tolist()
+    keep = len(PROMPT) + 2
+    engine.truncate(keep)
+    assert engine.cache.length == keep
+    assert engine.seq_lengths[0] == keep
+    # Feeding the next token again continues from the rolled-back state.
+    tokens = PROMPT + generated
+    logits = engine.forward(np.array([[tokens[keep]]], dtype=np.int64))
+    np.testing.assert_allclose(logits[0], _full_logits(toy_session, tokens[: keep + 1]), rtol=1e-4, atol=1e-4)
+
+
+def test_restored_prefix_continues_like_a_full_prefill(toy_session):
+    prefix = 4
+    source = DecodeEngine(toy_session, len(PROMPT) + STEPS)
+    source.reset()
+    source.prefill(np.array([PROMPT], dtype=np.int64))
+    kv = source.snapshot_prefix(prefix)
+    assert kv.shape == (1, 2, 2, prefix, 4)
+
+    engine = DecodeEngine(toy_session, len(PROMPT) + STEPS)
+    engine.reset()
+    engine.restore_prefix(kv)
+    logits = engine.prefill(np.array([PROMPT[prefix:]], dtype=np.int64))
+    np.testing.assert_allclose(logits[0], _full_logits(toy_session, PROMPT), rtol=1e-4, atol=1e-4)
+    assert _engine_greedy(engine, logits, STEPS)[0].tolist() == _naive_greedy(toy_session, PROMPT, STEPS)
+
+
+def test_padded_rows_cannot_be_snapshotted(toy_session):
+    engine = DecodeEngine(toy_session, len(PROMPT) + STEPS)
+    engine.reset()
+    engine.prefill(np.array([PROMPT], dtype=np.int64), np.array([[0, 0] + [1] * (len(PROMPT) - 2)]))
+    with pytest.raises(ValueError, match="unpadded"):
+        engine.snapshot_prefix(3)
@@ -0,0 +1,105 @@
+import multiprocessing as mp
+import threading
+import time
+
+import numpy as np
+import pytest
+
+ort = pytest.importorskip("onnxruntime")
+
+from ort_session import create_session, genai_session_options, join_workers  # noqa: E402
+
+
+def _feeds(sess):
+    feeds = {
+        "input_ids": np.array([[1, 2, 3]], dtype=np.int64),
+        "attention_mask": np.ones((1, 3), dtype=np.int64),
+        "position_ids": np.arange(3, dtype=np.int64)[None],
+    }
+    for spec in sess.get_inputs():
+        if spec.name.startswith("past_key_values."):
+            feeds[spec.name] = np.zeros((1, spec.shape[1], 0, spec.shape[3]), dtype=np.float32)
+    return feeds
+
+
+def _cold_start(model, cache_dir, barrier, results, index):
+    barrier.wait(timeout=60)
+    sess = create_session(model, "extended", cache_dir=cache_dir, threads={})
+    results[index] = sess.run(["logits"], _feeds(sess))[0]
+
+
+def test_cache_files_are_written_atomically(toy_model, tmp_path):
+    cache_dir = tmp_path / "cache"
+    reference = create_session(toy_model, "disable", threads={})
+    expected = reference.run(["logits"], _feeds(reference))[0]
+
+    ctx = mp.get_context("spawn")
+    processes = 3
+    barrier = ctx.Barrier(processes)
+    with ctx.Manager() as manager:
+        results = manager.dict()
+        workers = [
+            ctx.Process(target=_cold_start, args=(str(toy_model), str(cache_dir), barrier, results, index))
+            for index in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(timeout=120)
+        assert [worker.exitcode for worker in workers] == [0] * processes
+        outputs = list(results.values())
+
+    assert len(outputs) == processes
+    for output in outputs:
+        np.testing.assert_allclose(output, expected, rtol=1e-4, atol=1e-4)
+    models = list(cache_dir.glob("*.onnx"))
+    assert len(models) == 1
+    assert not list(cache_dir.glob("*.partial"))
+    # One data file per published graph: builds that lost the race removed theirs.
+    assert len(list(cache_dir.glob("*.data"))) == 1
+
+    cached = create_session(toy_model, "extended", cache_dir=cache_dir, threads={})
+    np.testing.assert_allclose(cached.run(["logits"], _feeds(cached))[0], expected, rtol=1e-4, atol=1e-4)
+
+
+def test_cache_without_hard_links_falls_back_to_rename(toy_model, tmp_path, monkeypatch):
+    def no_links(source, target):
+        raise PermissionError("hard links not supported")
+
+    monkeypatch.setattr("ort_session.os.link", no_links)
+    cache_dir = tmp_path / "cache"
+    sess = create_session(toy_model, "extended", cache_dir=cache_dir, threads={})
+    assert sess.run(["logits"], _feeds(sess))[0].shape == (1, 3, 64)
+    assert len(list(cache_dir.glob("*.onnx"))) == 1
+    assert not list(cache_dir.glob("*.partial"))
+    assert len(list(cache_dir.glob("*.data"))) == 1
+
+
+def _meet(barrier, fail):
+    if fail:
+        raise SystemExit(3)
+    try:
+        barrier.wait(timeout=60)
+    except threading.BrokenBarrierError:
+        return
+
+
+def test_worker_dying_before_barrier_releases_the_others():
+    ctx = mp.get_context("spawn")
+    barrier = ctx.Barrier(3)
+    workers = [ctx.Process(target=_meet, args=(barrier, index == 0)) for index in range(3)]
+    start = time.monotonic()
+    for worker in workers:
+        worker.start()
+    assert join_workers(workers, barrier, timeout=120) == [3, 0, 0]
+    # The barrier was aborted: nobody waited out its 60 s timeout.
+    assert time.monotonic() - start < 30
+
+
+def test_genai_session_options():
+    settings = {"intra_op_num_threads": 4, "execution_mode": "parallel", "allow_spinning": False}
+    assert genai_session_options(settings) == {
+        "intra_op_num_threads": 4,
+        "config_entries": {"session.intra_op.allow_spinning": "0", "session.inter_op.allow_spinning": "0"},
+    }
+    assert genai_session_options({}) == {}
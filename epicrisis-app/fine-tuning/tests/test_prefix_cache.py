@@ -0,0 +1,60 @@
+import numpy as np
+
+from prefix_cache import PrefixCache
+
+
+def _kv(length: int, value: float = 0.0) -> np.ndarray:
+    """Single-row snapshot shaped [layers, 2, kv_heads, length, head_dim]: 32 bytes per token."""
+    return np.full((1, 2, 1, length, 4), value, dtype=np.float32)
+
+
+def test_longest_cached_prefix_wins():
+    cache = PrefixCache(max_bytes=10_000)
+    cache.insert([1, 2], _kv(2, 2))
+    cache.insert([1, 2, 3, 4], _kv(4, 4))
+    length, kv = cache.lookup([1, 2, 3, 4, 5, 6])
+    assert length == 4 and kv[0, 0, 0, 0, 0] == 4
+    # max_length caps the match (a request must prefill at least one token).
+    assert cache.lookup([1, 2, 3, 4], max_length=3)[0] == 2
+    assert cache.lookup([1, 9, 3, 4])[0] == 0
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+    assert cache.stats()["hit_tokens"] == 6
+
+
+def test_evicts_least_recently_used_by_bytes():
+    cache = PrefixCache(max_bytes=3 * _kv(4).nbytes)
+    for first in (1, 2, 3):
+        cache.insert([first, 0, 0, 0], _kv(4))
+    # A hit refreshes [1, ...]; the next insert evicts [2, ...], now the oldest.
+    assert cache.lookup([1, 0, 0, 0])[0] == 4
+    cache.insert([4, 0, 0, 0], _kv(4))
+    assert len(cache) == 3
+    assert cache.nbytes == 3 * _kv(4).nbytes
+    assert cache.lookup([2, 0, 0, 0])[0] == 0
+    assert all(cache.lookup([first, 0, 0, 0])[0] == 4 for first in (1, 3, 4))
+
+
+def test_reinsert_refreshes_without_growing():
+    cache = PrefixCache(max_bytes=2 * _kv(4).nbytes)
+    cache.insert([1, 0, 0, 0], _kv(4))
+    cache.insert([2, 0, 0, 0], _kv(4))
+    assert cache.insert([1, 0, 0, 0], _kv(4))
+    assert cache.nbytes == 2 * _kv(4).nbytes
+    cache.insert([3, 0, 0, 0], _kv(4))
+    assert cache.lookup([1, 0, 0, 0])[0] == 4
+    assert cache.lookup([2, 0, 0, 0])[0] == 0
+
+
+def test_oversized_entry_is_rejected():
+    cache = PrefixCache(max_bytes=_kv(4).nbytes)
+    cache.insert([1, 0, 0, 0], _kv(4))
+    assert not cache.insert(list(range(8)), _kv(8))
+    assert len(cache) == 1
+
+
+def test_evicted_lengths_are_no_longer_probed():
+    cache = PrefixCache(max_bytes=_kv(4).nbytes)
+    cache.insert([1, 2], _kv(2))
+    cache.insert([5, 6, 7, 8], _kv(4))
+    assert cache.lookup([1, 2, 3]) == (0, None)
+    assert sorted(cache._lengths) == [4]
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from prompt_compiler import (
+    DEFAULT_STYLE,
+    PROMPT_STYLE_FILE,
+    build_chatml_prompt,
+    load_prompt_style,
+    save_prompt_style,
+    serialize,
+)
+
+PAYLOAD = {"dx": ["Angina inestable (I20.0)"], "proc": [], "med": ["Aspirina 100mg VO c/24h (B01AC06)"]}
+
+
+def test_default_is_the_indent_format_models_were_trained_on():
+    assert DEFAULT_STYLE == "indent"
+    assert serialize(PAYLOAD) == json.dumps(PAYLOAD, ensure_ascii=False, indent=2)
+    assert json.dumps(PAYLOAD, ensure_ascii=False, indent=2) in build_chatml_prompt(PAYLOAD)
+
+
+def test_model_without_style_file_uses_default(tmp_path):
+    assert load_prompt_style(tmp_path) == DEFAULT_STYLE
+
+
+def test_style_travels_with_the_model(tmp_path):
+    save_prompt_style(tmp_path, "compact")
+    onnx_dir = tmp_path / "onnx"
+    onnx_dir.mkdir()
+    assert load_prompt_style(tmp_path) == "compact"
+    # Runners pass the model file; the style file sits next to it or up to two levels above.
+    assert load_prompt_style(onnx_dir / "model.onnx") == "compact"
+    assert serialize(PAYLOAD, "compact") in build_chatml_prompt(PAYLOAD, load_prompt_style(onnx_dir))
+
+
+def test_unknown_style_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        save_prompt_style(tmp_path, "pretty")
+    (tmp_path / PROMPT_STYLE_FILE).write_text(json.dumps({"style": "pretty"}), encoding="utf-8")
+    with pytest.raises(ValueError):
+        load_prompt_style(tmp_path)
+    with pytest.raises(ValueError):
+        serialize(PAYLOAD, "pretty")
@@ -0,0 +1,96 @@
+import os
+
+from response_cache import ResponseCache, model_dir_fingerprint, response_key
+
+PAYLOAD = {"dx": ["Angina inestable (I20.0)"], "proc": ["Coronariografia (K492)"], "med": []}
+GREEDY = {"max_new_tokens": 200, "temperature": 0.0, "top_p": 0.8, "do_sample": False, "seed": None}
+
+
+def test_key_covers_input_model_template_and_sampling():
+    key = response_key(PAYLOAD, "model-a", GREEDY)
+    assert key == response_key(dict(PAYLOAD), "model-a", dict(GREEDY))
+    assert key != response_key(dict(PAYLOAD, med=["Aspirina 100mg"]), "model-a", GREEDY)
+    assert key != response_key(PAYLOAD, "model-b", GREEDY)
+    assert key != response_key(PAYLOAD, "model-a", dict(GREEDY, max_new_tokens=100))
+    assert key != response_key(PAYLOAD, "model-a", GREEDY, style="compact")
+    assert key != response_key(PAYLOAD, "model-a", GREEDY, prompt_budget=512)
+
+
+def test_compact_key_ignores_field_order_and_empty_fields():
+    reordered = {"proc": PAYLOAD["proc"], "dx": PAYLOAD["dx"]}
+    assert response_key(PAYLOAD, "m", GREEDY, style="compact") == response_key(reordered, "m", GREEDY, style="compact")
+
+
+def test_unseeded_sampling_bypasses_the_cache(tmp_path):
+    sampled = dict(GREEDY, temperature=0.2, do_sample=True)
+    assert response_key(PAYLOAD, "m", sampled) is None
+    assert response_key(PAYLOAD, "m", dict(sampled, seed=0)) is not None
+    cache = ResponseCache(tmp_path)
+    assert cache.get(None) is None
+    assert not cache.put(None, {"text": "x"})
+    assert cache.stats()["bypass"] == 1
+    assert len(cache) == 0
+
+
+def test_round_trip_and_persistence(tmp_path):
+    key = response_key(PAYLOAD, "m", GREEDY)
+    cache = ResponseCache(tmp_path)
+    assert cache.get(key) is None
+    assert cache.put(key, {"text": "Paciente ingresa por angina inestable."})
+    assert cache.get(key) == {"text": "Paciente ingresa por angina inestable."}
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 1)
+    # A new process rebuilds the index from the files.
+    reopened = ResponseCache(tmp_path)
+    assert len(reopened) == 1
+    assert reopened.get(key) == {"text": "Paciente ingresa por angina inestable."}
+
+
+def _fill(cache, count):
+    keys = [response_key(dict(PAYLOAD, dx=[f"dx {index}"]), "m", GREEDY) for index in range(count)]
+    for key in keys:
+        cache.put(key, {"text": "x" * 100})
+    return keys
+
+
+def test_evicts_least_recently_used(tmp_path):
+    entry = len('{"text": "' + "x" * 100 + '"}')
+    cache = ResponseCache(tmp_path, max_bytes=3 * entry)
+    keys = _fill(cache, 3)
+    # A hit refreshes the first entry; the fourth put evicts the second, now the oldest.
+    assert cache.get(keys[0]) is not None
+    cache.put(response_key(PAYLOAD, "m", GREEDY), {"text": "x" * 100})
+    assert cache.stats()["evictions"] == 1
+    assert cache.nbytes == 3 * entry
+    assert cache.get(keys[1]) is None
+    assert not cache._path(keys[1]).exists()
+    assert cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+
+
+def test_reopened_cache_evicts_by_file_age(tmp_path):
+    entry = len('{"text": "' + "x" * 100 + '"}')
+    cache = ResponseCache(tmp_path)
+    keys = _fill(cache, 3)
+    for age, key in enumerate(keys):
+        os.utime(cache._path(key), ns=(10**18 - age, 10**18 - age))
+    # keys[2] has the oldest mtime: a smaller bound drops it first.
+    smaller = ResponseCache(tmp_path, max_bytes=2 * entry)
+    assert len(smaller) == 2
+    assert smaller.get(keys[2]) is None
+    assert not cache._path(keys[2]).exists()
+
+
+def test_oversized_entry_is_not_stored(tmp_path):
+    cache = ResponseCache(tmp_path, max_bytes=50)
+    assert not cache.put(response_key(PAYLOAD, "m", GREEDY), {"text": "x" * 100})
+    assert len(cache) == 0
+
+
+def test_model_fingerprint_changes_with_the_files(tmp_path):
+    model_dir = tmp_path / "model"
+    model_dir.mkdir()
+    (model_dir / "genai_config.json").write_text('{"a": 1}', encoding="utf-8")
+    before = model_dir_fingerprint(model_dir)
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "genai_config.json").write_text('{"a": 2}', encoding="utf-8")
+    assert model_dir_fingerprint(other) != before
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+from conftest import build_toy_decoder
+from onnx_engine import DecodeEngine
+from sampling import SamplingParams
+from speculative import DraftModelDrafter, PromptLookupDrafter, speculative_generate
+from stopping import StopCriteria
+from streaming import stream_generate
+
+PROMPT = [1, 2, 3]
+STEPS = 24
+NUM_DRAFT = 4
+
+
+@pytest.fixture(scope="module")
+def sessions(tmp_path_factory):
+    ort = pytest.importorskip("onnxruntime")
+    directory = tmp_path_factory.mktemp("speculative")
+    target = build_toy_decoder(directory / "target.onnx")
+    draft = build_toy_decoder(directory / "draft.onnx", seed=1)
+    return {
+        name: ort.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+        for name, path in (("target", target), ("draft", draft))
+    }
+
+
+def _engine(sess):
+    return DecodeEngine(sess, len(PROMPT) + STEPS + NUM_DRAFT + 1)
+
+
+@pytest.fixture(scope="module")
+def greedy(sessions):
+    return list(stream_generate(_engine(sessions["target"]), PROMPT, StopCriteria(max_new_tokens=STEPS)))
+
+
+@pytest.mark.parametrize(
+    "drafter_name, min_acceptance",
+    [
+        ("lookup_greedy", 0.9),  # drafts copied from the target's own output: accepted whole
+        ("lookup_unrelated", 0.0),  # drafts from a source the target does not follow: mostly rejected
+        ("same_model", 1.0),
+        ("other_model", 0.0),
+    ],
+)
+def test_greedy_output_is_the_target_output(sessions, greedy, drafter_name, min_acceptance):
+    drafters = {
+        "lookup_greedy": lambda: PromptLookupDrafter([PROMPT + greedy], min_ngram=1),
+        "lookup_unrelated": lambda: PromptLookupDrafter([[greedy[-1], 0, 1, 2, 3, 4, 5, 6, 7]], min_ngram=1),
+        "same_model": lambda: DraftModelDrafter(_engine(sessions["target"])),
+        "other_model": lambda: DraftModelDrafter(_engine(sessions["draft"])),
+    }
+    target = _engine(sessions["target"])
+    stop = StopCriteria(max_new_tokens=STEPS)
+    tokens, stats = speculative_generate(target, PROMPT, drafters[drafter_name](), stop, num_draft=NUM_DRAFT)
+    assert tokens == greedy
+    assert stats["drafted"] > 0
+    assert stats["acceptance"] >= min_acceptance
+    if min_acceptance == 1.0:
+        assert stats["forwards"] < STEPS
+
+
+def _softmax(logits, temperature=1.0):
+    logits = logits.astype(np.float64) / temperature
+    exp = np.exp(logits - logits.max())
+    return exp / exp.sum()
+
+
+def _second_token_marginal(target, second, temperature: float) -> np.ndarray:
+    """Exact distribution of the second token: sum over t1 of p_target(t1) p_second(t2 | t1)."""
+    engine, second_engine = _engine(target), _engine(second)
+    engine.reset(batch=1)
+    first = _softmax(engine.prefill(np.array([PROMPT], dtype=np.int64))[0])
+    marginal = np.zeros_like(first)
+    for token, probability in enumerate(first):
+        second_engine.reset(batch=1)
+        logits = second_engine.prefill(np.array([PROMPT + [token]], dtype=np.int64))[0]
+        marginal += probability * _softmax(logits, temperature)
+    return marginal
+
+
+@pytest.mark.parametrize(
+    "draft, draft_temperature",
+    [
+        ("target", 1.6),  # close draft: mostly accepted
+        ("draft", 1.0),  # unrelated draft: mostly resampled from max(p - q, 0)
+    ],
+)
+def test_sampled_output_follows_the_target_distribution(sessions, draft, draft_temperature):
+    runs = 3000
+    target_engine, draft_engine = _engine(sessions["target"]), _engine(sessions[draft])
+    counts = np.zeros(target_engine.vocab_size)
+    accepted = drafted = 0
+    for seed in range(runs):
+        sampling = SamplingParams(temperature=1.0, seed=seed)
+        drafter = DraftModelDrafter(draft_engine, SamplingParams(temperature=draft_temperature, seed=seed))
+        # Three tokens with one draft: the second token is always a verified draft position.
+        tokens, stats = speculative_generate(
+            target_engine, PROMPT, drafter, StopCriteria(max_new_tokens=3), sampling, num_draft=1
+        )
+        counts[tokens[1]] += 1
+        accepted += stats["accepted"]
+        drafted += stats["drafted"]
+    expected = _second_token_marginal(sessions["target"], sessions["target"], 1.0)
+    proposed = _second_token_marginal(sessions["target"], sessions[draft], draft_temperature)
+    assert 0 < accepted < drafted
+    # Keeping the drafts as proposed would be this far off; speculative sampling is within sampling noise.
+    assert 0.5 * np.abs(proposed - expected).sum() > 0.15
+    assert 0.5 * np.abs(counts / runs - expected).sum() < 0.07
@@ -0,0 +1,59 @@
+from stopping import StopCriteria
+
+
+def _feed(criteria, tokens):
+    """(stopped after how many tokens, matcher) once `tokens` are fed one by one."""
+    matcher = criteria.matcher()
+    for count, token in enumerate(tokens, 1):
+        if matcher.update(token):
+            return count, matcher
+    return None, matcher
+
+
+def test_stop_sequence_split_across_tokens():
+    criteria = StopCriteria(stop_sequences=[[5, 6, 7]])
+    stopped, matcher = _feed(criteria, [1, 5, 6, 7, 8])
+    assert stopped == 4
+    assert (matcher.reason, matcher.matched_length) == ("stop_sequence", 3)
+
+
+def test_pending_counts_a_partial_match():
+    matcher = StopCriteria(stop_sequences=[[5, 6, 7]]).matcher()
+    pending = []
+    for token in [1, 5, 6, 9, 5]:
+        matcher.update(token)
+        pending.append(matcher.pending)
+    # 5, 6 may start the stop sequence until 9 breaks it.
+    assert pending == [0, 1, 2, 0, 1]
+    assert not matcher.done
+
+
+def test_overlapping_match_starts():
+    # "5 5 6": after 5 5 5 the match can still start at the second or third 5.
+    stopped, matcher = _feed(StopCriteria(stop_sequences=[[5, 5, 6]]), [5, 5, 5, 6])
+    assert stopped == 4
+    assert matcher.matched_length == 3
+
+
+def test_earliest_match_start_wins():
+    # Both end on the same token; trimming the longer match keeps no part of either stop string.
+    stopped, matcher = _feed(StopCriteria(stop_sequences=[[4, 5], [3, 4, 5]]), [3, 4, 5])
+    assert stopped == 3
+    assert matcher.matched_length == 3
+
+
+def test_eos_and_budget():
+    stopped, matcher = _feed(StopCriteria(eos_token_ids=[0], max_new_tokens=10), [3, 4, 0, 5])
+    assert (stopped, matcher.reason, matcher.matched_length) == (3, "eos", 1)
+    stopped, matcher = _feed(StopCriteria(eos_token_ids=[0], max_new_tokens=2), [3, 4, 5])
+    assert (stopped, matcher.reason) == (2, "max_new_tokens")
+
+
+def test_from_tokenizer_matches_text_split_into_tokens(byte_tokenizer):
+    criteria = StopCriteria.from_tokenizer(byte_tokenizer, stop_strings=["Diagnóstico"])
+    assert byte_tokenizer.eos_token_id in criteria.eos_token_ids
+    # With and without a leading space, each byte a token ("ó" is two).
+    assert sorted(len(sequence) for sequence in criteria.stop_sequences) == [12, 13]
+    text = byte_tokenizer.encode("Alta con aspirina. Diagnóstico de", add_special_tokens=False)
+    stopped, matcher = _feed(criteria, text)
+    assert byte_tokenizer.decode(text[: stopped - matcher.matched_length]) == "Alta con aspirina."
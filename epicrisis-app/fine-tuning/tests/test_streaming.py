@@ -0,0 +1,61 @@
+import pytest
+
+from conftest import TOY_VOCAB
+from onnx_engine import DecodeEngine
+from stopping import StopCriteria
+from streaming import REPLACEMENT_CHAR, IncrementalDetokenizer, stream_generate, stream_text
+
+PROMPT = [1, 2, 3]
+STEPS = 24
+
+
+def _find(tokens, sequence):
+    for start in range(len(tokens) - len(sequence) + 1):
+        if tokens[start : start + len(sequence)] == sequence:
+            return start
+    return None
+
+
+@pytest.fixture
+def engine(toy_session):
+    return DecodeEngine(toy_session, len(PROMPT) + STEPS + 1)
+
+
+@pytest.fixture
+def greedy(engine):
+    return list(stream_generate(engine, PROMPT, StopCriteria(max_new_tokens=STEPS)))
+
+
+def test_stop_sequence_never_reaches_the_stream(engine, greedy):
+    assert len(greedy) == STEPS
+    stop = greedy[6:9]
+    streamed = list(stream_generate(engine, PROMPT, StopCriteria(stop_sequences=[stop], max_new_tokens=STEPS)))
+    assert streamed == greedy[: _find(greedy, stop)]
+
+
+def test_held_back_tokens_are_released_when_the_match_fails(engine, greedy):
+    # Starts like greedy[6:] but ends with a token that never follows greedy[6], so it never matches.
+    follower = next(t for t in range(TOY_VOCAB) if _find(greedy, [greedy[6], t]) is None)
+    stop = [greedy[6], follower]
+    streamed = []
+    stream = stream_generate(engine, PROMPT, StopCriteria(stop_sequences=[stop], max_new_tokens=STEPS))
+    for token in stream:
+        streamed.append(token)
+        # A yielded token is final: it is what greedy decoding produced at that position.
+        assert streamed == greedy[: len(streamed)]
+    assert streamed == greedy
+
+
+def test_eos_is_not_streamed(engine, greedy):
+    eos = greedy[10]
+    streamed = list(stream_generate(engine, PROMPT, StopCriteria(eos_token_ids=[eos], max_new_tokens=STEPS)))
+    assert streamed == greedy[: greedy.index(eos)]
+
+
+@pytest.mark.parametrize("text", ["Diagnóstico: cardiopatía isquémica, ñandú", "IAM pared anterior (I21.0)", "ó"])
+def test_detokenizer_deltas_rebuild_the_text(byte_tokenizer, text):
+    ids = byte_tokenizer.encode(text, add_special_tokens=False)
+    deltas = list(stream_text(iter(ids), IncrementalDetokenizer(byte_tokenizer)))
+    assert "".join(deltas) == text
+    # A multi-byte character split across tokens is held back until it is complete.
+    assert not any(REPLACEMENT_CHAR in delta for delta in deltas)
@@ -0,0 +1,62 @@
+import pytest
+
+from stopping import StopCriteria
+from worker import InferenceWorker
+
+PROMPTS = [[1, 2, 3], [4, 5, 6, 7], [8, 9], [10, 11, 12, 13, 14], [15, 16, 17]]
+
+
+def _submit_all(worker):
+    return [worker.submit(prompt, stop_criteria=StopCriteria([], max_new_tokens=6)) for prompt in PROMPTS]
+
+
+def test_worker_completes_requests(toy_session):
+    worker = InferenceWorker(toy_session, max_slots=2, max_length=32).start()
+    try:
+        results = [request.result(timeout=30) for request in _submit_all(worker)]
+    finally:
+        worker.stop()
+    assert [result["reason"] for result in results] == ["max_new_tokens"] * len(PROMPTS)
+    assert all(len(result["tokens"]) == 6 for result in results)
+
+
+def test_failing_forward_resolves_every_future(toy_session):
+    worker = InferenceWorker(toy_session, max_slots=2, max_length=32)
+
+    def failing_forward(*args, **kwargs):
+        raise RuntimeError("decode failed")
+
+    worker.decoder.forward = failing_forward
+    # Queue everything before the thread starts, so some requests are still pending when decode fails.
+    requests = _submit_all(worker)
+    worker.start()
+    try:
+        for request in requests:
+            with pytest.raises(RuntimeError, match="decode failed"):
+                request.result(timeout=30)
+        assert worker.active == 0
+    finally:
+        worker.stop()
+
+
+def test_worker_recovers_after_failed_tick(toy_session):
+    worker = InferenceWorker(toy_session, max_slots=2, max_length=32)
+    forward = worker.decoder.forward
+    calls = {"n": 0}
+
+    def flaky_forward(*args, **kwargs):
+        calls["n"] += 1
+        if calls["n"] == 1:
+            raise RuntimeError("decode failed")
+        return forward(*args, **kwargs)
+
+    worker.decoder.forward = flaky_forward
+    worker.start()
+    try:
+        first = _submit_all(worker)
+        for request in first:
+            request.future.exception(timeout=30)
+        again = worker.submit(PROMPTS[0], stop_criteria=StopCriteria([], max_new_tokens=4))
+        assert len(again.result(timeout=30)["tokens"]) == 4
+    finally:
+        worker.stop()